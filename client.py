@@ -6,13 +6,12 @@ Created on Thu Dec  1 15:41:34 2016
 """
 # Imports----------------------------------------------------------------------
 from argparse import ArgumentParser
-import threading
-import Queue
 import logging
-import pika
 # Custom imports --------------------------------------------------------------
+import codec
 import common
-from windows import thread_printing
+from transport import PikaTransport
+from windows import thread_printing, Dispatcher
 from windows.server import ServerWindow
 from windows.lobby import LobbyWindow
 from windows.game import GameWindow
@@ -29,32 +28,38 @@ ___BUILT = '2016-11-10'
 # Functions -------------------------------------------------------------------
 def __info():
     return '%s version %s (%s)' % (___NAME, ___VER, ___BUILT)
-
-def window_control(events, server_window, lobby_window, game_window):
-    '''Get events from queue and show windows accordingly. In case of close
-    event, all windows are closed, and disconnect request is sent if necessary.
-    @param events: Queue of events
-    @param server_window: ServerWindow
-    @param lobby_window: LobbyWindow
-    @param game_window: GameWindow
+# Classes ---------------------------------------------------------------------
+class WindowControl(object):
+    '''State machine of shown window. Windows are switched on the Tk main
+    loop, by handlers of messages or of widgets.
     '''
-    while True:
-        try:
-            event, old_thread, arguments = events.get(timeout=5)
-            LOG.debug('Got window event: %s', event)
-            if old_thread is not None:
-                old_thread.join()
-            # Showing windows
-            if event == 'server':
-                server_window.show()
-            elif event == 'lobby':
-                lobby_window.show(arguments)
-            elif event == 'game':
-                game_window.show(arguments)
-            else:
-                LOG.debug('Unknown event for window control: %s', event)
-        except Queue.Empty:
-            pass
+    def __init__(self):
+        '''Set empty windows.
+        '''
+        # Window name -> window, name of shown window
+        self.windows = {}
+        self.state = None
+
+    def add(self, name, window):
+        '''Add window.
+        @param name: name of window
+        @param window: window with methods show(arguments) and hide()
+        '''
+        self.windows[name] = window
+
+    def switch(self, name, arguments=None):
+        '''Hide shown window and show another one.
+        @param name: name of window
+        @param arguments: arguments passed to the window
+        '''
+        if name not in self.windows:
+            LOG.debug('Unknown window: %s', name)
+            return
+        LOG.debug('Switching window: %s -> %s', self.state, name)
+        if self.state is not None:
+            self.windows[self.state].hide()
+        self.state = name
+        self.windows[name].show(arguments)
 
 # Main method -----------------------------------------------------------------
 if __name__ == '__main__':
@@ -72,30 +77,45 @@ if __name__ == '__main__':
         common.DEFAULT_SERVER_PORT,
         default=common.DEFAULT_SERVER_PORT
     )
+    parser.add_argument(
+        '-c', '--codec',
+        help='Codec of server responses, defaults to %s' % codec.CODEC_TEXT,
+        choices=codec.CODECS,
+        default=codec.CODEC_TEXT
+    )
     args = parser.parse_args()
 
-    # Connection
-    connection = pika.BlockingConnection(pika.ConnectionParameters(
-        host=args.host, port=args.port))
-    channel = connection.channel()
-    channel.exchange_declare(exchange='direct_logs', type='direct')
+    # Connections, one consumed by listening thread owning the queues, one
+    # used by windows for sending
+    transport = PikaTransport(args.host, args.port)
+    consumer = transport.channel()
+    channel = transport.channel()
 
     # Queues
-    client_queue = channel.queue_declare(exclusive=True).method.queue
-    server_advertisements = channel.queue_declare(exclusive=True).method.queue
-    game_advertisements = channel.queue_declare(exclusive=True).method.queue
-    events_queue = channel.queue_declare(exclusive=True).method.queue
+    client_queue = consumer.queue_declare(exclusive=True).method.queue
+    server_advertisements =\
+        consumer.queue_declare(exclusive=True).method.queue
+    game_advertisements = consumer.queue_declare(exclusive=True).method.queue
+    events_queue = consumer.queue_declare(exclusive=True).method.queue
 
-    # Queue for window control
-    events = Queue.Queue()
+    # Window control and one consumer of all queues for the whole run
+    control = WindowControl()
+    dispatcher = Dispatcher(consumer, channel)
+    consumer.queue_bind(exchange='direct_logs', queue=client_queue,
+                        routing_key=client_queue)
+    for queue in (client_queue, server_advertisements, game_advertisements,
+                  events_queue):
+        dispatcher.consume(queue)
 
     # Application windows
     server_window = ServerWindow(channel, server_advertisements,
-                                 client_queue, events)
+                                 client_queue, dispatcher, control,
+                                 args.codec)
     lobby_window = LobbyWindow(channel, game_advertisements,
-                               client_queue, events, server_window)
-    game_window = GameWindow(channel, client_queue, events_queue, events,
-                             server_window)
+                               client_queue, dispatcher, control,
+                               server_window)
+    game_window = GameWindow(channel, client_queue, events_queue, dispatcher,
+                             control, server_window)
 
     server_window.lobby_window = lobby_window
     lobby_window.game_window = game_window
@@ -103,12 +123,11 @@ if __name__ == '__main__':
     game_window.lobby_window = lobby_window
 
     # Controling which windows are shown and which are hidden
-    t_control = threading.Thread(target=window_control,
-                                 args=(events, server_window,
-                                       lobby_window, game_window),
-                                 name='Window control')
-    t_control.setDaemon(True)
-    t_control.start()
+    control.add('server', server_window)
+    control.add('lobby', lobby_window)
+    control.add('game', game_window)
+    control.switch('server')
+    dispatcher.start(server_window.root)
 
     #thread_printing()
 
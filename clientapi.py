@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""
+Client of the battleship server without graphical interface.
+
+Every request returns a Future resolved by the response with the same
+correlation id, so any number of requests may be pending. Requests without
+response in time fail, or are sent again with the same correlation id if the
+server de-duplicates them. Game events, and hits of the player's ships, are
+passed to subscribed callbacks.
+
+Callbacks of futures and subscribers run in the consuming thread of the
+client. Only that thread uses the consumed channel, requests are published on
+another channel.
+"""
+# Imports ---------------------------------------------------------------------
+import collections
+import threading
+import time
+import logging
+# Custom imports --------------------------------------------------------------
+import clientlib
+import codec
+import common
+from common import send_message
+from transport import ChannelControl
+# Logging ---------------------------------------------------------------------
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+# Constants -------------------------------------------------------------------
+# Default seconds to wait for a response, and number of repeated requests
+RESPONSE_TIMEOUT = 10
+RETRIES = 2
+# Seconds between checks of pending requests
+TIMEOUT_PERIOD = 0.1
+# Classes ---------------------------------------------------------------------
+# Page of list of games: number of all games, offset and names of the page
+GamePage = collections.namedtuple('GamePage', ('total', 'offset', 'names'))
+
+class RequestTimeout(Exception):
+    '''Response did not come in time.
+    '''
+
+class Future(object):
+    '''Result of request, available when the response comes.
+    '''
+    def __init__(self):
+        '''Set result, event of resolving and callbacks.
+        '''
+        self.value = None
+        self.exception = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def done(self):
+        '''Check if future is resolved.
+        @return True if resolved, else False
+        '''
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        '''Wait for result.
+        @param timeout: seconds to wait, None to wait until resolved
+        @return result
+        @raise RequestTimeout: if not resolved in time, or if the request got
+                               no response
+        '''
+        if not self.event.wait(timeout):
+            raise RequestTimeout()
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def add_done_callback(self, callback):
+        '''Call function when the future is resolved, or now if it is.
+        @param callback: function(future)
+        '''
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, value, exception=None):
+        '''Resolve future and call callbacks.
+        @param value: result
+        @param exception: exception raised by result() instead, if failed
+        '''
+        with self.lock:
+            self.value = value
+            self.exception = exception
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                LOG.exception('Callback of future failed.')
+
+class PendingRequest(object):
+    '''Request waiting for response.
+    '''
+    def __init__(self, message, routing_key, convert, deadline, retries):
+        '''Set request, future and its resolving.
+        @param message: String, request
+        @param routing_key: routing key
+        @param convert: function(message parts) returning result of future
+        @param deadline: time when the request fails or is sent again
+        @param retries: number of times the request may be sent again
+        '''
+        self.message = message
+        self.routing_key = routing_key
+        self.convert = convert
+        self.deadline = deadline
+        self.retries = retries
+        self.future = Future()
+
+class BattleshipClient(object):
+    '''Client of one player.
+    '''
+    def __init__(self, transport, server_name, client_name,
+                 codec_name=codec.CODEC_TEXT, timeout=RESPONSE_TIMEOUT,
+                 retries=RETRIES):
+        '''Open channels, declare queues and start consuming and timeout
+        checking threads.
+        @param transport: transport opening channels
+        @param server_name: name of server
+        @param client_name: name of player
+        @param codec_name: codec of server responses
+        @param timeout: seconds to wait for a response
+        @param retries: number of times de-duplicated requests are sent again
+        '''
+        self.server_name = server_name
+        self.client_name = client_name
+        self.codec_name = codec_name
+        self.timeout = timeout
+        self.retries = retries
+        self.closed = False
+
+        # Current game, and queue of its spectators if spectating
+        self.game_name = None
+        self.spectator_queue = None
+
+        # Correlation id -> PendingRequest
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.subscribers = []
+
+        # Routing keys
+        self.key_server = common.make_key_server(self.server_name)
+        self.key_games = common.make_key_games(self.server_name)
+
+        # Queues, consumed channel and channel publishing requests
+        self.channel = transport.channel()
+        self.publisher = transport.channel()
+        self.client_queue =\
+            self.channel.queue_declare(exclusive=True).method.queue
+        self.channel.queue_bind(exchange='direct_logs',
+                                queue=self.client_queue,
+                                routing_key=self.client_queue)
+        self.events_queue =\
+            self.channel.queue_declare(exclusive=True).method.queue
+        self.channel.basic_consume(common.decompressing(self.on_response),
+                                   queue=self.client_queue,
+                                   no_ack=True)
+        self.channel.basic_consume(common.decompressing(self.on_event),
+                                   queue=self.events_queue,
+                                   no_ack=True)
+        self.control = ChannelControl(self.channel, self.publisher)
+
+        self.thread = threading.Thread(
+            target=self.consume,
+            name='Client consumer: %s' % self.client_name)
+        self.thread.setDaemon(True)
+        self.control.start(self.thread)
+        self.thread.start()
+
+        self.timer = threading.Thread(
+            target=self.check_timeouts,
+            name='Client timeouts: %s' % self.client_name)
+        self.timer.setDaemon(True)
+        self.timer.start()
+
+    def consume(self):
+        '''Consume channel until the client is closed, then close it.
+        '''
+        self.channel.start_consuming()
+        self.channel.close()
+
+    def close(self):
+        '''Stop consuming and close channels.
+        '''
+        self.closed = True
+        self.control.call('stop_consuming')
+        with self.control.lock:
+            self.publisher.close()
+
+    # Requests ----------------------------------------------------------------
+    def request(self, message, routing_key, convert=None):
+        '''Send request.
+        @param message: String, request
+        @param routing_key: routing key
+        @param convert: function(message parts) returning result of future,
+                        or None to get the message parts
+        @return Future
+        '''
+        request_type = message.split(common.SEP, 1)[0]
+        retries = 0
+        if request_type in common.DEDUPLICATED_REQUESTS:
+            retries = self.retries
+        pending = PendingRequest(message, routing_key, convert,
+                                 time.time() + self.timeout, retries)
+        correlation_id = common.make_correlation_id()
+        with self.lock:
+            self.pending[correlation_id] = pending
+        self.send(message, routing_key, correlation_id)
+        return pending.future
+
+    def send(self, message, routing_key, correlation_id):
+        '''Publish request on the channel shared by requesting threads.
+        @param message: String, request
+        @param routing_key: routing key
+        @param correlation_id: correlation id of request
+        '''
+        with self.control.lock:
+            send_message(self.publisher, message, routing_key,
+                         self.client_queue, correlation_id=correlation_id)
+
+    def check_timeouts(self):
+        '''Send again or fail requests without response in time.
+        '''
+        while not self.closed:
+            time.sleep(TIMEOUT_PERIOD)
+            now = time.time()
+            again = []
+            failed = []
+            with self.lock:
+                for correlation_id, pending in self.pending.items():
+                    if pending.deadline > now:
+                        continue
+                    if pending.retries > 0:
+                        pending.retries -= 1
+                        pending.deadline = now + self.timeout
+                        again.append((correlation_id, pending))
+                    else:
+                        del self.pending[correlation_id]
+                        failed.append(pending)
+            for correlation_id, pending in again:
+                LOG.debug('Sending request again: %s', pending.message)
+                self.send(pending.message, pending.routing_key,
+                          correlation_id)
+            for pending in failed:
+                pending.future.set_result(None, RequestTimeout(
+                    pending.message.split(common.SEP, 1)[0]))
+
+    def game_request(self, message, convert=None):
+        '''Send request to the current game.
+        @param message: String, request
+        @param convert: function(message parts) returning result of future
+        @return Future
+        '''
+        return self.request(message,
+                            common.make_key_game(self.server_name,
+                                                 self.game_name),
+                            convert)
+
+    def connect(self):
+        '''Connect to server.
+        @return Future of message parts
+        '''
+        return self.request(
+            clientlib.make_req_connect(self.client_name, self.codec_name),
+            self.key_server)
+
+    def disconnect(self):
+        '''Disconnect from server, and from the current game.
+        @return Future of message parts
+        '''
+        msg = clientlib.make_req_disconnect(self.client_name)
+        if self.game_name is not None:
+            self.game_request(msg)
+            self.enter_game(None)
+        return self.request(msg, self.key_server)
+
+    def list_games(self, offset=None, limit=None):
+        '''List opened and closed games.
+        @param offset: number of games skipped in both lists
+        @param limit: maximal number of games in both lists, all if offset is
+                      None
+        @return Future of tuple (GamePage of opened, GamePage of closed games)
+        '''
+        msg = clientlib.make_req_batch([
+            clientlib.make_req_list_opened(offset, limit),
+            clientlib.make_req_list_closed(offset, limit)])
+        return self.request(msg, self.key_games, self.convert_games)
+
+    def convert_games(self, msg_parts):
+        '''Get pages of games from batch response.
+        @param msg_parts: message parts of batch response
+        @return tuple (GamePage of opened, GamePage of closed games), or
+                message parts if request failed
+        '''
+        if msg_parts[0] != common.RSP_BATCH:
+            return msg_parts
+        pages = []
+        for response in common.unpack_messages(msg_parts[1:]):
+            if response[0] not in (common.RSP_LIST_OPENED,
+                                   common.RSP_LIST_CLOSED):
+                return response
+            pages.append(GamePage(int(response[1]), int(response[2]),
+                                  response[3:]))
+        return tuple(pages)
+
+    def enter_game(self, game_name, spectator_queue=None):
+        '''Set the current game, and receive its events. Events queue is
+        bound by the consuming thread.
+        @param game_name: name of game, None to receive no events
+        @param spectator_queue: routing key of spectator stream if
+                                spectating
+        '''
+        for routing_key in self.event_keys():
+            self.control.unbind(self.events_queue, routing_key)
+        self.game_name = game_name
+        self.spectator_queue = spectator_queue
+        for routing_key in self.event_keys():
+            self.control.bind(self.events_queue, routing_key)
+
+    def event_keys(self):
+        '''Get routing keys of events of the current game.
+        @return list of routing keys
+        '''
+        keys = []
+        if self.game_name is not None:
+            keys.append(common.make_key_game_events(self.server_name,
+                                                    self.game_name))
+        if self.spectator_queue is not None:
+            keys.append(self.spectator_queue)
+        return keys
+
+    def entering(self, message, game_name):
+        '''Send request entering game. Events of the game are received from
+        sending the request, and stop if the request fails.
+        @param message: String, request
+        @param game_name: name of game
+        @return Future of message parts
+        '''
+        self.enter_game(game_name)
+        future = self.request(message, self.key_games)
+
+        def entered(future):
+            if future.exception is not None:
+                # Request timed out, the game is left as if entering failed
+                if self.game_name == game_name:
+                    self.enter_game(None)
+                return
+            msg_parts = future.value
+            if msg_parts[0] == common.RSP_GAME_SPECTATE:
+                self.enter_game(game_name, msg_parts[3])
+            elif msg_parts[0] != common.RSP_GAME_ENTERED and\
+                self.game_name == game_name:
+                self.enter_game(None)
+        future.add_done_callback(entered)
+        return future
+
+    def create_game(self, game_name, width, height):
+        '''Create game and enter it as owner.
+        @return Future of message parts
+        '''
+        return self.entering(clientlib.make_req_create_game(
+            game_name, self.client_name, width, height), game_name)
+
+    def join(self, game_name):
+        '''Join game as player.
+        @return Future of message parts
+        '''
+        return self.entering(
+            clientlib.make_req_join_game(game_name, self.client_name),
+            game_name)
+
+    def spectate(self, game_name):
+        '''Enter game as spectator.
+        @return Future of message parts
+        '''
+        return self.entering(
+            clientlib.make_req_spectate_game(game_name, self.client_name),
+            game_name)
+
+    def follow_spectators(self):
+        '''Ask for spectator stream of the current game again, its key
+        changes when the game starts.
+        @return Future of message parts
+        '''
+        game_name = self.game_name
+        future = self.game_request(
+            clientlib.make_req_get_spectator_queue(self.client_name))
+
+        def followed(future):
+            if future.exception is not None or\
+                future.value[0] != common.RSP_SPECTATOR_QUEUE:
+                return
+            if self.game_name == game_name:
+                self.enter_game(game_name, future.value[1])
+        future.add_done_callback(followed)
+        return future
+
+    def leave(self):
+        '''Leave the current game.
+        @return Future of message parts
+        '''
+        future = self.game_request(
+            clientlib.make_req_leave_game(self.client_name))
+        self.enter_game(None)
+        return future
+
+    def get_dimensions(self):
+        '''Get width, height and number of ships of the current game.
+        @return Future of message parts
+        '''
+        return self.game_request(clientlib.make_req_get_dimensions())
+
+    def get_game_state(self):
+        '''Get snapshot of the current game.
+        @return Future of message parts
+        '''
+        return self.game_request(
+            clientlib.make_req_get_game_state(self.client_name))
+
+    def get_keyframe(self):
+        '''Get the latest keyframe of spectator stream with deltas after it.
+        @return Future of message parts
+        '''
+        return self.game_request(
+            clientlib.make_req_get_keyframe(self.client_name))
+
+    def set_ready(self, ships):
+        '''Place ships and get ready.
+        @param ships: list of tuples (row, column), or common.Field of ships,
+                      sent as one dump if they are many
+        @return Future of message parts
+        '''
+        if isinstance(ships, common.Field):
+            ships = ships.export()
+        else:
+            ships = [common.FIELD_SEP.join((str(row), str(column)))
+                     for row, column in ships]
+        return self.game_request(
+            clientlib.make_req_set_ready(self.client_name, ships))
+
+    def kick_out(self, opponent_name):
+        '''Kick player out of the current game.
+        @return Future of message parts
+        '''
+        return self.game_request(
+            clientlib.make_req_kick_out(self.client_name, opponent_name))
+
+    def start_game(self):
+        '''Start the current game.
+        @return Future of message parts
+        '''
+        return self.game_request(
+            clientlib.make_req_start_game(self.client_name))
+
+    def shoot(self, opponent_name, row, column):
+        '''Shoot at opponent's field.
+        @return Future of message parts
+        '''
+        return self.game_request(clientlib.make_req_shoot(
+            self.client_name, opponent_name, row, column))
+
+    def restart(self):
+        '''Restart session of ended game.
+        @return Future of message parts
+        '''
+        return self.game_request(clientlib.make_req_restart_session())
+
+    # Events ------------------------------------------------------------------
+    def subscribe(self, callback):
+        '''Call function on every event of the current game.
+        @param callback: function(message parts)
+        '''
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        '''Stop calling function on events.
+        @param callback: function(message parts)
+        '''
+        self.subscribers.remove(callback)
+
+    def publish_event(self, msg_parts):
+        '''Pass event to subscribers.
+        @param msg_parts: message parts of event
+        '''
+        for callback in list(self.subscribers):
+            try:
+                callback(msg_parts)
+            except Exception:
+                LOG.exception('Subscriber of events failed.')
+
+    def on_event(self, ch, method, properties, body):
+        '''Pass event to subscribers.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
+        msg_parts = codec.decode(body)
+        if msg_parts[0] == common.E_GAME_STARTS and\
+            self.spectator_queue is not None:
+            self.follow_spectators()
+        self.publish_event(msg_parts)
+
+    def on_response(self, ch, method, properties, body):
+        '''Resolve the pending request with the correlation id of response.
+        Messages without correlation id, hits of the player's ships, are
+        passed to subscribers as events.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
+        msg_parts = codec.decode(body)
+        if properties.correlation_id is None:
+            self.publish_event(msg_parts)
+            return
+
+        with self.lock:
+            pending = self.pending.pop(properties.correlation_id, None)
+        if pending is None:
+            LOG.debug('Response to no pending request: %s', msg_parts[0])
+            return
+        if pending.convert is not None:
+            msg_parts = pending.convert(msg_parts)
+        pending.future.set_result(msg_parts)
@@ -20,20 +20,41 @@ def do_str(func):
     return wrapped
 
 @do_str
-def make_req_connect(client_name):
-    return common.REQ_CONNECT, client_name
+def make_req_connect(client_name, codec=None):
+    if codec is None:
+        return common.REQ_CONNECT, client_name
+    else:
+        return common.REQ_CONNECT, client_name, codec
 
 @do_str
 def make_req_disconnect(client_name):
     return common.REQ_DISCONNECT, client_name
 
 @do_str
-def make_req_list_opened():
-    return common.REQ_LIST_OPENED,
+def make_req_register(server_name, node):
+    return common.REQ_REGISTER, server_name, node
 
 @do_str
-def make_req_list_closed():
-    return common.REQ_LIST_CLOSED,
+def make_req_unregister(server_name, node):
+    return common.REQ_UNREGISTER, server_name, node
+
+@do_str
+def make_req_list_servers():
+    return common.REQ_LIST_SERVERS,
+
+@do_str
+def make_req_list_opened(offset=None, limit=None):
+    if offset is None:
+        return common.REQ_LIST_OPENED,
+    else:
+        return common.REQ_LIST_OPENED, str(offset), str(limit)
+
+@do_str
+def make_req_list_closed(offset=None, limit=None):
+    if offset is None:
+        return common.REQ_LIST_CLOSED,
+    else:
+        return common.REQ_LIST_CLOSED, str(offset), str(limit)
 
 @do_str
 def make_req_create_game(game_name, client_name, width, height):
@@ -88,10 +109,22 @@ def make_req_get_spectator(client_name):
 def make_req_get_spectator_queue(client_name):
     return common.REQ_GET_SPECTATOR_QUEUE, client_name
 
+@do_str
+def make_req_get_keyframe(client_name):
+    return common.REQ_GET_KEYFRAME, client_name
+
 @do_str
 def make_req_get_hits(client_name):
     return common.REQ_GET_HITS, client_name
 
+@do_str
+def make_req_get_game_state(client_name):
+    return common.REQ_GET_GAME_STATE, client_name
+
+@do_str
+def make_req_get_changes(client_name, version):
+    return common.REQ_GET_CHANGES, client_name, str(version)
+
 @do_str
 def make_req_set_ready(client_name, ships):
     return [common.REQ_SET_READY, client_name] + ships
@@ -111,3 +144,7 @@ def make_req_shoot(client_name, opponent_name, row, column):
 @do_str
 def make_req_restart_session():
     return common.REQ_RESTART_SESSION,
+
+@do_str
+def make_req_batch(messages):
+    return [common.REQ_BATCH] + common.pack_messages(messages)
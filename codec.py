@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Binary encoding of messages.
+
+Binary message starts with BINARY_MAGIC byte followed by the opcode of the
+message keyword. The rest of the message parts are grouped into runs of parts
+of the same kind: tag byte, varint number of parts, and encoded parts. Numbers
+are varints, field items are one byte codes from common.Field.
+"""
+# Imports ---------------------------------------------------------------------
+import logging
+# Custom imports --------------------------------------------------------------
+import common
+# Logging ---------------------------------------------------------------------
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+# Constants -------------------------------------------------------------------
+# Names of codecs negotiated at connect request
+CODEC_TEXT = 'text'
+CODEC_BINARY = 'binary'
+CODECS = (CODEC_TEXT, CODEC_BINARY)
+
+# Text messages never start with this byte
+BINARY_MAGIC = '\x00'
+
+# Message keywords and their opcodes
+KEYWORDS = sorted(set(
+    value for key, value in vars(common).items()
+    if key.startswith(('REQ_', 'RSP_', 'E_'))
+))
+OPCODES = dict((keyword, opcode) for opcode, keyword in enumerate(KEYWORDS))
+
+# Kinds of message parts
+TAG_TEXT = 0        # text
+TAG_NUMBER = 1      # number
+TAG_POSITION = 2    # row, column
+TAG_ITEM = 3        # row, column, item
+TAG_HIT = 4         # player, row, column, item
+
+# Encoding functions ----------------------------------------------------------
+def is_number(value):
+    '''Check if value is a canonically written non-negative number.
+    @param value: String
+    @return True if number, else False
+    '''
+    return value.isdigit() and (value[0] != '0' or value == '0')
+
+def is_item(value):
+    '''Check if value is a field item.
+    @param value: String
+    @return True if item, else False
+    '''
+    return value is not None and value in common.Field.CODES
+
+def part_tag(fields):
+    '''Get kind of message part.
+    @param fields: message part split by field separator
+    @return int, tag
+    '''
+    if len(fields) == 1 and is_number(fields[0]):
+        return TAG_NUMBER
+    if len(fields) == 2 and is_number(fields[0]) and is_number(fields[1]):
+        return TAG_POSITION
+    if len(fields) == 3 and is_number(fields[0]) and is_number(fields[1]) and\
+        is_item(fields[2]):
+        return TAG_ITEM
+    if len(fields) == 4 and is_number(fields[1]) and is_number(fields[2]) and\
+        is_item(fields[3]):
+        return TAG_HIT
+    return TAG_TEXT
+
+def put_varint(out, number):
+    '''Append varint to output.
+    @param out: bytearray
+    @param number: non-negative int
+    '''
+    while number > 0x7f:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+def put_text(out, value):
+    '''Append text with its length to output.
+    @param out: bytearray
+    @param value: String
+    '''
+    put_varint(out, len(value))
+    out.extend(value)
+
+def put_part(out, tag, fields):
+    '''Append message part to output.
+    @param out: bytearray
+    @param tag: kind of part
+    @param fields: message part split by field separator
+    '''
+    if tag == TAG_TEXT:
+        put_text(out, common.FIELD_SEP.join(fields))
+    elif tag == TAG_NUMBER:
+        put_varint(out, int(fields[0]))
+    elif tag == TAG_POSITION:
+        put_varint(out, int(fields[0]))
+        put_varint(out, int(fields[1]))
+    elif tag == TAG_ITEM:
+        put_varint(out, int(fields[0]))
+        put_varint(out, int(fields[1]))
+        out.append(common.Field.CODES[fields[2]])
+    elif tag == TAG_HIT:
+        put_text(out, fields[0])
+        put_varint(out, int(fields[1]))
+        put_varint(out, int(fields[2]))
+        out.append(common.Field.CODES[fields[3]])
+
+def encode(message):
+    '''Encode text message into binary message.
+    @param message: String, text message
+    @return String, binary message, or the text message if it has unknown
+            keyword
+    '''
+    parts = message.split(common.SEP)
+    if parts[0] not in OPCODES:
+        return message
+
+    out = bytearray(BINARY_MAGIC)
+    out.append(OPCODES[parts[0]])
+
+    # Group parts of the same kind
+    runs = []
+    for part in parts[1:]:
+        fields = part.split(common.FIELD_SEP)
+        tag = part_tag(fields)
+        if runs and runs[-1][0] == tag:
+            runs[-1][1].append(fields)
+        else:
+            runs.append((tag, [fields]))
+
+    for tag, run in runs:
+        out.append(tag)
+        put_varint(out, len(run))
+        for fields in run:
+            put_part(out, tag, fields)
+    return str(out)
+
+# Decoding functions ----------------------------------------------------------
+def get_byte(view, pos):
+    '''Read byte.
+    @param view: memoryview of message
+    @param pos: position in message
+    @return int, byte
+    @raise ValueError: if message ends before the position
+    '''
+    if pos >= len(view):
+        raise ValueError('Truncated binary message')
+    return ord(view[pos])
+
+def get_varint(view, pos):
+    '''Read varint.
+    @param view: memoryview of message
+    @param pos: position in message
+    @return tuple (number, position after the varint)
+    @raise ValueError: if message ends within the varint
+    '''
+    number = 0
+    shift = 0
+    while True:
+        byte = get_byte(view, pos)
+        pos += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+def get_text(view, pos):
+    '''Read text with its length.
+    @param view: memoryview of message
+    @param pos: position in message
+    @return tuple (String, position after the text)
+    @raise ValueError: if message ends within the text
+    '''
+    length, pos = get_varint(view, pos)
+    if pos + length > len(view):
+        raise ValueError('Truncated binary message')
+    return view[pos:pos + length].tobytes(), pos + length
+
+def get_part(view, pos, tag):
+    '''Read message part.
+    @param view: memoryview of message
+    @param pos: position in message
+    @param tag: kind of part
+    @return tuple (String, position after the part)
+    @raise ValueError: if part is truncated or of unknown kind or item
+    '''
+    if tag == TAG_TEXT:
+        return get_text(view, pos)
+    if tag == TAG_NUMBER:
+        number, pos = get_varint(view, pos)
+        return str(number), pos
+    if tag not in (TAG_POSITION, TAG_ITEM, TAG_HIT):
+        raise ValueError('Unknown kind of message part %d' % tag)
+
+    fields = []
+    if tag == TAG_HIT:
+        player, pos = get_text(view, pos)
+        fields.append(player)
+    row, pos = get_varint(view, pos)
+    column, pos = get_varint(view, pos)
+    fields += [str(row), str(column)]
+    if tag != TAG_POSITION:
+        code = get_byte(view, pos)
+        if code == 0 or code >= len(common.Field.ITEMS):
+            raise ValueError('Unknown item code %d' % code)
+        fields.append(common.Field.ITEMS[code])
+        pos += 1
+    return common.FIELD_SEP.join(fields), pos
+
+def is_binary(body):
+    '''Check if message is binary.
+    @param body: String, message
+    @return True if binary, else False
+    '''
+    return body[:1] == BINARY_MAGIC
+
+def decode(body):
+    '''Decode message of either codec into message parts.
+    @param body: String, message
+    @return list of message parts, as if text message was split by separator
+    @raise ValueError: if binary message is malformed
+    '''
+    if not is_binary(body):
+        return body.split(common.SEP)
+
+    view = memoryview(body)
+    opcode = get_byte(view, 1)
+    if opcode >= len(KEYWORDS):
+        raise ValueError('Unknown opcode %d' % opcode)
+    parts = [KEYWORDS[opcode]]
+    pos = 2
+    while pos < len(view):
+        tag = get_byte(view, pos)
+        count, pos = get_varint(view, pos + 1)
+        for _ in xrange(count):
+            part, pos = get_part(view, pos, tag)
+            parts.append(part)
+    return parts
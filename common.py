@@ -5,8 +5,14 @@ Created on Thu Dec  1 21:38:50 2016
 @author: pavla kratochvilova
 """
 # Imports ---------------------------------------------------------------------
+import base64
+import binascii
 import functools
+import itertools
 import logging
+import re
+import uuid
+import zlib
 import pika
 # Logging ---------------------------------------------------------------------
 LOG = logging.getLogger(__name__)
@@ -14,13 +20,21 @@ LOG.setLevel(logging.DEBUG)
 # Connection related constants ------------------------------------------------
 DEFAULT_SERVER_PORT = 5672
 DEFAULT_SERVER_INET_ADDR = '127.0.0.1'
+# Message bodies of at least COMPRESS_THRESHOLD bytes are compressed by zlib,
+# marked by content encoding ENCODING_DEFLATE
+COMPRESS_THRESHOLD = 1024
+ENCODING_DEFLATE = 'deflate'
+# Largest decompressed message body in bytes
+MAX_BODY = 16 * 1024 * 1024
 
 # Routing keys ----------------------------------------------------------------
-KEY_SERVER_ADVERT = 'server_advert'
-KEY_SERVER_STOP = 'server_stop'
+KEY_DIRECTORY = 'directory'
+KEY_DIRECTORY_EVENTS = 'directory events'
 KEY_GAMES = 'games'
 KEY_GAME_ADVERT = 'game advert'
 KEY_GAME_EVENTS = 'game events'
+KEY_WORKER = 'worker'
+KEY_CLUSTER = 'cluster'
 
 # Routing keys functions ------------------------------------------------------
 def do_str(func):
@@ -30,12 +44,12 @@ def do_str(func):
     return wrapped
 
 @do_str
-def make_key_server_advert():
-    return KEY_SERVER_ADVERT,
+def make_key_directory():
+    return KEY_DIRECTORY,
 
 @do_str
-def make_key_server_stop():
-    return KEY_SERVER_STOP,
+def make_key_directory_events():
+    return KEY_DIRECTORY_EVENTS,
 
 @do_str
 def make_key_server(server_name):
@@ -57,6 +71,18 @@ def make_key_game(server_name, game_name):
 def make_key_game_events(server_name, game_name):
     return server_name, game_name, KEY_GAME_EVENTS
 
+def make_key_game_spectators():
+    # Random key known only to spectators, as the stream shows all ships
+    return uuid.uuid4().hex
+
+@do_str
+def make_key_worker(server_name, node, number):
+    return server_name, KEY_WORKER, node, str(number)
+
+@do_str
+def make_key_cluster(server_name):
+    return server_name, KEY_CLUSTER
+
 # Connecting ------------------------------------------------------------------
 # Requests
 REQ_CONNECT = 'req connect'
@@ -66,6 +92,28 @@ RSP_CONNECTED = 'rsp connected'
 RSP_DISCONNECTED = 'rsp disconnected'
 RSP_USERNAME_TAKEN = 'rsp username taken'
 
+# Directory -------------------------------------------------------------------
+# Requests
+REQ_REGISTER = 'req register'
+REQ_UNREGISTER = 'req unregister'
+REQ_LIST_SERVERS = 'req list servers'
+# Responses
+RSP_REGISTERED = 'rsp registered'
+RSP_LIST_SERVERS = 'rsp list servers'
+# Events, the version of the directory is in the message headers
+E_SERVER_JOIN = 'server join'
+E_SERVER_LEAVE = 'server leave'
+E_SERVER_EXPIRE = 'server expire'
+
+# Cluster ---------------------------------------------------------------------
+# Messages between nodes of server cluster, the second part is name of the
+# sending node
+CLUSTER_HELLO = 'cluster hello'
+CLUSTER_CLIENTS = 'cluster clients'
+CLUSTER_CODECS = 'cluster codecs'
+CLUSTER_CLIENT_LEFT = 'cluster client left'
+CLUSTER_GAMES = 'cluster games'
+
 # Game list -------------------------------------------------------------------
 # Requests
 REQ_LIST_OPENED = 'req list opened'
@@ -93,7 +141,10 @@ REQ_GET_FIELD = 'get field'
 REQ_GET_ALL_FIELDS = 'get all fields'
 REQ_GET_SPECTATOR = 'get spectator'
 REQ_GET_SPECTATOR_QUEUE = 'get spectator queue'
+REQ_GET_KEYFRAME = 'get keyframe'
 REQ_GET_HITS = 'get hits'
+REQ_GET_GAME_STATE = 'get game state'
+REQ_GET_CHANGES = 'get changes'
 REQ_SET_READY = 'set ready'
 REQ_KICK_OUT = 'kick out'
 REQ_START_GAME = 'start game'
@@ -110,7 +161,11 @@ RSP_FIELD = 'field'
 RSP_ALL_FIELDS = 'all fields'
 RSP_SPECTATOR = 'spectator'
 RSP_SPECTATOR_QUEUE = 'spectator queue'
+RSP_KEYFRAME = 'keyframe'
 RSP_HITS = 'hits'
+RSP_PLAYER_ORDER = 'player order'
+RSP_GAME_STATE = 'game state'
+RSP_CHANGES = 'changes'
 RSP_READY = 'ready'
 RSP_WONT_KICK = 'wont kick'
 RSP_SHIPS_INCORRECT = 'ships incorrect'
@@ -127,20 +182,33 @@ E_PLAYER_READY = 'player ready'
 E_GAME_STARTS = 'game starts'
 E_ON_TURN = 'on turn'
 E_HIT = 'hit'
+E_MISS = 'miss'
 E_SINK = 'sink'
 E_PLAYER_END = 'player end'
 E_GAME_RESTART = 'game restart'
+# Fields of all players, sent to spectators between their deltas
+E_KEYFRAME = 'keyframe'
 
 # Game advert events ----------------------------------------------------------
 E_GAME_OPEN = 'game open'
 E_GAME_CLOSE = 'game close'
 E_GAME_END = 'game end'
 
+# Batch -----------------------------------------------------------------------
+# Requests
+REQ_BATCH = 'batch'
+# Responses
+RSP_BATCH = 'rsp batch'
+
 # Common responses ------------------------------------------------------------
 RSP_OK = 'ok'
 RSP_PERMISSION_DENIED = 'permission denied'
 RSP_INVALID_REQUEST = 'invalid request'
 
+# Requests the server answers only once per correlation id, so that clients
+# may send them again
+DEDUPLICATED_REQUESTS = (REQ_SHOOT, REQ_SET_READY)
+
 # Separator -------------------------------------------------------------------
 SEP = '\n'
 FIELD_SEP = '\t'
@@ -152,58 +220,242 @@ FIELD_HIT_SHIP = 'hit_ship'
 FIELD_SINK_SHIP = 'sink ship'
 FIELD_UNKNOWN = 'unknown'
 
+# Field sizes -----------------------------------------------------------------
+# Largest width and height of game field
+MAX_FIELD_SIZE = 1000
+# Fields with more items are sent as one dump instead of item per part
+MAX_ITEM_PARTS = 64
+# Mark of message part holding field dump
+FIELD_DUMP = 'dump'
+
 # Common functions ------------------------------------------------------------
-def send_message(channel, message, routing_key, reply_to=None):
+# Correlation ids are unique prefix of the process and a counter
+CORRELATION_PREFIX = uuid.uuid4().hex[:12]
+CORRELATION_COUNTER = itertools.count()
+
+def make_correlation_id():
+    '''Make new correlation id of request.
+    @return String, correlation id
+    '''
+    return '%s.%d' % (CORRELATION_PREFIX, next(CORRELATION_COUNTER))
+
+def send_message(channel, message, routing_key, reply_to=None, version=None,
+                 correlation_id=None):
     '''Compose message and routing key, and send request.
     @param channel: pika communication channel
     @param message: message
     @param routing_key: routing key
     @param reply_to: queue expecting reply
+    @param version: version of game state after the event, if message is event
+    @param correlation_id: correlation id of request, new one is made if the
+                           message expects reply
+    @return correlation id, or None if the message expects no reply
     '''
-    properties = pika.BasicProperties(reply_to=reply_to)
+    headers = None
+    if version is not None:
+        headers = {'version': version}
+    if reply_to is not None and correlation_id is None:
+        correlation_id = make_correlation_id()
+    body, encoding = compress(message)
+    properties = pika.BasicProperties(reply_to=reply_to, headers=headers,
+                                      correlation_id=correlation_id,
+                                      content_encoding=encoding)
     channel.basic_publish(exchange='direct_logs', routing_key=routing_key,
-                          properties=properties, body=message)
+                          properties=properties, body=body)
     LOG.debug('Sent message to "%s": "%s"', routing_key, message)
+    return correlation_id
+
+def compress(body):
+    '''Compress large message body.
+    @param body: String, message body
+    @return tuple (body, content encoding or None if not compressed)
+    '''
+    if len(body) < COMPRESS_THRESHOLD:
+        return body, None
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    compressed = zlib.compress(body)
+    if len(compressed) >= len(body):
+        return body, None
+    return compressed, ENCODING_DEFLATE
+
+def inflate(data, limit):
+    '''Decompress zlib data of bounded size.
+    @param data: str, compressed data
+    @param limit: largest size of decompressed data in bytes
+    @return str, decompressed data
+    @raise ValueError: if data are invalid or decompress over the limit
+    '''
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(data, limit + 1)
+    except zlib.error as e:
+        raise ValueError('Invalid compressed data: %s' % e)
+    if len(result) > limit or decompressor.unconsumed_tail:
+        raise ValueError('Compressed data over %d bytes' % limit)
+    return result
+
+def decompress(properties, body):
+    '''Decompress message body according to its content encoding.
+    @param properties: pika.spec.BasicProperties
+    @param body: str
+    @return str, body
+    @raise ValueError: if body is invalid or over MAX_BODY bytes
+    '''
+    if properties is not None and\
+        properties.content_encoding == ENCODING_DEFLATE:
+        return inflate(body, MAX_BODY)
+    return body
+
+def decompressing(callback):
+    '''Wrap consumer callback, so that it gets decompressed message bodies.
+    Bodies that cannot be decompressed are passed empty, so that they are
+    answered as invalid requests.
+    @param callback: function(ch, method, properties, body)
+    @return function(ch, method, properties, body)
+    '''
+    @functools.wraps(callback)
+    def wrapped(ch, method, properties, body):
+        try:
+            body = decompress(properties, body)
+        except ValueError as e:
+            LOG.warn('Message body rejected: %s', e)
+            body = ''
+        return callback(ch, method, properties, body)
+    return wrapped
+
+def is_field_dump(part):
+    '''Check if message part holds field dump.
+    @param part: String, message part
+    @return True if dump, else False
+    '''
+    return part.startswith(FIELD_DUMP + FIELD_SEP)
+
+def get_version(properties):
+    '''Get version of game state the event leads to.
+    @param properties: pika.spec.BasicProperties
+    @return int, version, or None if the message has no version
+    '''
+    if properties is None or not properties.headers:
+        return None
+    return properties.headers.get('version')
+
+def pack_messages(messages):
+    '''Pack messages into message parts of one message. Every message is
+    preceded by number of its parts.
+    @param messages: list of messages
+    @return list, message parts
+    '''
+    result = []
+    for message in messages:
+        msg_parts = message.split(SEP)
+        result.append(str(len(msg_parts)))
+        result += msg_parts
+    return result
+
+def unpack_messages(msg_parts):
+    '''Unpack messages packed by pack_messages.
+    @param msg_parts: message parts
+    @return list of parsed messages
+    @raise ValueError: if the message parts are not packed messages
+    '''
+    result = []
+    i = 0
+    while i < len(msg_parts):
+        length = int(msg_parts[i])
+        if length < 1 or i + 1 + length > len(msg_parts):
+            raise ValueError('Invalid packed messages')
+        result.append(msg_parts[i + 1:i + 1 + length])
+        i += 1 + length
+    return result
 
 # Common classes --------------------------------------------------------------
 class Field(object):
-    '''Field class.
+    '''Field class. Items are stored as small integer codes in a row-major
+    bytearray, together with running counts of every item type. Changed
+    positions can be recorded for partial redraws of the field.
     '''
+    # Item codes, code 0 marks an empty position
+    ITEMS = (None, FIELD_WATER, FIELD_SHIP, FIELD_HIT_SHIP, FIELD_SINK_SHIP,
+             FIELD_UNKNOWN)
+    CODES = dict((item, code) for code, item in enumerate(ITEMS))
+
     def __init__(self, width, height):
-        '''Initialize - field dimensions and dict of items.
+        '''Initialize - field dimensions, grid of item codes and counts.
         @param width: width
         @param height: height
         '''
-        self.width = width
-        self.height = height
-        self.field_dict = {}
+        self.width = int(width)
+        self.height = int(height)
+        self.grid = bytearray(self.width * self.height)
+        self.counts = [0] * len(self.ITEMS)
+        self.counts[0] = len(self.grid)
+        # Indexes changed since the last pop_dirty(), None if not recorded
+        self.dirty = None
+
+    def index(self, row, column):
+        '''Get index of position in the grid.
+        @param row: row
+        @param column: column
+        @return int, index or None if (row, column) out of field
+        '''
+        if row < 0 or row >= self.height or column < 0 or\
+            column >= self.width:
+            return None
+        return row * self.width + column
+
+    def set_code(self, index, code):
+        '''Set item code on index and update counts.
+        @param index: index in the grid
+        @param code: item code
+        '''
+        if self.dirty is not None and self.grid[index] != code:
+            self.dirty.add(index)
+        self.counts[self.grid[index]] -= 1
+        self.counts[code] += 1
+        self.grid[index] = code
+
+    def track(self):
+        '''Start recording changed positions.
+        '''
+        self.dirty = set()
+
+    def pop_dirty(self):
+        '''Get positions changed since the last call and forget them.
+        @return list of ((row, column), item), item is None if removed
+        '''
+        if not self.dirty:
+            return []
+        dirty = self.dirty
+        self.dirty = set()
+        return [(divmod(index, self.width), self.ITEMS[self.grid[index]])
+                for index in sorted(dirty)]
 
     def add_item(self, row, column, item):
-        '''Add item to the dict.
+        '''Add item to the field.
         @param row: row
         @param column: column
         @param item: item
-        @return False if (row, column) out of field, else True
+        @return False if (row, column) out of field or unknown item, else True
         '''
-        if row < 0 or row > self.height or column < 0 or column > self.width:
+        index = self.index(row, column)
+        if index is None or item not in self.CODES:
             return False
 
-        self.field_dict[(row, column)] = item
+        self.set_code(index, self.CODES[item])
         return True
 
     def remove_item(self, row, column):
-        '''Remove item from the dict.
+        '''Remove item from the field.
         @param row: row
         @param column: column
         @return False if (row, column) not in field, else True
         '''
-        if row < 0 or row > self.height or column < 0 or column > self.width:
-            return False
-
-        if (row, column) not in self.field_dict:
+        index = self.index(row, column)
+        if index is None or self.grid[index] == 0:
             return False
 
-        del self.field_dict[(row, column)]
+        self.set_code(index, 0)
         return True
 
     def change_item(self, row, column, old, new):
@@ -213,14 +465,13 @@ class Field(object):
         @param old: old item
         @param new: new item
         '''
-        if row < 0 or row > self.height or column < 0 or column > self.width:
+        index = self.index(row, column)
+        if index is None or self.grid[index] == 0:
             return False
-        if (row, column) not in self.field_dict:
-            return False
-        if self.field_dict[(row, column)] != old:
+        if self.ITEMS[self.grid[index]] != old or new not in self.CODES:
             return False
 
-        self.field_dict[(row, column)] = new
+        self.set_code(index, self.CODES[new])
         return True
 
     def get_item(self, row, column):
@@ -229,24 +480,155 @@ class Field(object):
         @param column: column
         @return String, item
         '''
-        if row < 0 or row > self.height or column < 0 or column > self.width:
+        index = self.index(row, column)
+        if index is None:
             return None
 
-        if (row, column) not in self.field_dict:
-            return None
+        return self.ITEMS[self.grid[index]]
 
-        return self.field_dict[(row, column)]
+    def count_items(self, item):
+        '''Count items of given type in constant time.
+        @param item: item
+        @return int, number of items
+        '''
+        if item not in self.CODES:
+            return 0
+        return self.counts[self.CODES[item]]
+
+    def items(self, item=None):
+        '''Iterate over positions of items.
+        @param item: item, all items if None
+        @return generator of ((row, column), item)
+        '''
+        if item is None:
+            codes = range(1, len(self.ITEMS))
+        elif item in self.CODES:
+            codes = [self.CODES[item]]
+        else:
+            codes = []
+
+        for code in codes:
+            char = chr(code)
+            count = self.counts[code]
+            index = -1
+            while count > 0:
+                index = self.grid.find(char, index + 1)
+                count -= 1
+                yield divmod(index, self.width), self.ITEMS[code]
 
     def get_all_items(self, item=None):
         '''Gets all positions of item.
         @param item: item
         @return list, positions
         '''
-        result = []
-        for key, value in self.field_dict.items():
-            if item is None or value == item:
-                result.append(
-                    FIELD_SEP.join([str(key[0]), str(key[1]), value])
-                )
-
-        return result
+        return [FIELD_SEP.join([str(key[0]), str(key[1]), value])
+                for key, value in self.items(item)]
+
+    def dump(self):
+        '''Dump items of the field into compact string, the shortest of
+        compressed map of item codes, compressed bitmap of fields with one
+        type of items, and run-length encoding of fields with few items.
+        @return String, dump
+        '''
+        dump = 'map:' + base64.b64encode(zlib.compress(str(self.grid)))
+        codes = [code for code in range(1, len(self.ITEMS))
+                 if self.counts[code]]
+        if len(codes) == 1:
+            bits = self.dump_bits(codes[0])
+            if len(bits) < len(dump):
+                dump = bits
+        if 2 * (len(self.grid) - self.counts[0]) >= len(dump):
+            return dump
+        runs = []
+        for match in re.finditer(r'(.)\1*', str(self.grid), re.DOTALL):
+            length = match.end() - match.start()
+            code = ord(match.group(1))
+            if length == 1:
+                runs.append(str(code))
+            else:
+                runs.append('%d*%d' % (length, code))
+        rle = 'rle:' + ','.join(runs)
+        return rle if len(rle) < len(dump) else dump
+
+    def dump_bits(self, code):
+        '''Dump field with one type of items into compressed bitmap.
+        @param code: item code of the items
+        @return String, dump
+        '''
+        table = ''.join('1' if i == code else '0' for i in range(256))
+        bits = str(self.grid).translate(table)
+        bits += '0' * (-len(bits) % 8)
+        packed = binascii.unhexlify('%0*x' % (len(bits) // 4, int(bits, 2)))
+        return 'bit:%d:%s' % (code, base64.b64encode(zlib.compress(packed)))
+
+    def export(self):
+        '''Get items of the field as message parts, one dump part for fields
+        with many items.
+        @return list of Strings, parts
+        '''
+        if len(self.grid) - self.counts[0] <= MAX_ITEM_PARTS:
+            return self.get_all_items()
+        return [FIELD_SEP.join((FIELD_DUMP, self.dump()))]
+
+    def add_parts(self, parts):
+        '''Add items from message parts made by export().
+        @param parts: list of Strings, parts
+        @raise ValueError: if part is not valid item or dump
+        '''
+        for part in parts:
+            if is_field_dump(part):
+                other = self.load(self.width, self.height,
+                                  part[len(FIELD_DUMP) + 1:])
+                for position, item in other.items():
+                    self.add_item(position[0], position[1], item)
+            else:
+                row, column, item = part.split(FIELD_SEP)
+                self.add_item(int(row), int(column), item)
+
+    @classmethod
+    def load(cls, width, height, dump):
+        '''Create field from dump.
+        @param width: width
+        @param height: height
+        @param dump: String made by dump()
+        @return Field
+        @raise ValueError: if dump does not fit the dimensions
+        '''
+        field = cls(width, height)
+        size = len(field.grid)
+        try:
+            if dump.startswith('map:'):
+                grid = bytearray(inflate(base64.b64decode(dump[4:]), size))
+            elif dump.startswith('bit:'):
+                code, packed = dump[4:].split(':', 1)
+                packed = inflate(base64.b64decode(packed), (size + 7) // 8)
+                bits = bin(int(binascii.hexlify(packed) or '0', 16))[2:]
+                bits = bits.zfill(len(packed) * 8)[:len(field.grid)]
+                table = '\0' + chr(int(code)) + '\0' * 254
+                grid = bytearray(bits.replace('0', '\0').replace('1', '\1')
+                                 .translate(table))
+            elif dump.startswith('rle:'):
+                runs = []
+                total = 0
+                for run in dump[4:].split(','):
+                    length, _, code = run.rpartition('*')
+                    length = int(length or 1)
+                    total += length
+                    # Runs are checked before the grid is allocated
+                    if length < 0 or total > size:
+                        raise ValueError('Field dump of wrong size')
+                    runs.append(chr(int(code)) * length)
+                grid = bytearray(''.join(runs))
+            else:
+                raise ValueError('Unknown field dump')
+        except (TypeError, OverflowError) as e:
+            raise ValueError('Invalid field dump: %s' % e)
+        if len(grid) != len(field.grid):
+            raise ValueError('Field dump of wrong size')
+        if grid.translate(None, bytes(bytearray(range(len(cls.ITEMS))))):
+            raise ValueError('Unknown item in field dump')
+        field.grid = grid
+        field.counts = [0] * len(cls.ITEMS)
+        for code in range(len(cls.ITEMS)):
+            field.counts[code] = grid.count(chr(code))
+        return field
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+"""
+Directory of running battleship servers.
+
+Servers register with a lease and renew it before it expires. The lease
+grows with the number of registered servers, so renewals arrive at a bounded
+rate however many servers there are. Clients ask for the list of servers once
+and then follow versioned events about servers that joined, left or whose
+lease expired.
+"""
+# Imports----------------------------------------------------------------------
+from argparse import ArgumentParser
+import threading
+import time
+import logging
+# Custom imports --------------------------------------------------------------
+import serverlib
+import common
+from common import send_message
+from transport import PikaTransport
+# Setup Python logging --------------------------------------------------------
+FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+# Constants -------------------------------------------------------------------
+# Shortest lease in seconds
+MIN_LEASE = 6.0
+# Highest rate of lease renewals per second, servers renew in the second half
+# of their lease
+MAX_RENEWAL_RATE = 50.0
+# Seconds between checks of expired leases
+EXPIRY_PERIOD = 1.0
+# Classes ---------------------------------------------------------------------
+class Directory(object):
+    '''Leases of servers and events about their changes.
+    '''
+    def __init__(self, channel, transport):
+        '''Set leases, communication channel, and consuming.
+        @param channel: pika connection channel
+        @param transport: transport opening channel of the expiry ticker
+        '''
+        # (server name, node) -> time of expiry
+        self.leases = {}
+        # Server name -> nodes holding lease
+        self.nodes = {}
+        # Version of the list of servers, raised by every event
+        self.version = 0
+
+        # Communication
+        self.channel = channel
+        self.directory_queue = common.make_key_directory()
+        channel.queue_declare(queue=self.directory_queue, durable=True)
+        self.channel.queue_bind(exchange='direct_logs',
+                                queue=self.directory_queue,
+                                routing_key=common.make_key_directory())
+        self.channel.basic_consume(common.decompressing(self.reply_request),
+                                   queue=self.directory_queue,
+                                   no_ack=True)
+
+        # Control queue for checking expired leases
+        self.control_queue =\
+            channel.queue_declare(exclusive=True).method.queue
+        self.channel.queue_bind(exchange='direct_logs',
+                                queue=self.control_queue,
+                                routing_key=self.control_queue)
+        self.channel.basic_consume(self.on_tick,
+                                   queue=self.control_queue,
+                                   no_ack=True)
+        self.ticker = threading.Thread(target=self.run_ticker,
+                                       args=(transport.channel(),),
+                                       name='Directory ticker')
+        self.ticker.setDaemon(True)
+        self.ticker.start()
+
+        # Request type -> handler
+        self.handlers = {
+            common.REQ_REGISTER: self.on_register,
+            common.REQ_UNREGISTER: self.on_unregister,
+            common.REQ_LIST_SERVERS: self.on_list_servers,
+        }
+
+    def run_ticker(self, channel):
+        '''Ask for check of expired leases periodically.
+        @param channel: channel of the ticker thread
+        '''
+        while True:
+            time.sleep(EXPIRY_PERIOD)
+            channel.basic_publish(exchange='direct_logs',
+                                  routing_key=self.control_queue, body='')
+
+    def lease(self):
+        '''Get length of lease for current number of servers.
+        @return float, seconds
+        '''
+        return max(MIN_LEASE, 2 * len(self.leases) / MAX_RENEWAL_RATE)
+
+    def publish(self, message):
+        '''Raise version and send event to clients.
+        @param message: String, event
+        '''
+        self.version += 1
+        send_message(self.channel, message,
+                     common.make_key_directory_events(), version=self.version)
+
+    def remove_lease(self, server_name, node, make_event):
+        '''Remove lease, send event if no node serves the server name.
+        @param server_name: name of server
+        @param node: name of node
+        @param make_event: function making event from server name
+        '''
+        if self.leases.pop((server_name, node), None) is None:
+            return
+        nodes = self.nodes[server_name]
+        nodes.discard(node)
+        if not nodes:
+            del self.nodes[server_name]
+            self.publish(make_event(server_name))
+
+    def on_register(self, items):
+        '''Register server or renew its lease.
+        @param items: server name and node
+        @return String, response
+        '''
+        server_name, node = items
+        lease = self.lease()
+        self.leases[(server_name, node)] = time.time() + lease
+        if server_name not in self.nodes:
+            self.nodes[server_name] = set()
+            LOG.info('Server %s joined.', server_name)
+            self.publish(serverlib.make_e_server_join(server_name))
+        self.nodes[server_name].add(node)
+        return serverlib.make_rsp_registered(lease)
+
+    def on_unregister(self, items):
+        '''Remove lease of stopped server.
+        @param items: server name and node
+        @return String, response
+        '''
+        server_name, node = items
+        self.remove_lease(server_name, node, serverlib.make_e_server_leave)
+        return serverlib.make_rsp_ok()
+
+    def on_list_servers(self, items):
+        '''List servers request.
+        @param items: empty list
+        @return String, response
+        '''
+        return serverlib.make_rsp_list_servers(self.version,
+                                               sorted(self.nodes))
+
+    def on_tick(self, ch, method, properties, body):
+        '''Remove expired leases.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
+        now = time.time()
+        expired = [key for key, expiry in self.leases.items() if expiry < now]
+        for server_name, node in expired:
+            LOG.info('Lease of server %s expired.', server_name)
+            self.remove_lease(server_name, node,
+                              serverlib.make_e_server_expire)
+
+    def reply_request(self, ch, method, properties, body):
+        '''Reply to request of server or client.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
+        LOG.debug('Received message: %s', body)
+        msg_parts = body.split(common.SEP)
+        try:
+            response = self.handlers[msg_parts[0]](msg_parts[1:])
+        except (KeyError, ValueError):
+            response = serverlib.make_rsp_invalid_request()
+
+        # Sending response, requests of servers may expect none
+        if properties.reply_to is not None:
+            serverlib.send_response(ch, response, properties, {})
+
+# Main function ---------------------------------------------------------------
+if __name__ == '__main__':
+    # Parsing arguments
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-H', '--host',
+        help='Address of the RabbitMQ server, defaults to %s' %
+        common.DEFAULT_SERVER_INET_ADDR,
+        default=common.DEFAULT_SERVER_INET_ADDR
+    )
+    parser.add_argument(
+        '-p', '--port',
+        help='Port of the RabbitMQ server, defaults to %d' %
+        common.DEFAULT_SERVER_PORT,
+        default=common.DEFAULT_SERVER_PORT
+    )
+    args = parser.parse_args()
+    transport = PikaTransport(args.host, args.port)
+
+    channel = transport.channel()
+    directory = Directory(channel, transport)
+    try:
+        while True:
+            channel.start_consuming()
+    except KeyboardInterrupt as e:
+        LOG.info('Terminating directory ...')
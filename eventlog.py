@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only log of server state changes, used to recover the server after a
+crash.
+
+Records are JSON lists framed by their length and checksum. They are buffered
+and written to the current segment file in batches by a flusher thread.
+When the segment grows over its size limit, a new segment is started with a
+checkpoint - compact snapshots of the whole server state - and older segments
+are deleted, or archived to keep whole history of games for replay. Recovery
+therefore reads only the last checkpoint and the records written after it.
+Segments are read back through mmap, reading stops at the first torn record.
+"""
+# Imports ---------------------------------------------------------------------
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+import logging
+# Logging ---------------------------------------------------------------------
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+# Constants -------------------------------------------------------------------
+# Segment files are rotated when records after their checkpoint grow over
+# this size in bytes
+SEGMENT_SIZE = 16 * 1024 * 1024
+# Buffered records are written every BATCH_INTERVAL seconds, or sooner when
+# they reach BATCH_SIZE bytes
+BATCH_INTERVAL = 0.05
+BATCH_SIZE = 64 * 1024
+# Record header: length of payload, crc32 of payload
+HEADER = struct.Struct('>II')
+SEGMENT_PREFIX = 'segment-'
+ARCHIVE_PREFIX = 'archive-'
+SEGMENT_SUFFIX = '.log'
+# Record kinds, the kind is followed by its items
+# Snapshot of connected clients: names, client queue -> codec
+LOG_CLIENTS = 'clients'
+# Client connected: name, client queue, codec
+LOG_CONNECT = 'connect'
+# Client disconnected: name, client queue
+LOG_DISCONNECT = 'disconnect'
+# Game created: name, owner, width, height
+LOG_GAME = 'game'
+# Game ended: name
+LOG_END = 'end'
+# Snapshot of game: name, width, height, dict of game state
+LOG_SNAPSHOT = 'snapshot'
+# Change of game state: name, version, kind of mutation, its arguments
+LOG_MUTATION = 'mutation'
+# Functions -------------------------------------------------------------------
+def to_str(value):
+    '''Convert unicode strings decoded from JSON back to str.
+    @param value: decoded JSON value
+    @return value with str instead of unicode
+    '''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [to_str(item) for item in value]
+    if isinstance(value, dict):
+        return dict((to_str(key), to_str(item))
+                    for key, item in value.items())
+    return value
+
+def encode_record(record):
+    '''Frame record.
+    @param record: list of JSON values
+    @return str
+    '''
+    payload = json.dumps(record, separators=(',', ':'))
+    return HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) +\
+        payload
+
+def read_segment(path):
+    '''Read records of segment file through mmap.
+    @param path: path of segment
+    @return generator of records, reading stops at the first torn record
+    '''
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = 0
+            while position + HEADER.size <= size:
+                length, checksum = HEADER.unpack_from(view, position)
+                start = position + HEADER.size
+                if start + length > size:
+                    break
+                payload = view[start:start + length]
+                if zlib.crc32(payload) & 0xffffffff != checksum:
+                    break
+                yield to_str(json.loads(payload))
+                position = start + length
+            if position != size:
+                LOG.warn('Torn record at %d in %s ignored.', position, path)
+        finally:
+            view.close()
+
+def segment_numbers(directory, prefix=SEGMENT_PREFIX):
+    '''Get numbers of segment files in directory.
+    @param directory: log directory
+    @param prefix: prefix of segment files
+    @return sorted list of int
+    '''
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith(SEGMENT_SUFFIX):
+            try:
+                numbers.append(int(name[len(prefix):-len(SEGMENT_SUFFIX)]))
+            except ValueError:
+                pass
+    return sorted(numbers)
+
+def segment_path(directory, number, prefix=SEGMENT_PREFIX):
+    '''Get path of segment file.
+    @param directory: log directory
+    @param number: number of segment
+    @param prefix: prefix of segment files
+    @return String, path
+    '''
+    return os.path.join(directory, '%s%08d%s' % (prefix, number,
+                                                 SEGMENT_SUFFIX))
+
+def read_history(directory):
+    '''Read records of archived and current segments.
+    @param directory: log directory
+    @return generator of records in order of appending
+    '''
+    paths = [(number, segment_path(directory, number, ARCHIVE_PREFIX))
+             for number in segment_numbers(directory, ARCHIVE_PREFIX)]
+    paths += [(number, segment_path(directory, number))
+              for number in segment_numbers(directory)]
+    for number, path in sorted(paths):
+        for record in read_segment(path):
+            yield record
+# Classes ---------------------------------------------------------------------
+class LogFailed(Exception):
+    '''Flusher thread stopped on error, records are not written any more.
+    '''
+
+class EventLog(object):
+    '''Segment-rotated append-only log in a directory.
+    '''
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, archive=False):
+        '''Open log directory, nothing is written until the log is started.
+        @param directory: directory of segment files, created if missing
+        @param segment_size: size of records after checkpoint in bytes before
+                             rotation
+        @param archive: whether to archive rotated segments instead of
+                        deleting them
+        '''
+        self.directory = directory
+        self.segment_size = segment_size
+        self.archive = archive
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Buffer of framed records, guarded by lock
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        # Writing into the current segment
+        self.write_lock = threading.Lock()
+        self.segment = None
+        numbers = segment_numbers(directory) +\
+            segment_numbers(directory, ARCHIVE_PREFIX)
+        self.number = max(numbers or [0])
+        # Size of checkpoint at the start of the current segment
+        self.checkpoint_size = 0
+
+        # Function appending records of checkpoint
+        self.checkpoint = None
+        self.running = False
+        self.flusher = None
+        # Exception that stopped the flusher thread, appending then fails
+        self.failure = None
+
+    def read(self):
+        '''Read records of all segments, to be used before the log is started.
+        @return generator of records in order of appending
+        '''
+        for number in segment_numbers(self.directory):
+            path = segment_path(self.directory, number)
+            for record in read_segment(path):
+                yield record
+
+    def start(self, checkpoint):
+        '''Start new segment by checkpoint and start writing appended records.
+        @param checkpoint: function appending records of current state by
+                           append(), called on every rotation
+        '''
+        self.checkpoint = checkpoint
+        self.rotate()
+        self.running = True
+        self.flusher = threading.Thread(target=self.run_flusher,
+                                        name='Event log flusher')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def stop(self):
+        '''Stop flusher thread, write buffered records and close segment.
+        '''
+        self.running = False
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+        with self.write_lock:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+    def append(self, record):
+        '''Append record, it is written with the next batch.
+        @param record: list of JSON values, the first one is kind of record
+        @raise LogFailed: if the flusher thread stopped on error
+        '''
+        if self.failure is not None:
+            raise LogFailed('Event log failed: %s' % self.failure)
+        frame = encode_record(record)
+        with self.lock:
+            self.buffer.append(frame)
+            self.buffered += len(frame)
+
+    def flush(self):
+        '''Write buffered records to the current segment.
+        '''
+        with self.write_lock:
+            with self.lock:
+                frames = self.buffer
+                self.buffer = []
+                self.buffered = 0
+            if not frames or self.segment is None:
+                return
+            self.segment.write(''.join(frames))
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+
+    def rotate(self):
+        '''Start new segment by checkpoint and delete or archive older
+        segments.
+        '''
+        # Records appended so far belong to old segments
+        self.flush()
+        with self.write_lock:
+            if self.segment is not None:
+                self.segment.close()
+            self.number += 1
+            self.segment = open(segment_path(self.directory, self.number),
+                                'ab')
+        LOG.debug('Starting log segment %d.', self.number)
+
+        # Older segments are not needed once the checkpoint is written
+        self.checkpoint()
+        self.flush()
+        self.checkpoint_size = self.segment.tell()
+        for number in segment_numbers(self.directory):
+            if number >= self.number:
+                continue
+            path = segment_path(self.directory, number)
+            if self.archive:
+                os.rename(path, segment_path(self.directory, number,
+                                             ARCHIVE_PREFIX))
+            else:
+                os.remove(path)
+
+    def run_flusher(self):
+        '''Write batches of records until the log is stopped.
+        '''
+        while self.running:
+            waited = 0
+            while self.running and waited < BATCH_INTERVAL and\
+                self.buffered < BATCH_SIZE:
+                time.sleep(BATCH_INTERVAL / 5)
+                waited += BATCH_INTERVAL / 5
+            try:
+                self.flush()
+                if self.segment.tell() - self.checkpoint_size >=\
+                    self.segment_size:
+                    self.rotate()
+            except (IOError, OSError):
+                LOG.exception('Writing event log failed.')
+            except Exception as e:
+                # Checkpoint may be written only partly, so no more records
+                # are written and appending fails
+                LOG.exception('Event log failed, records are not written.')
+                self.failure = e
+                return
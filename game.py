@@ -5,25 +5,131 @@ Created on Sat Dec 10 12:54:37 2016
 @author: pavla
 """
 # Imports----------------------------------------------------------------------
+import array
+import collections
 import random
 import threading
 import logging
-import pika
 # Custom imports --------------------------------------------------------------
 import serverlib
 import common
+import eventlog
 from common import send_message
 # Logging ---------------------------------------------------------------------
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
+# Constants -------------------------------------------------------------------
+# Number of changes kept in the game journal
+JOURNAL_LENGTH = 1000
+# Maximal number of remembered responses to requests sent again by clients
+RESPONSE_CACHE_LENGTH = 1000
+# Number of deltas sent to spectators between keyframes
+KEYFRAME_INTERVAL = 100
 # Classes ---------------------------------------------------------------------
+class Fleet(object):
+    '''Index of player's ships. Every connected ship is labeled once, when the
+    ships are placed, and keeps the number of its parts that were not hit.
+    Labels are kept in a flat array indexed like the field grid, so the index
+    stays compact on large fields; parts of a ship are found again when it
+    sinks.
+    '''
+    def __init__(self, width, height, positions):
+        '''Label connected ships.
+        @param width: width of field
+        @param height: height of field
+        @param positions: list of tuples (row, column)
+        '''
+        self.width = width
+        self.height = height
+        # Index in grid -> ship id, -1 for no ship; ship id -> unhit parts
+        self.ship_ids = array.array('i', [-1]) * (width * height)
+        self.remaining = array.array('i')
+
+        unlabeled = -2
+        indexes = [row * width + column for row, column in positions]
+        for index in indexes:
+            self.ship_ids[index] = unlabeled
+        for index in indexes:
+            if self.ship_ids[index] != unlabeled:
+                continue
+            ship_id = len(self.remaining)
+            self.ship_ids[index] = ship_id
+            self.remaining.append(
+                len(self.flood(index, unlabeled, ship_id)))
+
+        # Number of ships that did not sink
+        self.afloat = len(self.remaining)
+
+    def flood(self, index, label, new_label):
+        '''Relabel connected cells.
+        @param index: index of cell already relabeled
+        @param label: label of cells to relabel
+        @param new_label: new label
+        @return list of indexes of relabeled cells
+        '''
+        width = self.width
+        ship_ids = self.ship_ids
+        parts = []
+        stack = [index]
+        while stack:
+            index = stack.pop()
+            parts.append(index)
+            column = index % width
+            neighbours = [index - width, index + width]
+            if column > 0:
+                neighbours.append(index - 1)
+            if column < width - 1:
+                neighbours.append(index + 1)
+            for neighbour in neighbours:
+                if 0 <= neighbour < len(ship_ids) and\
+                    ship_ids[neighbour] == label:
+                    ship_ids[neighbour] = new_label
+                    stack.append(neighbour)
+        return parts
+
+    def hit(self, row, column):
+        '''Register hit of a ship part.
+        @param row: row
+        @param column: column
+        @return list of positions of the ship if it sunk, else None
+        '''
+        index = row * self.width + column
+        ship_id = self.ship_ids[index]
+        if ship_id < 0:
+            return None
+        self.remaining[ship_id] -= 1
+        if self.remaining[ship_id] != 0:
+            return None
+        self.afloat -= 1
+        # Parts are collected by relabeling the ship to the same id
+        found = self.width * self.height
+        self.ship_ids[index] = found
+        parts = self.flood(index, ship_id, found)
+        for part in parts:
+            self.ship_ids[part] = ship_id
+        return [divmod(part, self.width) for part in parts]
+
 class Game(threading.Thread):
     '''Game session.
     '''
-    def __init__(self, game_list, server_args, name, owner, width, height):
+    def __init__(self, game_list, server_args, name, owner, width, height,
+                 channel, game_queue):
+        '''Set game attributes, players and communication.
+        @param game_list: GameHost running the game
+        @param server_args: arguments of server
+        @param name: name of game
+        @param owner: owner of game
+        @param width: width of field of game
+        @param height: height of field of game
+        @param channel: channel owning the game queue
+        @param game_queue: exclusive queue of game requests, owning it makes
+                           the game unique among servers of the same name
+        '''
         super(Game, self).__init__(name='Game thread: %s' % name)
 
         self.game_list = game_list
+        self.channel = channel
+        self.game_queue = game_queue
 
         # Game attributes
         self.name = name
@@ -34,6 +140,8 @@ class Game(threading.Thread):
 
         # Players
         self.client_queues = {}
+        # Codecs of players and spectators, client queue -> codec
+        self.codecs = {}
 
         self.players = set()
         self.spectators = set()
@@ -42,30 +150,89 @@ class Game(threading.Thread):
         self.players.add(self.owner)
 
         self.fields = {}
+        self.fleets = {}
         self.player_hits = {}
 
         self.on_turn = None
         self.player_order = []
 
+        # Version of game state and journal of the latest changes: tuples
+        # (version, players that may see the change or None for all, event)
+        self.version = 0
+        self.journal = collections.deque(maxlen=JOURNAL_LENGTH)
+        self.journal_lock = threading.Lock()
+
+        # Responses to requests which may be sent again by clients
+        self.responses = serverlib.ResponseCache(RESPONSE_CACHE_LENGTH)
+
         # Communication
         self.server_name = server_args.name
-        self.host = server_args.host
-        self.port = server_args.port
+        # Spectators bind their own queues to the key, so the broker copies
+        # the stream to each of them. The key is given only to spectators.
+        self.key_spectators = common.make_key_game_spectators()
+
+        # Latest keyframe of spectator stream, tuple (version, event) or None
+        # if fields changed other than by deltas, and deltas sent after it
+        self.keyframe = None
+        self.deltas = []
 
         # To synchronize creation of the game communication, and sending enter
         # game event to client
         self.ready_event = threading.Event()
 
+        # Requests are processed under the lock, so the event log takes
+        # snapshots consistent with the logged mutations
+        self.lock = threading.RLock()
+        # Mutations of the request being processed, logged with the version
+        # reached by the request
+        self.mutations = []
+
+        # Kind of mutation -> function applying it, used both when processing
+        # requests and when replaying the event log
+        self.appliers = {
+            'join': self.apply_join,
+            'spectate': self.apply_spectate,
+            'disconnect': self.apply_disconnect,
+            'left': self.apply_left,
+            'ready': self.apply_ready,
+            'start': self.apply_start,
+            'shot': self.apply_shot,
+            'restart': self.apply_restart,
+        }
+
+        # Request type -> handler
+        self.handlers = {
+            common.REQ_DISCONNECT: self.on_disconnect,
+            common.REQ_LEAVE_GAME: self.on_leave_game,
+            common.REQ_GET_DIMENSIONS: self.on_get_dimensions,
+            common.REQ_GET_PLAYERS: self.on_get_players,
+            common.REQ_GET_PLAYERS_READY: self.on_get_players_ready,
+            common.REQ_GET_OWNER: self.on_get_owner,
+            common.REQ_GET_TURN: self.on_get_turn,
+            common.REQ_GET_FIELD: self.on_get_field,
+            common.REQ_GET_HITS: self.on_get_hits,
+            common.REQ_GET_GAME_STATE: self.on_get_game_state,
+            common.REQ_GET_CHANGES: self.on_get_changes,
+            common.REQ_GET_ALL_FIELDS: self.on_get_all_fields,
+            common.REQ_GET_SPECTATOR: self.on_get_spectator,
+            common.REQ_GET_SPECTATOR_QUEUE: self.on_get_spectator_queue,
+            common.REQ_GET_KEYFRAME: self.on_get_keyframe,
+            common.REQ_SET_READY: self.on_set_ready,
+            common.REQ_KICK_OUT: self.on_kick_out,
+            common.REQ_START_GAME: self.on_start_game,
+            common.REQ_SHOOT: self.on_shoot,
+            common.REQ_RESTART_SESSION: self.on_restart_session,
+        }
+
+        # Request type -> handler of requests forwarded by game list
+        self.forwarded_handlers = {
+            common.REQ_JOIN_GAME: self.on_join_game,
+            common.REQ_SPECTATE_GAME: self.on_spectate_game,
+        }
+
     def run(self):
         '''Method for running the thread.
         '''
-        # Connection
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=self.host, port=self.port)
-        )
-        self.channel = self.connection.channel()
-        self.channel.exchange_declare(exchange='direct_logs', type='direct')
-
         # Routing keys
         self.key_game = common.make_key_game(self.server_name, self.name)
         self.key_events = common.make_key_game_events(self.server_name,
@@ -73,22 +240,13 @@ class Game(threading.Thread):
         self.key_adverts = common.make_key_game_advert(self.server_name)
 
         # Game queue
-        self.game_queue =\
-            self.channel.queue_declare(exclusive=True).method.queue
         self.channel.queue_bind(exchange='direct_logs',
                                 queue=self.game_queue,
                                 routing_key=self.key_game)
-        self.channel.basic_consume(self.reply_request,
+        self.channel.basic_consume(common.decompressing(self.reply_request),
                                    queue=self.game_queue,
                                    no_ack=True)
 
-        # Spectator queue
-        self.spectator_queue =\
-            self.channel.queue_declare(exclusive=True).method.queue
-        self.channel.queue_bind(exchange='direct_logs',
-                                queue=self.spectator_queue,
-                                routing_key=self.spectator_queue)
-
         # Control queue for quiting consuming
         self.control_queue =\
             self.channel.queue_declare(exclusive=True).method.queue
@@ -101,6 +259,9 @@ class Game(threading.Thread):
 
         self.ready_event.set()
         self.channel.start_consuming()
+
+        # Free the name of game before announcing its end
+        self.channel.queue_delete(queue=self.game_queue)
         self.game_list.remove_game(self.name)
 
     def quit_game(self, ch, method, properties, body):
@@ -112,25 +273,116 @@ class Game(threading.Thread):
         '''
         self.channel.stop_consuming()
 
+    def record(self, message, audience=None):
+        '''Record change of game state into the journal.
+        @param message: event describing the change
+        @param audience: players that may see the change, None for everyone
+        @return int, version of game state after the change
+        '''
+        with self.journal_lock:
+            self.version += 1
+            self.journal.append((self.version, audience, message))
+            return self.version
+
+    def send_event(self, message):
+        '''Record event into the journal and send it to all game events.
+        @param message: event
+        @return int, version of game state after the event
+        '''
+        version = self.record(message)
+        send_message(self.channel, message, self.key_events, version=version)
+        return version
+
+    def send_delta(self, message, version, stream=True):
+        '''Send change of fields to spectators, keyframe is sent after every
+        KEYFRAME_INTERVAL deltas.
+        @param message: event
+        @param version: version of game state after the change
+        @param stream: False if the event was sent to all game events already
+        '''
+        if stream:
+            send_message(self.channel, message, self.key_spectators,
+                         version=version)
+        self.deltas.append(message)
+        if len(self.deltas) >= KEYFRAME_INTERVAL:
+            version, message = self.make_keyframe()
+            send_message(self.channel, message, self.key_spectators,
+                         version=version)
+
+    def make_keyframe(self):
+        '''Make keyframe of fields of all players, deltas sent before it are
+        forgotten.
+        @return tuple (version, event)
+        '''
+        all_fields = []
+        for player in self.players:
+            if player in self.fields:
+                all_fields += [player] + self.fields[player].export()
+        self.keyframe = (self.version, serverlib.make_e_keyframe(all_fields))
+        self.deltas = []
+        return self.keyframe
+
+    def get_changes(self, player, version):
+        '''Get events visible to player that happened after version.
+        @param player: name of player
+        @param version: version known to player
+        @return list of events, or None if the journal does not reach back to
+                the version
+        '''
+        with self.journal_lock:
+            if version > self.version:
+                return None
+            if self.journal and self.journal[0][0] > version + 1:
+                return None
+            if not self.journal and version != self.version:
+                return None
+            spectator = player in self.spectators
+            return [message for change_version, audience, message
+                    in self.journal if change_version > version and
+                    (audience is None or spectator or player in audience)]
+
     def wait_for_ready(self):
         '''To synchronize creation of the game communication, and sending enter
         game event to client
         '''
         self.ready_event.wait()
 
+    def parse_ships(self, ships):
+        '''Get positions of ships, sent as positions or as one field dump.
+        @param ships: list of strings encoding positions, or field dump
+        @return list of tuples (row, column)
+        @raise ValueError: if ships are not positions or field dump of ships
+        '''
+        if len(ships) == 1 and common.is_field_dump(ships[0]):
+            field = common.Field.load(self.width, self.height,
+                                      ships[0][len(common.FIELD_DUMP) + 1:])
+            if field.count_items(common.FIELD_SHIP) !=\
+                len(field.grid) - field.counts[0]:
+                raise ValueError('Field dump of ships has other items')
+            return [position for position, _
+                    in field.items(common.FIELD_SHIP)]
+
+        positions = []
+        for ship in ships:
+            ship_position = ship.split(common.FIELD_SEP)
+            positions.append((int(ship_position[0]), int(ship_position[1])))
+        return positions
+
     def check_ships(self, ships):
         '''Check if list of ships is correct.
         @param ships: list of ships
         @return True if list ok, else False
+        @raise ValueError: if ships cannot be parsed
         '''
-        if len(ships) != self.ship_number:
+        if len(ships) != 1 and len(ships) != self.ship_number:
+            return False
+        positions = self.parse_ships(ships)
+        if len(positions) != self.ship_number:
             return False
 
-        for ship in ships:
-            ship_position = ship.split(common.FIELD_SEP)
-            if int(ship_position[0]) < 0 or int(ship_position[1]) < 0 or\
-                int(ship_position[0]) > self.height or\
-                int(ship_position[1]) > self.width:
+        for row, column in positions:
+            if row < 0 or column < 0 or row >= int(self.height) or\
+                column >= int(self.width):
                 return False
 
         return True
@@ -138,14 +390,26 @@ class Game(threading.Thread):
     def add_ships(self, player, ships):
         '''Add ships to player field.
         @param player: player name
-        @param ships: list of tuples (row, column)
+        @param ships: list of strings encoding positions, or field dump
         '''
         self.fields[player] = common.Field(self.width, self.height)
-        for ship in ships:
-            ship_position = ship.split(common.FIELD_SEP)
-            self.fields[player].add_item(int(ship_position[0]),
-                                         int(ship_position[1]),
-                                         common.FIELD_SHIP)
+        positions = self.parse_ships(ships)
+        for row, column in positions:
+            self.fields[player].add_item(row, column, common.FIELD_SHIP)
+        self.fleets[player] = Fleet(self.width, self.height, positions)
+
+    def compact_ships(self, ships):
+        '''Get ships in the form kept in the event log, many ships are kept
+        as one field dump.
+        @param ships: list of strings encoding positions, or field dump
+        @return list of strings encoding positions, or field dump
+        '''
+        if len(ships) <= common.MAX_ITEM_PARTS:
+            return ships
+        field = common.Field(self.width, self.height)
+        for row, column in self.parse_ships(ships):
+            field.add_item(row, column, common.FIELD_SHIP)
+        return field.export()
 
     def get_field(self, player):
         '''Get field information for specific player.
@@ -154,7 +418,7 @@ class Game(threading.Thread):
         result = []
         if player not in self.fields:
             return result
-        return self.fields[player].get_all_items()
+        return self.fields[player].export()
 
     def get_hits(self, player):
         '''Get hit information for specific player.
@@ -165,44 +429,6 @@ class Game(threading.Thread):
             return result
         return self.player_hits[player]
 
-    def check_sink_ship(self, field, row, column, searched, hit_ships):
-        '''Check recursively if the ship sunk.
-        @param field: Field
-        @param row: row
-        @param column: column
-        @param searched: list of searched positions
-        @hit_ships: list of positions where the ship has been hit
-        @return None if found position where the ship is still unhit, list of
-        hit_ships otherwise
-        '''
-        searched.append((row, column))
-        if field.get_item(row, column) == common.FIELD_SHIP:
-            return None
-        if field.get_item(row, column) == common.FIELD_HIT_SHIP:
-            hit_ships.append((row, column))
-            if (row-1, column) not in searched:
-                result = self.check_sink_ship(field, row-1, column,
-                                              searched, hit_ships)
-                if result is None:
-                    return None
-            if (row+1, column) not in searched:
-                result = self.check_sink_ship(field, row+1, column,
-                                              searched, hit_ships)
-                if result is None:
-                    return None
-            if (row, column-1) not in searched:
-                result = self.check_sink_ship(field, row, column-1,
-                                              searched, hit_ships)
-                if result is None:
-                    return None
-            if (row, column+1) not in searched:
-                result = self.check_sink_ship(field, row, column+1,
-                                              searched, hit_ships)
-                if result is None:
-                    return None
-
-        return hit_ships
-
     def sink_ship(self, field, hit_ships):
         '''Make ship sinked.
         @param field: Field
@@ -219,12 +445,11 @@ class Game(threading.Thread):
         return hit_ships_string
 
     def count_player_ships(self, player):
-        '''Count ships that are not hit.
+        '''Count ships that did not sink.
         @param player: name of player
         @return number of ships
         '''
-        ships = self.fields[player].get_all_items(common.FIELD_SHIP)
-        return len(ships)
+        return self.fleets[player].afloat
 
     def check_end_game(self):
         '''Check end-game condition
@@ -232,7 +457,7 @@ class Game(threading.Thread):
         '''
         number_unfinished_players = 0
         for field in self.fields.values():
-            if field.get_all_items(common.FIELD_SHIP) != []:
+            if field.count_items(common.FIELD_SHIP) != 0:
                 number_unfinished_players += 1
         return number_unfinished_players <= 1
 
@@ -240,30 +465,106 @@ class Game(threading.Thread):
         '''Actions on player leaving or disconnecting from the game
         @param player: name of player
         '''
-        # Remove player's client queue
-        try:
-            del self.client_queues[player]
-        except KeyError:
-            pass
+        # Choose new owner if the owner is leaving
+        new_owner = None
+        remaining = [name for name in self.client_queues if name != player]
+        if remaining and self.owner == player:
+            new_owner = random.choice(remaining)
+        self.mutate('disconnect', player, new_owner)
 
         # If noone is in the game
         if len(self.client_queues.keys()) == 0:
-            # Quit game
+            # Quit game, it is removed when consuming stops
             self.channel.stop_consuming()
-            self.game_list.remove_game(self.name)
 
-        # Else we might need to change the owner
-        elif self.owner == player:
-            new_owner = random.choice(self.client_queues.keys())
-            self.owner = new_owner
+        elif new_owner is not None:
             # Send event that owner changed
             msg = serverlib.make_e_new_owner(new_owner)
-            send_message(self.channel, msg, self.key_events)
+            self.send_event(msg)
 
     def player_left(self, player):
         '''Actions on player leaving from the game
         @param player: name of player
         '''
+        self.mutate('left', player)
+
+        # Send event that player left
+        msg = serverlib.make_e_player_left(player)
+        self.send_event(msg)
+
+    def next_turn(self):
+        '''Change turn to next player.
+        '''
+        next_index = self.player_order.index(self.on_turn) + 1
+        if next_index >= len(self.player_order):
+            next_index = 0
+        self.on_turn = self.player_order[next_index]
+
+    def send_turn(self):
+        '''Send on turn event.
+        '''
+        msg = serverlib.make_e_on_turn(self.on_turn)
+        self.send_event(msg)
+
+    def mutate(self, kind, *args):
+        '''Apply mutation of game state and remember it for the event log.
+        @param kind: kind of mutation
+        @param args: arguments of the mutation, JSON values
+        @return result of the mutation
+        '''
+        result = self.appliers[kind](*args)
+        # Shots are followed by deltas, spectators do not change fields, other
+        # changes need new keyframe
+        if kind not in ('shot', 'spectate'):
+            self.keyframe = None
+            self.deltas = []
+        if self.game_list.log is not None:
+            self.mutations.append([kind] + list(args))
+        return result
+
+    def log_mutations(self):
+        '''Append mutations of processed request to the event log.
+        '''
+        for mutation in self.mutations:
+            self.game_list.log.append([eventlog.LOG_MUTATION, self.name,
+                                       self.version] + mutation)
+        self.mutations = []
+
+    def apply_join(self, player, client_queue, codec_name):
+        '''Add player, or reconnect player of the game.
+        @param player: name of player
+        @param client_queue: queue of player's client
+        @param codec_name: codec of player's client
+        '''
+        self.client_queues[player] = client_queue
+        self.codecs[client_queue] = codec_name
+        self.players.add(player)
+
+    def apply_spectate(self, spectator, client_queue, codec_name):
+        '''Add spectator.
+        @param spectator: name of spectator
+        @param client_queue: queue of spectator's client
+        @param codec_name: codec of spectator's client
+        '''
+        self.spectators.add(spectator)
+        self.codecs[client_queue] = codec_name
+
+    def apply_disconnect(self, player, new_owner):
+        '''Remove client queue of player.
+        @param player: name of player
+        @param new_owner: name of new owner, or None if owner does not change
+        '''
+        try:
+            self.codecs.pop(self.client_queues.pop(player), None)
+        except KeyError:
+            pass
+        if new_owner is not None:
+            self.owner = new_owner
+
+    def apply_left(self, player):
+        '''Remove player from the game.
+        @param player: name of player
+        '''
         try:
             self.players.remove(player)
         except KeyError:
@@ -272,6 +573,10 @@ class Game(threading.Thread):
             del self.fields[player]
         except KeyError:
             pass
+        try:
+            del self.fleets[player]
+        except KeyError:
+            pass
         try:
             del self.player_hits[player]
         except KeyError:
@@ -281,220 +586,549 @@ class Game(threading.Thread):
         except KeyError:
             pass
 
-        # Send event that player left
-        msg = serverlib.make_e_player_left(player)
-        send_message(self.channel, msg, self.key_events)
+    def apply_ready(self, player, ships):
+        '''Place ships of player.
+        @param player: name of player
+        @param ships: list of strings encoding positions of ships, or field
+                      dump
+        '''
+        self.add_ships(player, ships)
 
-    def change_turn(self):
-        '''Change turn to next player and send event.
+    def apply_start(self, player_order, key_spectators):
+        '''Start game.
+        @param player_order: list of players, the first is on turn
+        @param key_spectators: new routing key of spectator stream
         '''
-        next_index = self.player_order.index(self.on_turn) + 1
-        if next_index >= len(self.player_order):
-            next_index = 0
-        self.on_turn = self.player_order[next_index]
+        self.state = 'closed'
+        self.key_spectators = key_spectators
+        for player in self.players:
+            self.player_hits[player] = []
+        self.player_order = list(player_order)
+        self.on_turn = self.player_order[0]
+
+    def apply_shot(self, shooter, opponent, row, column):
+        '''Shoot at field of opponent and change turn.
+        @param shooter: name of shooting player
+        @param opponent: name of opponent
+        @param row: row
+        @param column: column
+        @return tuple (shot item, list of strings encoding positions of sunk
+                ship or None, whether opponent lost, whether game ended)
+        '''
+        # Get shot item
+        field = self.fields[opponent]
+        item = field.get_item(row, column)
+        if item is None:
+            item = common.FIELD_WATER
+
+        # Update player_hits by the shot item, ship before it was hit
+        self.player_hits[shooter].append(common.FIELD_SEP.join(
+            [opponent, str(row), str(column), item]))
+
+        # If miss
+        if item == common.FIELD_WATER:
+            self.next_turn()
+            return item, None, False, False
+
+        # If hit, ships that sunk are found in the fleet index
+        ships = None
+        if field.change_item(row, column, common.FIELD_SHIP,
+                             common.FIELD_HIT_SHIP):
+            ships = self.fleets[opponent].hit(row, column)
+
+        sunk = None
+        player_end = False
+        game_end = False
+        if ships is not None:
+            sunk = self.sink_ship(field, ships)
+
+            # If player lost
+            if self.count_player_ships(opponent) == 0:
+                self.players.remove(opponent)
+                self.spectators.add(opponent)
+                player_end = True
+
+                # Adjust turn and player order
+                if self.on_turn == opponent:
+                    i = self.player_order.index(self.on_turn) - 1
+                    if i < 0:
+                        i = len(self.player_order)
+                    self.on_turn = self.player_order[i]
+                    del self.player_order[self.player_order.index(
+                        opponent)]
+
+                game_end = self.check_end_game()
+
+        self.next_turn()
+        return item, sunk, player_end, game_end
+
+    def apply_restart(self):
+        '''Restart game session.
+        '''
+        self.fields = {}
+        self.fleets = {}
+        self.on_turn = None
+        self.player_hits = {}
+        self.player_order = []
 
-        # Send on turn event
-        msg = serverlib.make_e_on_turn(self.on_turn)
-        send_message(self.channel, msg, self.key_events)
+    def snapshot(self):
+        '''Make snapshot of game state.
+        @return dict of JSON values
+        '''
+        return {
+            'owner': self.owner,
+            'width': self.width,
+            'height': self.height,
+            'state': self.state,
+            'version': self.version,
+            'client_queues': self.client_queues,
+            'codecs': self.codecs,
+            'players': sorted(self.players),
+            'spectators': sorted(self.spectators),
+            'fields': dict((player, field.dump())
+                           for player, field in self.fields.items()),
+            'player_hits': self.player_hits,
+            'on_turn': self.on_turn,
+            'player_order': self.player_order,
+            'key_spectators': self.key_spectators,
+        }
+
+    def load_snapshot(self, snapshot):
+        '''Replace game state by snapshot.
+        @param snapshot: dict made by snapshot()
+        '''
+        self.owner = snapshot['owner']
+        self.state = snapshot['state']
+        self.version = snapshot['version']
+        self.client_queues = snapshot['client_queues']
+        self.codecs = snapshot['codecs']
+        self.players = set(snapshot['players'])
+        self.spectators = set(snapshot['spectators'])
+        self.fields = {}
+        self.fleets = {}
+        self.keyframe = None
+        self.deltas = []
+        for player, dump in snapshot['fields'].items():
+            field = common.Field.load(self.width, self.height, dump)
+            # Fleet is labeled from all ship parts and hit again
+            positions = []
+            hit = []
+            for position, item in field.items():
+                if item in (common.FIELD_SHIP, common.FIELD_HIT_SHIP,
+                            common.FIELD_SINK_SHIP):
+                    positions.append(position)
+                if item in (common.FIELD_HIT_SHIP, common.FIELD_SINK_SHIP):
+                    hit.append(position)
+            fleet = Fleet(self.width, self.height, positions)
+            for row, column in hit:
+                fleet.hit(row, column)
+            self.fields[player] = field
+            self.fleets[player] = fleet
+        self.player_hits = snapshot['player_hits']
+        self.on_turn = snapshot['on_turn']
+        self.player_order = snapshot['player_order']
+        self.key_spectators = snapshot.get('key_spectators',
+                                           self.key_spectators)
+
+    def replay(self, version, kind, args):
+        '''Apply mutation read from the event log.
+        @param version: version of game state after the request
+        @param kind: kind of mutation
+        @param args: arguments of the mutation
+        @return result of the mutation
+        '''
+        result = self.appliers[kind](*args)
+        self.version = version
+        return result
+
+    def join_player(self, player, client_queue, codec_name):
+        '''Add player to the game, or reconnect player of the game.
+        @param player: name of player
+        @param client_queue: queue of player's client
+        @param codec_name: codec of player's client
+        @return String, response
+        '''
+        if player not in self.players and self.state == 'closed':
+            return serverlib.make_rsp_permission_denied()
+        # Spectators know the key of spectator stream showing all ships
+        if player in self.spectators:
+            return serverlib.make_rsp_permission_denied()
+
+        new_player = player not in self.players
+        self.mutate('join', player, client_queue, codec_name)
+        if new_player:
+            # Send event that new player was added
+            msg = serverlib.make_e_new_player(player)
+            self.send_event(msg)
+
+        return serverlib.make_rsp_game_entered(self.name,
+                                               int(player == self.owner))
+
+    def spectate(self, spectator, client_queue, codec_name):
+        '''Add spectator to the game.
+        @param spectator: name of spectator
+        @param client_queue: queue of spectator's client
+        @param codec_name: codec of spectator's client
+        @return String, response
+        '''
+        if spectator in self.players:
+            return serverlib.make_rsp_permission_denied()
+
+        self.mutate('spectate', spectator, client_queue, codec_name)
+        return serverlib.make_rsp_game_spectate(self.name, 0,
+                                                self.key_spectators)
+
+    def on_join_game(self, request, properties):
+        '''Join game request forwarded by game list.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties
+        @return String, response
+        '''
+        return self.join_player(request.client_name, properties.reply_to,
+                                serverlib.get_forwarded_codec(properties))
+
+    def on_spectate_game(self, request, properties):
+        '''Spectate game request forwarded by game list.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties
+        @return String, response
+        '''
+        return self.spectate(request.client_name, properties.reply_to,
+                             serverlib.get_forwarded_codec(properties))
+
+    def on_disconnect(self, request):
+        '''Disconnect request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        self.player_disconnected(request.client_name)
+        return serverlib.make_rsp_disconnected()
+
+    def on_leave_game(self, request):
+        '''Leave game request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        self.player_disconnected(request.client_name)
+        self.player_left(request.client_name)
+        return serverlib.make_rsp_game_left()
+
+    def on_get_dimensions(self, request):
+        '''Get dimensions request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        return serverlib.make_rsp_dimensions(self.width, self.height,
+                                             self.ship_number)
+
+    def on_get_players(self, request):
+        '''Get players request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        return serverlib.make_rsp_list_players(list(self.players))
+
+    def on_get_players_ready(self, request):
+        '''Get players ready request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        return serverlib.make_rsp_list_players_ready(list(self.fields))
+
+    def on_get_owner(self, request):
+        '''Get owner request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        return serverlib.make_rsp_owner(self.owner)
+
+    def on_get_turn(self, request):
+        '''Get turn request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        return serverlib.make_rsp_turn(self.on_turn)
+
+    def on_get_field(self, request):
+        '''Get field request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        return serverlib.make_rsp_field(self.get_field(request.client_name))
+
+    def on_get_hits(self, request):
+        '''Get hits request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        return serverlib.make_rsp_hits(self.get_hits(request.client_name))
 
-    def process_request(self, msg_parts):
-        '''Process game request.
-        @param msg_parts: parsed message
+    def on_get_all_fields(self, request):
+        '''Get all fields request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        if request.client_name not in self.spectators:
+            return serverlib.make_rsp_permission_denied()
+
+        all_fields = []
+        for player in self.players:
+            items = self.fields[player].export()
+            all_fields += [player] + items
+        return serverlib.make_rsp_all_fields(all_fields)
+
+    def on_get_spectator(self, request):
+        '''Get spectator request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        if request.client_name in self.spectators:
+            return serverlib.make_rsp_spectator(1)
+        return serverlib.make_rsp_spectator(0)
+
+    def on_get_spectator_queue(self, request):
+        '''Get spectator queue request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        if request.client_name not in self.spectators:
+            return serverlib.make_rsp_permission_denied()
+        return serverlib.make_rsp_spectator_queue(self.key_spectators)
+
+    def on_get_keyframe(self, request):
+        '''Get keyframe request, the latest keyframe of spectator stream is
+        returned with deltas sent after it.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        if request.client_name not in self.spectators:
+            return serverlib.make_rsp_permission_denied()
+        if self.keyframe is None:
+            self.make_keyframe()
+        return serverlib.make_rsp_keyframe(self.version,
+                                           [self.keyframe[1]] + self.deltas)
+
+    def on_get_game_state(self, request):
+        '''Get game state request. All information needed by a client
+        entering the game is returned at once, so no event can come between
+        its parts. Turn goes last, as it marks the state complete.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        return serverlib.make_rsp_game_state(self.version, [
+            self.on_get_spectator(request),
+            self.on_get_dimensions(request),
+            self.on_get_players(request),
+            self.on_get_players_ready(request),
+            self.on_get_owner(request),
+            serverlib.make_rsp_player_order(self.player_order),
+            self.on_get_field(request),
+            self.on_get_hits(request),
+            self.on_get_turn(request)
+        ])
+
+    def on_get_changes(self, request):
+        '''Get changes request. If the journal does not reach back to the
+        version known to client, whole game state is returned instead.
+        @param request: serverlib.Request
         @return String, response
         '''
-        # Disconnect request
-        if msg_parts[0] == common.REQ_DISCONNECT:
-            self.player_disconnected(msg_parts[1])
-            return serverlib.make_rsp_disconnected()
-
-        # Leave game request
-        if msg_parts[0] == common.REQ_LEAVE_GAME:
-            if len(msg_parts) != 2:
-                return serverlib.make_rsp_invalid_request()
-
-            self.player_disconnected(msg_parts[1])
-            self.player_left(msg_parts[1])
-            return serverlib.make_rsp_game_left()
-
-        # Get dimensions request
-        if msg_parts[0] == common.REQ_GET_DIMENSIONS:
-            return serverlib.make_rsp_dimensions(self.width, self.height,
-                                                 self.ship_number)
-
-        # Get players request
-        if msg_parts[0] == common.REQ_GET_PLAYERS:
-            return serverlib.make_rsp_list_players(list(self.players))
-
-        # Get players ready request
-        if msg_parts[0] == common.REQ_GET_PLAYERS_READY:
-            players_ready = [p for p in self.fields if self.fields[p] != {}]
-            return serverlib.make_rsp_list_players_ready(players_ready)
-
-        # Get owner request
-        if msg_parts[0] == common.REQ_GET_OWNER:
-            return serverlib.make_rsp_owner(self.owner)
-
-        # Get turn request
-        if msg_parts[0] == common.REQ_GET_TURN:
-            return serverlib.make_rsp_turn(self.on_turn)
-
-        # Get field request
-        if msg_parts[0] == common.REQ_GET_FIELD:
-            return serverlib.make_rsp_field(self.get_field(msg_parts[1]))
-
-        # Get hits request
-        if msg_parts[0] == common.REQ_GET_HITS:
-            return serverlib.make_rsp_hits(self.get_hits(msg_parts[1]))
-
-        # Get all fields request
-        if msg_parts[0] == common.REQ_GET_ALL_FIELDS:
-            if msg_parts[1] not in self.spectators:
-                return serverlib.make_rsp_permission_denied()
-
-            all_fields = []
-            for player in self.players:
-                items = self.fields[player].get_all_items()
-                all_fields += [player] + items
-            return serverlib.make_rsp_all_fields(all_fields)
-
-        if msg_parts[0] == common.REQ_GET_SPECTATOR:
-            if msg_parts[1] in self.spectators:
-                return serverlib.make_rsp_spectator(1)
-            return serverlib.make_rsp_spectator(0)
-
-        if msg_parts[0] == common.REQ_GET_SPECTATOR_QUEUE:
-            if msg_parts[1] not in self.spectators:
-                return serverlib.make_rsp_permission_denied()
-            return serverlib.make_rsp_spectator_queue(self.spectator_queue)
-
-        # Set ready request
-        if msg_parts[0] == common.REQ_SET_READY:
-            if not self.check_ships(msg_parts[2:]):
+        version = self.version
+        events = self.get_changes(request.client_name, request.version)
+        if events is None:
+            return self.on_get_game_state(request)
+        return serverlib.make_rsp_changes(version, events)
+
+    def on_set_ready(self, request):
+        '''Set ready request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        try:
+            if not self.check_ships(request.items):
                 return serverlib.make_rsp_ships_incorrect()
+        except (ValueError, IndexError):
+            return serverlib.make_rsp_ships_incorrect()
+
+        self.mutate('ready', request.client_name,
+                    self.compact_ships(request.items))
+        # Send event that player is ready
+        msg = serverlib.make_e_player_ready(request.client_name)
+        self.send_event(msg)
+        return serverlib.make_rsp_ready()
+
+    def on_kick_out(self, request):
+        '''Kick out request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        if request.client_name != self.owner or\
+            request.opponent_name in self.client_queues:
+            return serverlib.make_rsp_wont_kick()
+        self.player_left(request.opponent_name)
+        return serverlib.make_rsp_ok()
+
+    def on_start_game(self, request):
+        '''Start game request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        if not self.players.issubset(set(self.fields.keys())):
+            return serverlib.make_rsp_not_all_ready()
+
+        # Determine player order
+        player_order = [self.owner]
+        not_sorted = list(self.players)
+        not_sorted.remove(self.owner)
+        while len(not_sorted) > 0:
+            random_player = random.choice(not_sorted)
+            player_order.append(random_player)
+            not_sorted.remove(random_player)
+        # Spectators before the start may have left and joined since, so the
+        # stream gets new key, asked for again by spectators
+        self.mutate('start', player_order,
+                    common.make_key_game_spectators())
+        self.game_list.index_game(self.name, self.state)
+
+        # Send advert about game start
+        msg = serverlib.make_e_game_close(self.name)
+        send_message(self.channel, msg, self.key_adverts)
+
+        # Send event that game starts
+        msg = serverlib.make_e_game_starts(self.on_turn)
+        self.send_event(msg)
+
+        return serverlib.make_rsp_ok()
+
+    def on_shoot(self, request):
+        '''Shoot request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        client_name = request.client_name
+        opponent_name = request.opponent_name
+        row = request.row
+        column = request.column
+
+        if client_name != self.on_turn:
+            return serverlib.make_rsp_not_on_turn()
+        if opponent_name not in self.fields:
+            return serverlib.make_rsp_invalid_request()
+
+        item, sunk, player_end, game_end = self.mutate(
+            'shot', client_name, opponent_name, row, column)
+
+        # If miss
+        if item == common.FIELD_WATER:
+            msg = serverlib.make_e_miss(client_name, opponent_name, row,
+                                        column)
+            version = self.record(msg, (client_name,))
+            self.send_delta(msg, version)
+            self.send_turn()
+            return serverlib.make_rsp_miss(client_name, opponent_name, row,
+                                           column)
+
+        # Notify the hit player
+        msg = serverlib.make_e_hit(client_name, opponent_name, row, column)
+        version = self.record(msg, (client_name, opponent_name))
+        send_message(self.channel, msg, self.client_queues[opponent_name],
+                     version=version)
+
+        # Send secret event for spectators
+        self.send_delta(msg, version)
+
+        # If ship sinked
+        if sunk is not None:
+            msg = serverlib.make_e_sink(opponent_name, sunk)
+            self.send_delta(msg, self.send_event(msg), stream=False)
+
+        # If player lost
+        if player_end:
+            msg = serverlib.make_e_player_end(opponent_name)
+            self.send_event(msg)
+
+        # If end of game
+        if game_end:
+            msg = serverlib.make_e_game_end(self.name)
+            self.send_event(msg)
+
+        self.send_turn()
+        return serverlib.make_rsp_hit(client_name, opponent_name, row, column)
+
+    def on_restart_session(self, request):
+        '''Restart session request.
+        @param request: serverlib.Request
+        @return String, response
+        '''
+        if not self.check_end_game():
+            return serverlib.make_rsp_permission_denied()
 
-            self.add_ships(msg_parts[1], msg_parts[2:])
-            # Send event that player is ready
-            msg = serverlib.make_e_player_ready(msg_parts[1])
-            send_message(self.channel, msg, self.key_events)
-            return serverlib.make_rsp_ready()
-
-        # Kick out request
-        if msg_parts[0] == common.REQ_KICK_OUT:
-            if msg_parts[1] != self.owner or\
-                msg_parts[2] in self.client_queues:
-                return serverlib.make_rsp_wont_kick()
-            self.player_left(msg_parts[2])
-            return serverlib.make_rsp_ok()
-
-        # Start game request
-        if msg_parts[0] == common.REQ_START_GAME:
-            if not self.players.issubset(set(self.fields.keys())):
-                return serverlib.make_rsp_not_all_ready()
-
-            self.state = 'closed'
-            for player in self.players:
-                self.player_hits[player] = []
-
-            # Determine player order
-            self.on_turn = self.owner
-            self.player_order.append(self.owner)
-            not_sorted = list(self.players)
-            not_sorted.remove(self.owner)
-            while len(not_sorted) > 0:
-                random_player = random.choice(not_sorted)
-                self.player_order.append(random_player)
-                not_sorted.remove(random_player)
-
-            # Send advert about game start
-            msg = serverlib.make_e_game_close(self.name)
-            send_message(self.channel, msg, self.key_adverts)
-
-            # Send event that game starts
-            msg = serverlib.make_e_game_starts(self.on_turn)
-            send_message(self.channel, msg, self.key_events)
-
-            return serverlib.make_rsp_ok()
-
-        # Shoot request
-        if msg_parts[0] == common.REQ_SHOOT:
-            if msg_parts[1] != self.on_turn:
-                return serverlib.make_rsp_not_on_turn()
-
-            # Get shot item
-            item = self.fields[msg_parts[2]].get_item(int(msg_parts[3]),
-                                                      int(msg_parts[4]))
-            if item is None:
-                item = common.FIELD_WATER
-
-            # Update player_hits
-            self.player_hits[msg_parts[1]].append(common.FIELD_SEP.join(
-                [msg_parts[2], msg_parts[3], msg_parts[4], item]))
-
-            # If miss
-            if item == common.FIELD_WATER:
-                self.change_turn()
-                return serverlib.make_rsp_miss(*msg_parts[1:])
-
-            # If hit
-            self.fields[msg_parts[2]].change_item(
-                int(msg_parts[3]), int(msg_parts[4]),
-                common.FIELD_SHIP, common.FIELD_HIT_SHIP
-            )
-
-            # Notify the hit player
-            msg = serverlib.make_e_hit(*msg_parts[1:])
-            send_message(self.channel, msg, self.client_queues[msg_parts[2]])
-
-            # Send secret event for spectators
-            send_message(self.channel, msg, self.spectator_queue)
-
-            ships = self.check_sink_ship(self.fields[msg_parts[2]],
-                                         int(msg_parts[3]),
-                                         int(msg_parts[4]), [], [])
-            # If ship sinked
-            if ships is not None:
-                ships_string = self.sink_ship(self.fields[msg_parts[2]], ships)
-                msg = serverlib.make_e_sink(msg_parts[2], ships_string)
-                send_message(self.channel, msg, self.key_events)
-
-                # If player lost
-                if self.count_player_ships(msg_parts[2]) == 0:
-                    self.players.remove(msg_parts[2])
-                    self.spectators.add(msg_parts[2])
-                    msg = serverlib.make_e_player_end(msg_parts[2])
-                    send_message(self.channel, msg, self.key_events)
-
-                    # Adjust turn and player order
-                    if self.on_turn == msg_parts[2]:
-                        i = self.player_order.index(self.on_turn) - 1
-                        if i < 0:
-                            i = len(self.player_order)
-                        self.on_turn = self.player_order[i]
-                        del self.player_order[self.player_order.index(
-                            msg_parts[2])]
-
-                    # If end of game
-                    if self.check_end_game():
-                        msg = serverlib.make_e_game_end(self.name)
-                        send_message(self.channel, msg, self.key_events)
-
-            self.change_turn()
-            return serverlib.make_rsp_hit(*msg_parts[1:])
-
-        # Restart session request
-        if msg_parts[0] == common.REQ_RESTART_SESSION:
-            if self.check_end_game():
-                # Send restart session event
-                msg = serverlib.make_e_game_restart()
-                send_message(self.channel, msg, self.key_events)
-
-                # Restart game
-                self.fields = {}
-                self.on_turn = None
-                self.player_hits = {}
-                self.player_order = []
-
-                return serverlib.make_rsp_ok()
+        # Send restart session event
+        msg = serverlib.make_e_game_restart()
+        self.send_event(msg)
+
+        # Restart game
+        self.mutate('restart')
+
+        return serverlib.make_rsp_ok()
+
+    def on_batch(self, request, properties):
+        '''Batch request, requests are processed in order and sent again are
+        answered by the same responses.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties, or None
+        @return String, response
+        '''
+        try:
+            requests = serverlib.parse_batch(request)
+        except ValueError:
+            return serverlib.make_rsp_invalid_request()
+
+        responses = [self.answer(item, properties, index)
+                     for index, item in enumerate(requests)]
+        return serverlib.make_rsp_batch(responses)
+
+    def answer(self, request, properties, index=None):
+        '''Process request, request sent again is answered by the same
+        response.
+        @param request: serverlib.Request, or None if request is invalid
+        @param properties: pika.spec.BasicProperties, or None
+        @param index: index of request in batch, None if not in batch
+        @return String, response
+        '''
+        deduplicated = request is not None and\
+            request.type in common.DEDUPLICATED_REQUESTS
+        if deduplicated:
+            response = self.responses.get(properties, index)
+            if response is not None:
+                return response
+        if index is None:
+            response = self.process_request(request, properties)
+        else:
+            # Requests in batch are not forwarded
+            response = self.process_request(request)
+        if deduplicated:
+            self.responses.put(properties, response, index)
+        return response
+
+    def process_request(self, request, properties=None):
+        '''Process game request by the handler registered for its type.
+        @param request: serverlib.Request, or None if request is invalid
+        @param properties: pika.spec.BasicProperties, if request may be
+                           forwarded by game list
+        @return String, response
+        '''
+        if request is None:
+            return serverlib.make_rsp_invalid_request()
+        if request.type == common.REQ_BATCH:
+            return self.on_batch(request, properties)
+        if request.type in self.forwarded_handlers and\
+            properties is not None and\
+            serverlib.get_forwarded_codec(properties) is not None:
+            return self.forwarded_handlers[request.type](request, properties)
+        if request.type not in self.handlers:
+            return serverlib.make_rsp_invalid_request()
+        return self.handlers[request.type](request)
 
     def reply_request(self, ch, method, properties, body):
         '''Reply to game request.
@@ -505,11 +1139,12 @@ class Game(threading.Thread):
         '''
         LOG.debug('Processing game request.')
         LOG.debug('Received message: %s', body)
-        msg_parts = body.split(common.SEP)
-        response = self.process_request(msg_parts)
+        request = serverlib.decode_request(body)
+
+        with self.lock:
+            response = self.answer(request, properties)
+            if self.mutations:
+                self.log_mutations()
 
         # Sending response
-        ch.basic_publish(exchange='direct_logs',
-                         routing_key=properties.reply_to,
-                         body=response)
-        LOG.debug('Sent response to client: %s', response)
+        serverlib.send_response(ch, response, properties, self.codecs)
@@ -0,0 +1,489 @@
+#!/usr/bin/python
+"""
+Load generator for the battleship server.
+
+Synthetic players (bots) are spread across games, and every game is played in
+rounds: the owner creates the game, other players join, all players set ready
+with random fleets, the owner starts the game, players shoot until the game
+ends, the owner restarts the session, and all players leave. The next round is
+played in a new game.
+
+By default the server runs in this process over the in-memory transport. With
+--host, bots connect to a RabbitMQ server and use a running battleship server.
+"""
+# Imports----------------------------------------------------------------------
+from argparse import ArgumentParser
+import collections
+import threading
+import random
+import time
+import Queue
+import logging
+# Custom imports --------------------------------------------------------------
+import clientlib
+import codec
+import common
+from common import send_message
+from server import start_server, stop_games
+from transport import ChannelControl, LocalTransport, PikaTransport
+# Setup Python logging --------------------------------------------------------
+FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+# Constants -------------------------------------------------------------------
+# Seconds to wait for a response, and for events of other players
+RESPONSE_TIMEOUT = 10
+ROUND_TIMEOUT = 60
+# Seconds between attempts to join game not created yet
+JOIN_RETRY = 0.05
+# Seconds between checks of waiting bots
+WATCHDOG_PERIOD = 0.1
+# Classes ---------------------------------------------------------------------
+class RoundAborted(Exception):
+    '''Round of game could not be finished.
+    '''
+
+class Stats(object):
+    '''Statistics shared by all bots.
+    '''
+    def __init__(self):
+        '''Set latencies and counters.
+        '''
+        self.lock = threading.Lock()
+        # Request type -> list of latencies in seconds
+        self.latencies = collections.defaultdict(list)
+        self.timeouts = 0
+        self.games = 0
+        self.aborted = 0
+        self.start = time.time()
+
+    def add_latency(self, request_type, latency):
+        '''Record latency of a response.
+        @param request_type: type of request
+        @param latency: seconds from request to response
+        '''
+        with self.lock:
+            self.latencies[request_type].append(latency)
+
+    def add_timeout(self):
+        '''Record request without response.
+        '''
+        with self.lock:
+            self.timeouts += 1
+
+    def add_game(self):
+        '''Record finished game.
+        '''
+        with self.lock:
+            self.games += 1
+
+    def add_aborted(self):
+        '''Record aborted round.
+        '''
+        with self.lock:
+            self.aborted += 1
+
+class Bot(threading.Thread):
+    '''Synthetic player.
+    '''
+    def __init__(self, transport, args, stats, name, game, group_size,
+                 deadline):
+        '''Set communication and game assignment.
+        @param transport: transport opening channels
+        @param args: arguments of load test
+        @param stats: Stats
+        @param name: name of player
+        @param game: prefix of names of games the bot plays
+        @param group_size: number of players of the game, 0 if bot only joins
+        @param deadline: time when bot stops
+        '''
+        super(Bot, self).__init__(name='Bot: %s' % name)
+        self.setDaemon(True)
+        self.transport = transport
+        self.args = args
+        self.stats = stats
+        self.client_name = name
+        self.game_prefix = game
+        self.group_size = group_size
+        self.deadline = deadline
+
+        self.responses = Queue.Queue()
+        self.events = Queue.Queue()
+
+        self.game_name = None
+        self.key_events = None
+
+        # Tuple (queue, time limit) while waiting for response or event
+        self.waiting = None
+
+    def on_response(self, ch, method, properties, body):
+        '''Put response to queue of responses.
+        '''
+        self.responses.put(codec.decode(body))
+
+    def on_event(self, ch, method, properties, body):
+        '''Put event with its routing key to queue of events.
+        '''
+        self.events.put((method.routing_key, codec.decode(body)))
+
+    def consume(self):
+        '''Consume responses and events. Only the consuming thread uses the
+        consumed channel, the bot publishes on its own channel.
+        '''
+        self.channel.start_consuming()
+
+    def get(self, queue, limit):
+        '''Wait for item of queue until time limit. Waiting with timeout
+        polls in Python 2 and would distort latencies, so the bot blocks and
+        the watchdog wakes it up with None after the limit.
+        @param queue: Queue
+        @param limit: time limit
+        @return item, or None if time limit passed
+        '''
+        self.waiting = (queue, limit)
+        try:
+            while True:
+                item = queue.get()
+                if item is not None:
+                    return item
+                if time.time() >= limit:
+                    return None
+        finally:
+            self.waiting = None
+
+    def request(self, message, routing_key):
+        '''Send request and wait for response. Hit events sent to the player's
+        queue are skipped.
+        @param message: String, request
+        @param routing_key: routing key
+        @return list of response parts
+        '''
+        request_type = message.split(common.SEP, 1)[0]
+        start = time.time()
+        send_message(self.publisher, message, routing_key, self.client_queue)
+        while True:
+            msg_parts = self.get(self.responses, start + RESPONSE_TIMEOUT)
+            if msg_parts is None:
+                self.stats.add_timeout()
+                raise RoundAborted('No response to %s' % request_type)
+            if msg_parts[0] == common.E_HIT and\
+                msg_parts[1] != self.client_name:
+                continue
+            self.stats.add_latency(request_type, time.time() - start)
+            return msg_parts
+
+    def game_request(self, message):
+        '''Send request to the game and wait for response.
+        @param message: String, request
+        @return list of response parts
+        '''
+        return self.request(message, common.make_key_game(
+            self.args.name, self.game_name))
+
+    def next_event(self):
+        '''Wait for event of the current game.
+        @return list of event parts
+        '''
+        limit = min(time.time() + ROUND_TIMEOUT, self.deadline)
+        while True:
+            item = self.get(self.events, limit)
+            if item is None:
+                raise RoundAborted('No event in game %s' % self.game_name)
+            routing_key, msg_parts = item
+            if routing_key == self.key_events:
+                return msg_parts
+
+    def random_fleet(self, width, height, ship_number):
+        '''Choose random positions of ships.
+        @return list of ships
+        '''
+        positions = random.sample(xrange(width * height), ship_number)
+        return [common.FIELD_SEP.join((str(position / width),
+                                       str(position % width)))
+                for position in positions]
+
+    def enter_game(self):
+        '''Create or join game of the current round.
+        '''
+        self.key_events = common.make_key_game_events(self.args.name,
+                                                      self.game_name)
+        self.control.bind(self.events_queue, self.key_events)
+        key_games = common.make_key_games(self.args.name)
+        if self.group_size:
+            msg = clientlib.make_req_create_game(
+                self.game_name, self.client_name, self.args.width,
+                self.args.height)
+            msg_parts = self.request(msg, key_games)
+            if msg_parts[0] != common.RSP_GAME_ENTERED:
+                raise RoundAborted('Game %s not created' % self.game_name)
+            return
+
+        msg = clientlib.make_req_join_game(self.game_name, self.client_name)
+        while time.time() < self.deadline:
+            msg_parts = self.request(msg, key_games)
+            if msg_parts[0] == common.RSP_GAME_ENTERED:
+                return
+            time.sleep(JOIN_RETRY)
+        raise RoundAborted('Game %s not joined' % self.game_name)
+
+    def wait_for_players(self):
+        '''Owner waits until all players are ready, and starts the game.
+        '''
+        players_ready = set()
+        while len(players_ready) < self.group_size:
+            msg_parts = self.next_event()
+            if msg_parts[0] == common.E_PLAYER_READY:
+                players_ready.add(msg_parts[1])
+        msg_parts = self.game_request(
+            clientlib.make_req_start_game(self.client_name))
+        if msg_parts[0] != common.RSP_OK:
+            raise RoundAborted('Game %s not started' % self.game_name)
+
+    def play(self, width, height):
+        '''Shoot at random positions of opponents until the game ends.
+        @return True if the game ended
+        '''
+        opponents = None
+        # Opponent -> positions not shot yet
+        targets = {}
+        while True:
+            msg_parts = self.next_event()
+            if msg_parts[0] == common.E_GAME_END:
+                return True
+            if msg_parts[0] == common.E_PLAYER_END or\
+                msg_parts[0] == common.E_PLAYER_LEFT:
+                if opponents is not None and msg_parts[1] in opponents:
+                    opponents.remove(msg_parts[1])
+                continue
+            if msg_parts[0] not in (common.E_GAME_STARTS, common.E_ON_TURN) or\
+                msg_parts[1] != self.client_name:
+                continue
+
+            if opponents is None:
+                msg_parts = self.game_request(
+                    clientlib.make_req_get_players())
+                opponents = [player for player in msg_parts[1:]
+                             if player != self.client_name]
+                for opponent in opponents:
+                    targets[opponent] = random.sample(xrange(width * height),
+                                                      width * height)
+            if not opponents:
+                continue
+
+            opponent = random.choice(opponents)
+            position = targets[opponent].pop()
+            msg_parts = self.game_request(clientlib.make_req_shoot(
+                self.client_name, opponent, position / width,
+                position % width))
+            if msg_parts[0] == common.RSP_INVALID_REQUEST:
+                opponents.remove(opponent)
+
+    def leave_game(self):
+        '''Leave the current game and stop receiving its events.
+        '''
+        self.control.unbind(self.events_queue, self.key_events)
+        try:
+            self.game_request(clientlib.make_req_leave_game(self.client_name))
+        except RoundAborted:
+            pass
+
+    def play_round(self, number):
+        '''Play one round in a new game.
+        @param number: number of round
+        '''
+        self.game_name = '%s-%d' % (self.game_prefix, number)
+        self.enter_game()
+        try:
+            msg_parts = self.game_request(clientlib.make_req_get_dimensions())
+            width, height, ship_number = [int(x) for x in msg_parts[1:4]]
+            msg_parts = self.game_request(clientlib.make_req_set_ready(
+                self.client_name,
+                self.random_fleet(width, height, ship_number)))
+            if msg_parts[0] != common.RSP_READY:
+                raise RoundAborted('Ships not accepted')
+            if self.group_size:
+                self.wait_for_players()
+            self.play(width, height)
+            if self.group_size:
+                self.stats.add_game()
+                self.game_request(clientlib.make_req_restart_session())
+        finally:
+            self.leave_game()
+
+    def run(self):
+        '''Connect and play rounds until deadline.
+        '''
+        self.channel = self.transport.channel()
+        self.publisher = self.transport.channel()
+        self.client_queue =\
+            self.channel.queue_declare(exclusive=True).method.queue
+        self.channel.queue_bind(exchange='direct_logs',
+                                queue=self.client_queue,
+                                routing_key=self.client_queue)
+        self.events_queue =\
+            self.channel.queue_declare(exclusive=True).method.queue
+        self.channel.basic_consume(common.decompressing(self.on_response),
+                                   queue=self.client_queue,
+                                   no_ack=True)
+        self.channel.basic_consume(common.decompressing(self.on_event),
+                                   queue=self.events_queue,
+                                   no_ack=True)
+        self.control = ChannelControl(self.channel, self.publisher)
+        t = threading.Thread(target=self.consume,
+                             name='Bot consumer: %s' % self.client_name)
+        t.setDaemon(True)
+        self.control.start(t)
+        t.start()
+
+        try:
+            msg_parts = self.request(
+                clientlib.make_req_connect(self.client_name, self.args.codec),
+                self.args.name)
+        except RoundAborted as e:
+            LOG.error('Bot %s: %s', self.client_name, e)
+            return
+        if msg_parts[0] != common.RSP_CONNECTED:
+            LOG.error('Bot %s not connected: %s', self.client_name,
+                      msg_parts[0])
+            return
+
+        number = 0
+        while time.time() < self.deadline:
+            try:
+                self.play_round(number)
+            except RoundAborted as e:
+                if time.time() < self.deadline:
+                    LOG.warning('Bot %s: %s', self.client_name, e)
+                    self.stats.add_aborted()
+            number += 1
+
+        try:
+            self.request(clientlib.make_req_disconnect(self.client_name),
+                         self.args.name)
+        except RoundAborted:
+            pass
+
+# Functions -------------------------------------------------------------------
+def watchdog(bots):
+    '''Wake up bots waiting longer than their time limit.
+    @param bots: list of Bot
+    '''
+    while True:
+        time.sleep(WATCHDOG_PERIOD)
+        now = time.time()
+        for bot in bots:
+            waiting = bot.waiting
+            if waiting is not None and now >= waiting[1]:
+                waiting[0].put(None)
+
+def percentile(values, fraction):
+    '''Get percentile of sorted values.
+    @param values: sorted list of numbers
+    @param fraction: percentile as fraction
+    @return value
+    '''
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def print_report(stats, elapsed):
+    '''Print requests per second, latencies and finished games.
+    @param stats: Stats
+    @param elapsed: duration of test in seconds
+    '''
+    total = sum(len(values) for values in stats.latencies.values())
+    print 'Duration: %.1f s' % elapsed
+    print 'Requests: %d (%.1f per second), timeouts: %d' %\
+        (total, total / elapsed, stats.timeouts)
+    print 'Games finished: %d (%.1f per minute), rounds aborted: %d' %\
+        (stats.games, stats.games * 60.0 / elapsed, stats.aborted)
+    print
+    print '%-22s %8s %10s %10s %10s' % ('Request', 'Count', 'p50 ms',
+                                        'p95 ms', 'p99 ms')
+    for request_type, values in sorted(stats.latencies.items()):
+        values = sorted(values)
+        print '%-22s %8d %10.2f %10.2f %10.2f' % (
+            request_type, len(values), percentile(values, 0.5) * 1000,
+            percentile(values, 0.95) * 1000, percentile(values, 0.99) * 1000)
+
+# Main method -----------------------------------------------------------------
+if __name__ == '__main__':
+    # Parsing arguments
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-H', '--host',
+        help='Address of the RabbitMQ server, if not given the server runs '
+        'in this process'
+    )
+    parser.add_argument(
+        '-p', '--port',
+        help='Port of the RabbitMQ server, defaults to %d' %
+        common.DEFAULT_SERVER_PORT,
+        default=common.DEFAULT_SERVER_PORT
+    )
+    parser.add_argument('-n', '--name',
+                        help='Server name, defaults to loadtest',
+                        default='loadtest')
+    parser.add_argument('-P', '--players', type=int, default=20,
+                        help='Number of players, defaults to 20')
+    parser.add_argument('-g', '--games', type=int, default=10,
+                        help='Number of concurrent games, defaults to 10')
+    parser.add_argument('-W', '--width', type=int, default=10,
+                        help='Width of fields, defaults to 10')
+    parser.add_argument('-E', '--height', type=int, default=10,
+                        help='Height of fields, defaults to 10')
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help='Duration of test in seconds, defaults to 30')
+    parser.add_argument(
+        '-c', '--codec',
+        help='Codec of server responses, defaults to %s' % codec.CODEC_TEXT,
+        choices=codec.CODECS,
+        default=codec.CODEC_TEXT
+    )
+    args = parser.parse_args()
+    if args.games < 1 or args.players < 2 * args.games:
+        parser.error('Every game needs at least two players')
+
+    # Only report of the load test is of interest
+    for name in ('server', 'game', 'serverlib', 'common', 'transport'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    # Transport, and server if it runs in this process
+    if args.host is None:
+        transport = LocalTransport()
+        channel, clients, game_list = start_server(transport, args)
+        t = threading.Thread(target=channel.start_consuming,
+                             name='Server')
+        t.setDaemon(True)
+        t.start()
+    else:
+        transport = PikaTransport(args.host, args.port)
+
+    stats = Stats()
+    deadline = stats.start + args.duration
+    prefix = 'load-%d' % random.randint(0, 99999)
+    bots = []
+    for i in range(args.players):
+        game = i % args.games
+        group_size = 0
+        if i < args.games:
+            group_size = len(range(game, args.players, args.games))
+        bots.append(Bot(transport, args, stats, '%s-bot-%d' % (prefix, i),
+                        '%s-game-%d' % (prefix, game), group_size, deadline))
+    for bot in bots:
+        bot.start()
+    t = threading.Thread(target=watchdog, args=(bots,), name='Watchdog')
+    t.setDaemon(True)
+    t.start()
+
+    try:
+        for bot in bots:
+            while bot.is_alive():
+                bot.join(1)
+    except KeyboardInterrupt as e:
+        LOG.debug('Crtrl+C issued ...')
+        LOG.info('Terminating load test ...')
+
+    print_report(stats, time.time() - stats.start)
+
+    if args.host is None:
+        stop_games(channel, game_list)
@@ -0,0 +1,284 @@
+#!/usr/bin/python
+"""
+Replay of games recorded in the event log of the server.
+
+A game session is rebuilt from the state mutations logged by the game (see
+eventlog.py, run the server with --log-dir and --archive-log to keep whole
+history). Rules of the game are applied by the same Game methods as in the
+server. Snapshots of game state (keyframes) are kept every few mutations, so
+seeking to any turn replays at most that many mutations.
+
+Boards of chosen turns, or of every turn, are printed to standard output. In
+fast mode the session is replayed without printing, and the rate of replayed
+mutations is reported.
+"""
+# Imports----------------------------------------------------------------------
+from argparse import ArgumentParser, Namespace
+import bisect
+import json
+import time
+import logging
+# Custom imports --------------------------------------------------------------
+import common
+import eventlog
+from game import Game
+# Setup Python logging --------------------------------------------------------
+FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+# Constants -------------------------------------------------------------------
+# Number of mutations between keyframes
+KEYFRAME_INTERVAL = 100
+# Characters of board items, by item code of common.Field
+BOARD_CHARS = '.~ox#?'
+# Classes ---------------------------------------------------------------------
+class Trace(object):
+    '''Recorded session of game.
+    '''
+    def __init__(self, name, owner, width, height, snapshot=None):
+        '''Set game attributes and empty list of mutations.
+        @param name: name of game
+        @param owner: owner of game
+        @param width: width of field of game
+        @param height: height of field of game
+        @param snapshot: snapshot of game state the session starts from, or
+                         None if it starts by creation of the game
+        '''
+        self.name = name
+        self.owner = owner
+        self.width = width
+        self.height = height
+        self.snapshot = snapshot
+        # List of tuples (version, kind of mutation, arguments)
+        self.mutations = []
+
+class Replay(object):
+    '''Game state at any position of recorded session. Position is the number
+    of applied mutations.
+    '''
+    def __init__(self, trace, interval=KEYFRAME_INTERVAL):
+        '''Set game in the initial state of session.
+        @param trace: Trace
+        @param interval: number of mutations between keyframes
+        '''
+        self.trace = trace
+        self.interval = interval
+        self.game = Game(None, Namespace(name='replay'), trace.name,
+                         trace.owner, trace.width, trace.height, None, None)
+        self.position = 0
+
+        # Positions of keyframes and their encoded snapshots
+        self.keyframe_positions = [0]
+        if trace.snapshot is None:
+            self.keyframes = {0: json.dumps(self.game.snapshot())}
+        else:
+            self.keyframes = {0: json.dumps(trace.snapshot)}
+            self.load_keyframe(0)
+
+        # Position after every shot
+        self.turns = [position + 1 for position, mutation
+                      in enumerate(trace.mutations) if mutation[1] == 'shot']
+
+    def load_keyframe(self, position):
+        '''Set game state from keyframe.
+        @param position: position of keyframe
+        '''
+        self.game.load_snapshot(eventlog.to_str(
+            json.loads(self.keyframes[position])))
+        self.position = position
+
+    def step(self):
+        '''Apply next mutation, keyframe is kept every interval mutations.
+        @return tuple (kind of mutation, arguments, result of mutation)
+        '''
+        version, kind, args = self.trace.mutations[self.position]
+        result = self.game.replay(version, kind, args)
+        self.position += 1
+        if self.position % self.interval == 0 and\
+            self.position not in self.keyframes:
+            bisect.insort(self.keyframe_positions, self.position)
+            self.keyframes[self.position] = json.dumps(self.game.snapshot())
+        return kind, args, result
+
+    def index(self):
+        '''Replay whole session to keep all keyframes.
+        '''
+        self.seek(0)
+        while self.position < len(self.trace.mutations):
+            self.step()
+
+    def seek(self, position):
+        '''Move to position, starting from the nearest keyframe before it.
+        @param position: number of applied mutations
+        '''
+        position = max(0, min(position, len(self.trace.mutations)))
+        keyframe = self.keyframe_positions[
+            bisect.bisect_right(self.keyframe_positions, position) - 1]
+        if position < self.position or keyframe > self.position:
+            self.load_keyframe(keyframe)
+        while self.position < position:
+            self.step()
+
+    def seek_turn(self, turn):
+        '''Move to the end of turn.
+        @param turn: number of shot, 0 for the start of session
+        '''
+        if turn <= 0:
+            self.seek(0)
+        else:
+            self.seek(self.turns[min(turn, len(self.turns)) - 1])
+
+# Functions -------------------------------------------------------------------
+def read_traces(directory, name):
+    '''Read recorded sessions of game.
+    @param directory: directory of event log
+    @param name: name of game
+    @return list of Trace, in order of recording
+    '''
+    traces = []
+    trace = None
+    for record in eventlog.read_history(directory):
+        kind = record[0]
+        if len(record) < 2 or record[1] != name:
+            continue
+        if kind == eventlog.LOG_GAME:
+            trace = Trace(*record[1:5])
+            traces.append(trace)
+        elif kind == eventlog.LOG_SNAPSHOT and trace is None:
+            # History of the session before the snapshot was deleted
+            width, height, snapshot = record[2:5]
+            trace = Trace(name, snapshot['owner'], width, height, snapshot)
+            traces.append(trace)
+        elif kind == eventlog.LOG_MUTATION and trace is not None:
+            trace.mutations.append((record[2], record[3], record[4:]))
+        elif kind == eventlog.LOG_END:
+            trace = None
+    return traces
+
+def format_board(field):
+    '''Format field as lines of characters.
+    @param field: common.Field
+    @return String
+    '''
+    chars = BOARD_CHARS
+    return '\n'.join(''.join(chars[code] for code in
+                             field.grid[row * field.width:
+                                        (row + 1) * field.width])
+                     for row in range(field.height))
+
+def format_state(game):
+    '''Format players, turn and boards of game.
+    @param game: Game
+    @return String
+    '''
+    lines = ['players: %s, on turn: %s' % (', '.join(sorted(game.players)),
+                                           game.on_turn)]
+    for player in sorted(game.fields):
+        lines.append('%s:' % player)
+        lines.append(format_board(game.fields[player]))
+    return '\n'.join(lines)
+
+def format_shot(args, result):
+    '''Format shot mutation.
+    @param args: shooter, opponent, row, column
+    @param result: result of Game.apply_shot
+    @return String
+    '''
+    shooter, opponent, row, column = args
+    item, sunk, player_end, game_end = result
+    line = '%s shoots %s at %d %d: %s' % (shooter, opponent, row, column,
+                                          'miss' if item == common.FIELD_WATER
+                                          else 'hit')
+    if sunk is not None:
+        line += ', ship sunk'
+    if player_end:
+        line += ', %s lost' % opponent
+    if game_end:
+        line += ', game ended'
+    return line
+
+def print_turns(replay):
+    '''Print every turn of session with boards.
+    @param replay: Replay
+    '''
+    replay.seek(0)
+    turn = 0
+    while replay.position < len(replay.trace.mutations):
+        kind, args, result = replay.step()
+        if kind != 'shot':
+            print ' '.join([kind] + ['%d items' % len(arg)
+                                     if isinstance(arg, list) else str(arg)
+                                     for arg in args])
+            continue
+        turn += 1
+        print 'turn %d: %s' % (turn, format_shot(args, result))
+        print format_state(replay.game)
+
+def benchmark(replay, repeat):
+    '''Replay whole session repeatedly and report rate of mutations.
+    @param replay: Replay
+    @param repeat: number of replays
+    '''
+    mutations = len(replay.trace.mutations) * repeat
+    start = time.time()
+    for _ in range(repeat):
+        replay.index()
+    elapsed = max(time.time() - start, 1e-9)
+    print '%d mutations (%d turns) replayed in %.3f s: %.0f mutations/s' % (
+        mutations, len(replay.turns) * repeat, elapsed, mutations / elapsed)
+
+    # Seeking uses the keyframes kept by the replays
+    start = time.time()
+    for turn in range(len(replay.turns), 0, -1):
+        replay.seek_turn(turn)
+    elapsed = max(time.time() - start, 1e-9)
+    if replay.turns:
+        print 'seek to every turn backwards: %.1f us per seek' % (
+            elapsed / len(replay.turns) * 1e6)
+
+# Main function ---------------------------------------------------------------
+if __name__ == '__main__':
+    # Parsing arguments
+    parser = ArgumentParser()
+    parser.add_argument('log_dir',
+                        help='Directory of event log of server or worker')
+    parser.add_argument('game', help='Name of game')
+    parser.add_argument('-s', '--session', type=int, default=-1,
+                        help='Index of recorded session of the game, '
+                        'defaults to -1 for the last one')
+    parser.add_argument('-t', '--turn', type=int, nargs='+',
+                        help='Print boards at the end of given turns')
+    parser.add_argument('-f', '--fast', action='store_true',
+                        help='Replay as fast as possible and report rate')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Number of replays in fast mode, defaults to 1')
+    parser.add_argument('-k', '--keyframes', type=int,
+                        default=KEYFRAME_INTERVAL,
+                        help='Number of mutations between keyframes, '
+                        'defaults to %d' % KEYFRAME_INTERVAL)
+    args = parser.parse_args()
+    if args.keyframes < 1:
+        parser.error('Keyframe interval must be positive')
+
+    traces = read_traces(args.log_dir, args.game)
+    if not traces:
+        parser.error('Game %s not found in the log' % args.game)
+    try:
+        trace = traces[args.session]
+    except IndexError:
+        parser.error('Game %s has %d recorded sessions' % (args.game,
+                                                          len(traces)))
+    LOG.info('Session %d of %d: %d mutations.', args.session % len(traces),
+             len(traces), len(trace.mutations))
+
+    replay = Replay(trace, args.keyframes)
+    if args.fast:
+        benchmark(replay, args.repeat)
+    elif args.turn:
+        for turn in args.turn:
+            replay.seek_turn(turn)
+            print 'turn %d:' % turn
+            print format_state(replay.game)
+    else:
+        print_turns(replay)
@@ -6,15 +6,25 @@ Created on Thu Dec  1 15:41:13 2016
 """
 # Imports----------------------------------------------------------------------
 from argparse import ArgumentParser
-from time import sleep
+import bisect
+import time
+import multiprocessing
 import threading
 import logging
-import pika
+import os
+import random
+import uuid
+import zlib
 # Custom imports --------------------------------------------------------------
 import serverlib
+import clientlib
+import codec
 import common
+import eventlog
 from common import send_message
+from eventlog import EventLog
 from game import Game
+from transport import PikaTransport
 # Setup Python logging --------------------------------------------------------
 FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -25,27 +35,78 @@ ___NAME = 'Battleship Game Client'
 ___VER = '0.1.0.0'
 ___DESC = 'Battleship Game Client'
 ___BUILT = '2016-11-10'
+# Seconds to wait for the directory to acknowledge registration
+REGISTER_TIMEOUT = 2.0
+# Lease assumed before the directory grants one, in seconds
+DEFAULT_LEASE = 6.0
+# Shortest and longest delay of repeated registration after failure, seconds
+RETRY_MIN = 0.5
+RETRY_MAX = 30.0
+# States of games listed by game list
+GAME_STATES = ('opened', 'closed')
 # Classes ---------------------------------------------------------------------
-class GameList(object):
-    '''List of game sessions.
+class GameHost(object):
+    '''Game sessions running in this process.
     '''
-    def __init__(self, channel, server_args, clients):
+    def __init__(self, channel, server_args, transport):
+        '''Set dict of games and communication channel.
+        @param channel: pika connection channel
+        @param server_args: arguments of server
+        @param transport: transport opening channels for games
+        '''
         # Dict of running games
         self.games = {}
+        # Game state -> sorted names of games, updated by index_game and
+        # unindex_game, also from game threads
+        self.index = dict((state, []) for state in GAME_STATES)
+        self.index_lock = threading.Lock()
 
         # Communication
+        self.transport = transport
         self.server_args = server_args
         self.server_name = server_args.name
-        self.clients = clients
         self.channel = channel
-        self.games_queue = channel.queue_declare(exclusive=True).method.queue
-        self.channel.queue_bind(exchange='direct_logs',
-                                queue=self.games_queue,
-                                routing_key=common.make_key_games(
-                                    self.server_name))
-        self.channel.basic_consume(self.reply_request,
-                                   queue=self.games_queue,
-                                   no_ack=True)
+
+        # Name of server node, unique among nodes of cluster
+        self.node = getattr(server_args, 'node', None)
+
+        # EventLog of games, or None
+        self.log = None
+
+    def index_game(self, name, state):
+        '''Put game into the index of its state.
+        @param name: name of game
+        @param state: state of game
+        '''
+        with self.index_lock:
+            for names in self.index.values():
+                index = bisect.bisect_left(names, name)
+                if index < len(names) and names[index] == name:
+                    del names[index]
+            bisect.insort(self.index[state], name)
+
+    def unindex_game(self, name):
+        '''Remove game from the indexes.
+        @param name: name of game
+        '''
+        with self.index_lock:
+            for names in self.index.values():
+                index = bisect.bisect_left(names, name)
+                if index < len(names) and names[index] == name:
+                    del names[index]
+
+    def list_games(self, state, offset=0, limit=None):
+        '''Get page of names of games in state.
+        @param state: state of game
+        @param offset: number of games skipped
+        @param limit: maximal number of games, None for all
+        @return tuple (number of all games in state, list of names)
+        '''
+        with self.index_lock:
+            names = self.index[state]
+            if limit is None:
+                return len(names), names[offset:]
+            return len(names), names[offset:offset + limit]
 
     def add_game(self, name, owner, width, height):
         '''Add game to the dict of games.
@@ -53,10 +114,21 @@ class GameList(object):
         @param owner: owner of game
         @param width: width of field of game
         @param height: height of field of game
+        @return Game, or None if the game runs elsewhere
         '''
+        # Only one server may own the game queue
+        game_queue = common.make_key_game(self.server_name, name)
+        channel = self.transport.claim_queue(game_queue)
+        if channel is None:
+            return None
+
         # Create game in new thread
-        game = Game(self, self.server_args, name, owner, width, height)
+        game = Game(self, self.server_args, name, owner, width, height,
+                    channel, game_queue)
         self.games[name] = game
+        self.index_game(name, 'opened')
+        if self.log is not None:
+            self.log.append([eventlog.LOG_GAME, name, owner, width, height])
         game.start()
 
         # Send event about added game
@@ -72,6 +144,9 @@ class GameList(object):
         '''
         try:
             del self.games[name]
+            self.unindex_game(name)
+            if self.log is not None:
+                self.log.append([eventlog.LOG_END, name])
             # Send event about removed game
             msg = serverlib.make_e_game_end(name)
             send_message(self.channel, msg,
@@ -79,97 +154,310 @@ class GameList(object):
         except KeyError:
             pass
 
-    def get_games(self, state=None):
-        '''Get list of games, optionally filtering by state.
+    def create_game(self, name, owner, width, height, client_queue,
+                    codec_name):
+        '''Create game and enter it as its owner.
+        @param name: name of game
+        @param owner: owner of game
+        @param width: width of field of game
+        @param height: height of field of game
+        @param client_queue: queue of owner's client
+        @param codec_name: codec of owner's client
+        @return String, response
+        '''
+        game = self.add_game(name, owner, width, height)
+        if game is None:
+            return serverlib.make_rsp_name_exists()
+        game.wait_for_ready()
+        with game.lock:
+            response = game.join_player(owner, client_queue, codec_name)
+            if game.mutations:
+                game.log_mutations()
+        return response
+
+    def restore_game(self, name, owner, width, height):
+        '''Add game read from the event log, it is started by
+        start_restored_games().
+        @param name: name of game
+        @param owner: owner of game
+        @param width: width of field of game
+        @param height: height of field of game
+        @return Game
+        '''
+        game = Game(self, self.server_args, name, owner, width, height, None,
+                    None)
+        self.games[name] = game
+        return game
+
+    def start_restored_games(self):
+        '''Start games read from the event log. Games without clients are
+        dropped.
+        '''
+        for name, game in self.games.items():
+            if not isinstance(game, Game) or game.is_alive():
+                continue
+            game_queue = common.make_key_game(self.server_name, name)
+            channel = None
+            if game.client_queues:
+                channel = self.transport.claim_queue(game_queue)
+            if channel is None:
+                LOG.info('Dropping restored game %s.', name)
+                del self.games[name]
+                continue
+            game.channel = channel
+            game.game_queue = game_queue
+            self.index_game(name, game.state)
+            game.start()
+
+            # Send events about restored game
+            key_adverts = common.make_key_game_advert(self.server_name)
+            send_message(self.channel, serverlib.make_e_game_open(name),
+                         key_adverts)
+            if game.state == 'closed':
+                send_message(self.channel, serverlib.make_e_game_close(name),
+                             key_adverts)
+
+    def checkpoint(self):
+        '''Append snapshots of games to the event log.
+        '''
+        for name, game in self.games.items():
+            if not isinstance(game, Game):
+                continue
+            # The snapshot is appended before any later mutation of the game
+            with game.lock:
+                self.log.append([eventlog.LOG_SNAPSHOT, name, game.width,
+                                 game.height, game.snapshot()])
+
+class RemoteGame(object):
+    '''Record of game session running in worker process or other node of
+    cluster, followed by game adverts.
+    '''
+    def __init__(self, name, state='opened'):
+        '''Set name and state of game.
+        @param name: name of game
         @param state: state of game
-        @return list: list of games
         '''
-        if state is None:
-            return self.games
-        return [game for game in self.games.values() if game.state == state]
+        self.name = name
+        self.state = state
+
+class GameList(GameHost):
+    '''List of game sessions. Games run in this process, or in worker
+    processes if server has workers. Nodes of cluster also list games of
+    other nodes.
+    '''
+    def __init__(self, channel, server_args, clients, transport):
+        '''Set dict of games, communication channel, and consuming.
+        @param channel: pika connection channel
+        @param server_args: arguments of server
+        @param clients: Clients
+        @param transport: transport opening channels for games
+        '''
+        super(GameList, self).__init__(channel, server_args, transport)
+        self.clients = clients
 
-    def process_request(self, msg_parts, properties):
-        '''Process request about list of games.
-        @param msg_parts: parsed message
+        # Number of worker processes running games, 0 to run them here
+        self.workers = getattr(server_args, 'workers', 0)
+        # Whether server is node of cluster
+        self.cluster = getattr(server_args, 'cluster', False)
+
+        # Communication, nodes of cluster compete for requests in shared
+        # queue
+        if self.cluster:
+            self.games_queue = common.make_key_games(self.server_name)
+            channel.queue_declare(queue=self.games_queue, durable=True)
+        else:
+            self.games_queue =\
+                channel.queue_declare(exclusive=True).method.queue
+        self.channel.queue_bind(exchange='direct_logs',
+                                queue=self.games_queue,
+                                routing_key=common.make_key_games(
+                                    self.server_name))
+        self.channel.basic_consume(common.decompressing(self.reply_request),
+                                   queue=self.games_queue,
+                                   no_ack=True)
+        if self.workers or self.cluster:
+            self.adverts_queue =\
+                channel.queue_declare(exclusive=True).method.queue
+            self.channel.queue_bind(exchange='direct_logs',
+                                    queue=self.adverts_queue,
+                                    routing_key=common.make_key_game_advert(
+                                        self.server_name))
+            self.channel.basic_consume(common.decompressing(self.on_advert),
+                                       queue=self.adverts_queue,
+                                       no_ack=True)
+
+        # Request type -> handler
+        self.handlers = {
+            common.REQ_LIST_OPENED: self.on_list_opened,
+            common.REQ_LIST_CLOSED: self.on_list_closed,
+            common.REQ_CREATE_GAME: self.on_create_game,
+            common.REQ_JOIN_GAME: self.on_join_game,
+            common.REQ_SPECTATE_GAME: self.on_spectate_game,
+            common.REQ_BATCH: self.on_batch,
+        }
+
+    def on_advert(self, ch, method, properties, body):
+        '''Update record of game running in worker process or other node.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
+        msg_parts = body.split(common.SEP)
+        if len(msg_parts) != 2:
+            return
+        event, name = msg_parts
+        game = self.games.get(name)
+        if event == common.E_GAME_OPEN and game is None:
+            self.games[name] = RemoteGame(name)
+            self.index_game(name, 'opened')
+        elif not isinstance(game, RemoteGame):
+            return
+        elif event == common.E_GAME_CLOSE:
+            game.state = 'closed'
+            self.index_game(name, 'closed')
+        elif event == common.E_GAME_END:
+            del self.games[name]
+            self.unindex_game(name)
+
+    def get_codec(self, client_queue):
+        '''Get codec negotiated by client.
+        @param client_queue: queue of client
+        @return codec name
+        '''
+        return self.clients.codecs.get(client_queue, codec.CODEC_TEXT)
+
+    def get_page(self, request, state):
+        '''Get page of games asked for by list request.
+        @param request: serverlib.Request, items are optional offset and limit
+        @param state: state of game
+        @return tuple (number of all games in state, offset, list of names),
+                or None if the page is invalid
+        '''
+        offset = 0
+        limit = None
+        if request.items:
+            if len(request.items) != 2:
+                return None
+            try:
+                offset = int(request.items[0])
+                limit = int(request.items[1])
+            except ValueError:
+                return None
+            if offset < 0 or limit < 0:
+                return None
+        total, names = self.list_games(state, offset, limit)
+        return total, offset, names
+
+    def on_list_opened(self, request, properties):
+        '''Get list of opened games request.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties
+        @return String, response
+        '''
+        page = self.get_page(request, 'opened')
+        if page is None:
+            return serverlib.make_rsp_invalid_request()
+        return serverlib.make_rsp_list_opened(*page)
+
+    def on_list_closed(self, request, properties):
+        '''Get list of closed games request.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties
+        @return String, response
+        '''
+        page = self.get_page(request, 'closed')
+        if page is None:
+            return serverlib.make_rsp_invalid_request()
+        return serverlib.make_rsp_list_closed(*page)
+
+    def on_create_game(self, request, properties):
+        '''Create game request.
+        @param request: serverlib.Request
         @param properties: pika.spec.BasicProperties
         @return String, response
         '''
-        # Get list of games request
-        if msg_parts[0] == common.REQ_LIST_OPENED:
-            game_names = [game.name for game in self.get_games('opened')]
-            return serverlib.make_rsp_list_opened(game_names)
-        if msg_parts[0] == common.REQ_LIST_CLOSED:
-            game_names = [game.name for game in self.get_games('closed')]
-            return serverlib.make_rsp_list_closed(game_names)
-
-        # Create game request
-        if msg_parts[0] == common.REQ_CREATE_GAME:
-            if len(msg_parts) != 5 or msg_parts[1].strip() == '' or\
-                msg_parts[3].strip() == '' or msg_parts[4].strip() == '':
-                return serverlib.make_rsp_invalid_request()
-
-            game_name = msg_parts[1]
-            client_name = msg_parts[2]
-            width = msg_parts[3]
-            height = msg_parts[4]
-
-            if game_name in self.games:
-                return serverlib.make_rsp_name_exists()
-            if client_name not in self.clients.client_set:
-                return serverlib.make_rsp_permission_denied()
-
-            game = self.add_game(game_name, client_name, width, height)
-            game.wait_for_ready()
-            game.client_queues[client_name] = properties.reply_to
-            return serverlib.make_rsp_game_entered(game_name, 1)
-
-        # Join game request
-        if msg_parts[0] == common.REQ_JOIN_GAME:
-            if len(msg_parts) != 3:
-                return serverlib.make_rsp_invalid_request()
-
-            game_name = msg_parts[1]
-            client_name = msg_parts[2]
-
-            if game_name not in self.games:
-                return serverlib.make_rsp_name_doesnt_exist()
-            if client_name not in self.clients.client_set:
-                return serverlib.make_rsp_permission_denied()
-            if client_name not in self.games[game_name].players and\
-                self.games[game_name].state == 'closed':
-                return serverlib.make_rsp_permission_denied()
-
-            self.games[game_name].client_queues[client_name] =\
-                properties.reply_to
-            if client_name not in self.games[game_name].players:
-                self.games[game_name].players.add(client_name)
-                # Send event that new player was added
-                msg = serverlib.make_e_new_player(client_name)
-                send_message(self.channel, msg,
-                             common.make_key_game_events(self.server_name,
-                                                         game_name))
-
-            return serverlib.make_rsp_game_entered(game_name, 0)
-
-        # Spectating game request
-        if msg_parts[0] == common.REQ_SPECTATE_GAME:
-            if len(msg_parts) != 3:
-                return serverlib.make_rsp_invalid_request()
-
-            game_name = msg_parts[1]
-            client_name = msg_parts[2]
-
-            if game_name not in self.games:
-                return serverlib.make_rsp_name_doesnt_exist()
-            if client_name not in self.clients.client_set:
-                return serverlib.make_rsp_permission_denied()
-            if client_name in self.games[game_name].players:
-                return serverlib.make_rsp_permission_denied()
-
-            game = self.games[game_name]
-            game.spectators.add(client_name)
-            return serverlib.make_rsp_game_spectate(game_name, 0,
-                                                    game.spectator_queue)
+        if request.width < 1 or request.height < 1 or\
+            request.width > common.MAX_FIELD_SIZE or\
+            request.height > common.MAX_FIELD_SIZE:
+            return serverlib.make_rsp_invalid_request()
+
+        game_name = request.game_name
+        client_name = request.client_name
+
+        if game_name in self.games:
+            return serverlib.make_rsp_name_exists()
+        if client_name not in self.clients.client_set:
+            return serverlib.make_rsp_permission_denied()
+
+        # Worker process creates the game and replies, the game is recorded
+        # when its advert comes, so a game the worker failed to create is
+        # not listed
+        if self.workers:
+            return serverlib.Forward(common.make_key_worker(
+                self.server_name, self.node,
+                worker_number(game_name, self.workers)))
+
+        return self.create_game(game_name, client_name, request.width,
+                                request.height, properties.reply_to,
+                                self.get_codec(properties.reply_to))
+
+    def on_join_game(self, request, properties):
+        '''Join game request, the game itself adds the player and replies.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties
+        @return String, response, or serverlib.Forward
+        '''
+        if request.game_name not in self.games:
+            return serverlib.make_rsp_name_doesnt_exist()
+        if request.client_name not in self.clients.client_set:
+            return serverlib.make_rsp_permission_denied()
+        return serverlib.Forward(common.make_key_game(self.server_name,
+                                                      request.game_name))
+
+    def on_spectate_game(self, request, properties):
+        '''Spectating game request, the game itself adds the spectator and
+        replies.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties
+        @return String, response, or serverlib.Forward
+        '''
+        if request.game_name not in self.games:
+            return serverlib.make_rsp_name_doesnt_exist()
+        if request.client_name not in self.clients.client_set:
+            return serverlib.make_rsp_permission_denied()
+        return serverlib.Forward(common.make_key_game(self.server_name,
+                                                      request.game_name))
+
+    def on_batch(self, request, properties):
+        '''Batch request, requests are processed in order.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties
+        @return String, response
+        '''
+        try:
+            requests = serverlib.parse_batch(request)
+        except ValueError:
+            return serverlib.make_rsp_invalid_request()
+
+        responses = [self.process_request(item, properties)
+                     for item in requests]
+        # Forwarded requests can't be answered in batch
+        responses = [serverlib.make_rsp_invalid_request()
+                     if isinstance(response, serverlib.Forward) else response
+                     for response in responses]
+        return serverlib.make_rsp_batch(responses)
+
+    def process_request(self, request, properties):
+        '''Process request about list of games by the handler registered for
+        its type.
+        @param request: serverlib.Request, or None if request is invalid
+        @param properties: pika.spec.BasicProperties
+        @return String, response
+        '''
+        if request is None or request.type not in self.handlers:
+            return serverlib.make_rsp_invalid_request()
+        return self.handlers[request.type](request, properties)
 
     def reply_request(self, ch, method, properties, body):
         '''Reply to request about list of games.
@@ -180,38 +468,111 @@ class GameList(object):
         '''
         LOG.debug('Processing game list request.')
         LOG.debug('Received message: %s', body)
-        msg_parts = body.split(common.SEP)
-        response = self.process_request(msg_parts, properties)
+        request = serverlib.decode_request(body)
+        response = self.process_request(request, properties)
+
+        # Forwarding request
+        if isinstance(response, serverlib.Forward):
+            serverlib.forward_request(ch, body, properties,
+                                      response.routing_key,
+                                      self.get_codec(properties.reply_to))
+            return
 
         # Sending response
-        ch.basic_publish(exchange='direct_logs',
-                         routing_key=properties.reply_to,
-                         body=response)
-        LOG.debug('Sent response to client: %s', response)
+        serverlib.send_response(ch, response, properties, self.clients.codecs)
 
 class Clients(object):
     '''Process client connections.
     '''
-    def __init__(self, channel, server_name):
+    def __init__(self, channel, server_name, cluster=False):
         '''Set a set of client usernames, communication channel, and consuming.
         @param channel: pika connection channel
         @param server_name: name of server
+        @param cluster: whether server is node of cluster
         '''
         # Set of client usernames
         self.client_set = set()
 
+        # Codecs negotiated by clients, client queue -> codec
+        self.codecs = {}
+
         self.server_name = server_name
 
-        # Communication
+        # Cluster node sharing the clients with other nodes, or None
+        self.cluster = None
+
+        # EventLog of connected clients, or None
+        self.log = None
+
+        # Communication, nodes of cluster compete for requests in shared
+        # queue
         self.channel = channel
-        self.connect_queue = channel.queue_declare(exclusive=True).method.queue
+        if cluster:
+            self.connect_queue = self.server_name
+            channel.queue_declare(queue=self.connect_queue, durable=True)
+        else:
+            self.connect_queue =\
+                channel.queue_declare(exclusive=True).method.queue
         self.channel.queue_bind(exchange='direct_logs',
                                 queue=self.connect_queue,
                                 routing_key=self.server_name)
-        self.channel.basic_consume(self.process_client,
+        self.channel.basic_consume(common.decompressing(self.process_client),
                                    queue=self.connect_queue,
                                    no_ack=True)
 
+        # Request type -> handler
+        self.handlers = {
+            common.REQ_CONNECT: self.on_connect,
+            common.REQ_DISCONNECT: self.on_disconnect,
+        }
+
+    def on_connect(self, request, properties):
+        '''Connect request. Client may ask for codec of the responses.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties
+        @return String, response
+        '''
+        if len(request.items) > 1 or\
+            (request.items and request.items[0] not in codec.CODECS):
+            return serverlib.make_rsp_invalid_request()
+        if request.client_name in self.client_set:
+            return serverlib.make_rsp_username_taken()
+        self.client_set.add(request.client_name)
+        if request.items:
+            self.codecs[properties.reply_to] = request.items[0]
+        if self.log is not None:
+            self.log.append([eventlog.LOG_CONNECT, request.client_name,
+                             properties.reply_to,
+                             self.codecs.get(properties.reply_to)])
+        if self.cluster is not None:
+            self.cluster.client_connected(request.client_name,
+                                          properties.reply_to,
+                                          self.codecs.get(properties.reply_to))
+
+        if not request.items:
+            return serverlib.make_rsp_connected(self.server_name,
+                                                request.client_name)
+        return serverlib.make_rsp_connected(self.server_name,
+                                            request.client_name,
+                                            request.items[0])
+
+    def on_disconnect(self, request, properties):
+        '''Disconnect request.
+        @param request: serverlib.Request
+        @param properties: pika.spec.BasicProperties
+        @return String, response
+        '''
+        try:
+            self.client_set.remove(request.client_name)
+        except KeyError:
+            pass
+        if self.log is not None:
+            self.log.append([eventlog.LOG_DISCONNECT, request.client_name,
+                             properties.reply_to])
+        if self.cluster is not None:
+            self.cluster.client_left(request.client_name, properties.reply_to)
+        return serverlib.make_rsp_disconnected()
+
     def process_client(self, ch, method, properties, body):
         '''Process client's connection request.
         @param ch: pika.BlockingChannel
@@ -221,61 +582,438 @@ class Clients(object):
         '''
         LOG.debug('Processing connection request.')
         LOG.debug('Received message: %s', body)
+        request = serverlib.decode_request(body)
+        if request is None or request.type not in self.handlers:
+            response = serverlib.make_rsp_invalid_request()
+        else:
+            response = self.handlers[request.type](request, properties)
+
+        # Sending response
+        serverlib.send_response(ch, response, properties, self.codecs)
+        if request is not None and request.type == common.REQ_DISCONNECT:
+            self.codecs.pop(properties.reply_to, None)
+
+    def checkpoint(self):
+        '''Append snapshot of clients to the event log.
+        '''
+        self.log.append([eventlog.LOG_CLIENTS, list(self.client_set),
+                         dict(self.codecs)])
+
+class Cluster(object):
+    '''Node of server cluster. Nodes share clients and records of games, and
+    compete for requests in shared queues.
+    '''
+    def __init__(self, channel, server_name, node, clients, game_list):
+        '''Set communication with other nodes, and ask them for their clients
+        and games.
+        @param channel: pika connection channel
+        @param server_name: name of server
+        @param node: name of node
+        @param clients: Clients
+        @param game_list: GameList
+        '''
+        self.server_name = server_name
+        self.node = node
+        self.clients = clients
+        self.game_list = game_list
+
+        # Communication
+        self.channel = channel
+        self.key_cluster = common.make_key_cluster(self.server_name)
+        self.cluster_queue =\
+            channel.queue_declare(exclusive=True).method.queue
+        self.channel.queue_bind(exchange='direct_logs',
+                                queue=self.cluster_queue,
+                                routing_key=self.key_cluster)
+        self.channel.basic_consume(common.decompressing(self.on_message),
+                                   queue=self.cluster_queue,
+                                   no_ack=True)
+
+        # Message type -> handler
+        self.handlers = {
+            common.CLUSTER_HELLO: self.on_hello,
+            common.CLUSTER_CLIENTS: self.on_clients,
+            common.CLUSTER_CODECS: self.on_codecs,
+            common.CLUSTER_CLIENT_LEFT: self.on_client_left,
+            common.CLUSTER_GAMES: self.on_games,
+        }
+
+        self.publish(serverlib.make_cluster_hello(self.node))
+
+    def publish(self, message):
+        '''Send message to other nodes.
+        @param message: String, message
+        '''
+        send_message(self.channel, message, self.key_cluster)
+
+    def client_connected(self, client_name, client_queue, codec_name):
+        '''Tell other nodes about connected client.
+        @param client_name: name of client
+        @param client_queue: queue of client
+        @param codec_name: codec negotiated by client, or None
+        '''
+        self.publish(serverlib.make_cluster_clients(self.node, [client_name]))
+        if codec_name is not None:
+            self.publish(serverlib.make_cluster_codecs(
+                self.node, [common.FIELD_SEP.join((client_queue, codec_name))]))
+
+    def client_left(self, client_name, client_queue):
+        '''Tell other nodes about disconnected client.
+        @param client_name: name of client
+        @param client_queue: queue of client
+        '''
+        self.publish(serverlib.make_cluster_client_left(self.node, client_name,
+                                                        client_queue))
+
+    def on_hello(self, items):
+        '''New node asks for clients and games.
+        @param items: message parts after the node name
+        '''
+        self.publish(serverlib.make_cluster_clients(
+            self.node, sorted(self.clients.client_set)))
+        self.publish(serverlib.make_cluster_codecs(
+            self.node, [common.FIELD_SEP.join(item)
+                        for item in self.clients.codecs.items()]))
+        self.publish(serverlib.make_cluster_games(
+            self.node, [common.FIELD_SEP.join((game.name, game.state))
+                        for game in self.game_list.games.values()]))
+
+    def on_clients(self, items):
+        '''Add clients connected to other node.
+        @param items: names of clients
+        '''
+        self.clients.client_set.update(items)
+
+    def on_codecs(self, items):
+        '''Add codecs of clients connected to other node.
+        @param items: client queues and codecs
+        '''
+        for item in items:
+            client_queue, codec_name = item.split(common.FIELD_SEP)
+            self.clients.codecs[client_queue] = codec_name
+
+    def on_client_left(self, items):
+        '''Remove client disconnected from other node.
+        @param items: name and queue of client
+        '''
+        client_name, client_queue = items
+        self.clients.client_set.discard(client_name)
+        self.clients.codecs.pop(client_queue, None)
+
+    def on_games(self, items):
+        '''Add records of games known to other node.
+        @param items: names and states of games
+        '''
+        for item in items:
+            name, state = item.split(common.FIELD_SEP)
+            if state not in GAME_STATES:
+                continue
+            if name not in self.game_list.games:
+                self.game_list.games[name] = RemoteGame(name, state)
+                self.game_list.index_game(name, state)
+
+    def on_message(self, ch, method, properties, body):
+        '''Process message of other node.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
         msg_parts = body.split(common.SEP)
-        response = None
+        if len(msg_parts) < 2 or msg_parts[1] == self.node or\
+            msg_parts[0] not in self.handlers:
+            return
+        LOG.debug('Received cluster message: %s', msg_parts[0])
+        try:
+            self.handlers[msg_parts[0]](msg_parts[2:])
+        except ValueError:
+            LOG.debug('Invalid cluster message: %s', body)
 
-        # Connect request
-        if msg_parts[0] == common.REQ_CONNECT:
-            if len(msg_parts) != 2:
-                response = serverlib.make_rsp_invalid_request()
-            else:
-                client_name = msg_parts[1].strip()
-                if client_name in self.client_set:
-                    response = serverlib.make_rsp_username_taken()
-                else:
-                    self.client_set.add(msg_parts[1].strip())
-                    response = serverlib.make_rsp_connected(self.server_name,
-                                                            client_name)
-
-        # Disconnect request
-        elif msg_parts[0] == common.REQ_DISCONNECT:
-            try:
-                self.client_set.remove(msg_parts[1])
-            except KeyError:
-                pass
-            response = serverlib.make_rsp_disconnected()
+class Worker(GameHost):
+    '''Worker process running game sessions created by game list.
+    '''
+    def __init__(self, channel, server_args, transport, number):
+        '''Set dict of games, communication channel, and consuming.
+        @param channel: pika connection channel
+        @param server_args: arguments of server
+        @param transport: transport opening channels for games
+        @param number: number of worker
+        '''
+        super(Worker, self).__init__(channel, server_args, transport)
+        self.number = number
+
+        # Communication
+        self.worker_queue = channel.queue_declare(exclusive=True).method.queue
+        self.channel.queue_bind(exchange='direct_logs',
+                                queue=self.worker_queue,
+                                routing_key=common.make_key_worker(
+                                    self.server_name, self.node,
+                                    self.number))
+        self.channel.basic_consume(common.decompressing(self.reply_request),
+                                   queue=self.worker_queue,
+                                   no_ack=True)
+
+    def reply_request(self, ch, method, properties, body):
+        '''Reply to create game request forwarded by game list.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
+        LOG.debug('Processing worker request.')
+        LOG.debug('Received message: %s', body)
+        request = serverlib.decode_request(body)
+        codec_name = serverlib.get_forwarded_codec(properties)
+        if request is None or request.type != common.REQ_CREATE_GAME or\
+            codec_name is None:
+            response = serverlib.make_rsp_invalid_request()
+        else:
+            response = self.create_game(request.game_name,
+                                        request.client_name, request.width,
+                                        request.height, properties.reply_to,
+                                        codec_name)
 
         # Sending response
-        ch.basic_publish(exchange='direct_logs',
-                         routing_key=properties.reply_to,
-                         body=response)
-        LOG.debug('Sent response to client: %s', response)
+        serverlib.send_response(ch, response, properties,
+                                {properties.reply_to: codec_name})
+
+class Registration(object):
+    '''Lease of server in the directory. Lease is renewed in its second half,
+    at random time so that renewals of servers spread out. Failed
+    registration is repeated with growing delay.
+    '''
+    def __init__(self, channel, transport, server_name, node):
+        '''Set communication and start renewing thread.
+        @param channel: pika connection channel, consumed by the server
+        @param transport: transport opening channel of the renewing thread
+        @param server_name: name of server
+        @param node: name of server node
+        '''
+        self.server_name = server_name
+        self.node = node
+        self.lease = DEFAULT_LEASE
+        self.acknowledged = threading.Event()
+        self.stopped = threading.Event()
+
+        # Communication, acknowledgements are received by the server channel
+        self.channel = channel
+        self.reply_queue = channel.queue_declare(exclusive=True).method.queue
+        self.channel.queue_bind(exchange='direct_logs',
+                                queue=self.reply_queue,
+                                routing_key=self.reply_queue)
+        self.channel.basic_consume(common.decompressing(self.on_registered),
+                                   queue=self.reply_queue,
+                                   no_ack=True)
+
+        self.thread = threading.Thread(target=self.run,
+                                       args=(transport.channel(),),
+                                       name='Registration')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def on_registered(self, ch, method, properties, body):
+        '''Directory acknowledged registration.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
+        msg_parts = body.split(common.SEP)
+        if msg_parts[0] != common.RSP_REGISTERED:
+            return
+        try:
+            self.lease = float(msg_parts[1])
+        except (IndexError, ValueError):
+            return
+        self.acknowledged.set()
+
+    def run(self, channel):
+        '''Renew lease until stopped.
+        @param channel: channel of the renewing thread
+        '''
+        retry = RETRY_MIN
+        while not self.stopped.is_set():
+            self.acknowledged.clear()
+            start = time.time()
+            send_message(channel, clientlib.make_req_register(
+                self.server_name, self.node), common.make_key_directory(),
+                         self.reply_queue)
+            if self.acknowledged.wait(REGISTER_TIMEOUT):
+                retry = RETRY_MIN
+                delay = self.lease * random.uniform(0.5, 0.75) -\
+                    (time.time() - start)
+            else:
+                LOG.debug('Directory did not acknowledge registration.')
+                delay = retry * random.uniform(0.5, 1.0)
+                retry = min(retry * 2, RETRY_MAX)
+            self.stopped.wait(max(delay, 0))
+
+    def stop(self):
+        '''Stop renewing and remove lease.
+        '''
+        self.stopped.set()
+        send_message(self.channel, clientlib.make_req_unregister(
+            self.server_name, self.node), common.make_key_directory())
 
 # Functions -------------------------------------------------------------------
 def __info():
     return '%s version %s (%s)' % (___NAME, ___VER, ___BUILT)
 
-def publish_server_advertisements(server_on, channel, server_name, interval=2):
-    '''Publishes server adverts periodically.
-    @param server_on: indicate server running
-    @param channel: pika.BlockingChannel
-    @param server_name: name of server
-    @param interval: interval for publishing
+def start_server(transport, server_args):
+    '''Open channel and create client connections and list of games.
+    @param transport: transport opening channels
+    @param server_args: arguments of server
+    @return tuple (channel, Clients, GameList)
     '''
-    while server_on[0]:
-        channel.basic_publish(exchange='direct_logs',
-                              routing_key=common.make_key_server_advert(),
-                              body=server_name)
-        sleep(interval)
+    channel = transport.channel()
+    cluster = getattr(server_args, 'cluster', False)
+
+    # Client connections
+    clients = Clients(channel, server_args.name, cluster)
+
+    # Dict of games
+    game_list = GameList(channel, server_args, clients, transport)
+
+    # Restoring clients and games from the event log
+    log_dir = getattr(server_args, 'log_dir', None)
+    if log_dir is not None:
+        open_log(EventLog(log_dir,
+                          archive=getattr(server_args, 'archive_log', False)),
+                 clients, game_list)
+
+    # Sharing clients and games with other nodes
+    if cluster:
+        clients.cluster = Cluster(channel, server_args.name, server_args.node,
+                                  clients, game_list)
+
+    return channel, clients, game_list
 
-def stop_server(channel, server_name):
-    '''Publishes server advert about stopping server.
+def recover(log, clients, game_host):
+    '''Rebuild clients and games from the last checkpoint and the records
+    written after it.
+    @param log: EventLog, not started
+    @param clients: Clients, or None
+    @param game_host: GameHost
+    '''
+    records = 0
+    for record in log.read():
+        records += 1
+        kind = record[0]
+        try:
+            if kind == eventlog.LOG_CLIENTS and clients is not None:
+                clients.client_set = set(record[1])
+                clients.codecs = record[2]
+            elif kind == eventlog.LOG_CONNECT and clients is not None:
+                clients.client_set.add(record[1])
+                if record[3] is not None:
+                    clients.codecs[record[2]] = record[3]
+            elif kind == eventlog.LOG_DISCONNECT and clients is not None:
+                clients.client_set.discard(record[1])
+                clients.codecs.pop(record[2], None)
+            elif kind == eventlog.LOG_GAME:
+                if record[1] not in game_host.games:
+                    game_host.restore_game(*record[1:5])
+            elif kind == eventlog.LOG_END:
+                game_host.games.pop(record[1], None)
+            elif kind == eventlog.LOG_SNAPSHOT:
+                name, width, height, snapshot = record[1:5]
+                game = game_host.restore_game(name, snapshot['owner'], width,
+                                              height)
+                game.load_snapshot(snapshot)
+            elif kind == eventlog.LOG_MUTATION:
+                game = game_host.games.get(record[1])
+                if game is not None:
+                    game.replay(record[2], record[3], record[4:])
+        except (KeyError, IndexError, TypeError, ValueError):
+            LOG.exception('Invalid log record %s.', kind)
+    LOG.info('Recovered %d games from %d log records.',
+             len(game_host.games), records)
+
+def checkpoint(clients, game_host):
+    '''Append snapshots of clients and games to the event log.
+    @param clients: Clients, or None
+    @param game_host: GameHost
+    '''
+    if clients is not None:
+        clients.checkpoint()
+    game_host.checkpoint()
+
+def open_log(log, clients, game_host):
+    '''Recover from the event log, start logging and start restored games.
+    @param log: EventLog
+    @param clients: Clients, or None
+    @param game_host: GameHost
+    '''
+    recover(log, clients, game_host)
+    # Games without clients would never end
+    for name, game in game_host.games.items():
+        if isinstance(game, Game) and not game.client_queues:
+            del game_host.games[name]
+    if clients is not None:
+        clients.log = log
+    game_host.log = log
+    log.start(lambda: checkpoint(clients, game_host))
+    game_host.start_restored_games()
+
+def worker_number(game_name, workers):
+    '''Choose worker process of game by hash of its name.
+    @param game_name: name of game
+    @param workers: number of workers
+    @return number of worker
+    '''
+    return zlib.crc32(game_name) % workers
+
+def run_worker(transport, server_args, number):
+    '''Run games of worker process until interrupted.
+    @param transport: transport opening channels
+    @param server_args: arguments of server
+    @param number: number of worker
+    '''
+    channel = transport.channel()
+    worker = Worker(channel, server_args, transport, number)
+    log_dir = getattr(server_args, 'log_dir', None)
+    if log_dir is not None:
+        open_log(EventLog(os.path.join(log_dir, 'worker-%d' % number),
+                          archive=getattr(server_args, 'archive_log', False)),
+                 None, worker)
+    try:
+        while True:
+            channel.start_consuming()
+    except KeyboardInterrupt as e:
+        LOG.info('Terminating worker %d ...', number)
+    # Games are kept in the event log to be restored on next start
+    if worker.log is not None:
+        worker.log.stop()
+    stop_games(channel, worker)
+
+def start_workers(transport, server_args):
+    '''Start worker processes running games.
+    @param transport: transport opening channels, must connect to broker
+                      shared by processes
+    @param server_args: arguments of server
+    @return list of multiprocessing.Process
+    '''
+    workers = []
+    for number in range(server_args.workers):
+        worker = multiprocessing.Process(target=run_worker,
+                                         args=(transport, server_args,
+                                               number),
+                                         name='Worker %d' % number)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+def stop_games(channel, game_list):
+    '''Send message to all games control queues to stop consuming.
     @param channel: pika.BlockingChannel
-    @param server_name: name of server
+    @param game_list: GameList
     '''
-    channel.basic_publish(exchange='direct_logs',
-                          routing_key=common.make_key_server_stop(),
-                          body=server_name)
+    for game in game_list.games.values():
+        if not isinstance(game, Game):
+            continue
+        channel.basic_publish(exchange='direct_logs',
+                              routing_key=game.control_queue,
+                              body='')
 
 # Main function ---------------------------------------------------------------
 if __name__ == '__main__':
@@ -296,28 +1034,32 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--name',
                         help='Server name.',
                         required=True)
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='Number of worker processes running games, '
+                        'defaults to 0 to run games in the server process')
+    parser.add_argument('-C', '--cluster', action='store_true',
+                        help='Serve the server name together with other '
+                        'servers started with this option')
+    parser.add_argument('-l', '--log-dir',
+                        help='Directory of event log, clients and games are '
+                        'restored from it on start')
+    parser.add_argument('-a', '--archive-log', action='store_true',
+                        help='Archive rotated segments of event log to keep '
+                        'whole history of games for replay.py')
     args = parser.parse_args()
+    args.node = uuid.uuid4().hex[:12]
+    transport = PikaTransport(args.host, args.port)
 
-    # Connection
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=args.host, port=args.port)
-    )
-    channel = connection.channel()
-    channel.exchange_declare(exchange='direct_logs', type='direct')
-
-    # Client connections
-    clients = Clients(channel, args.name)
+    # Connection, client connections and dict of games
+    channel, clients, game_list = start_server(transport, args)
 
-    # Server advertisements
-    server_on = [True]
-    t = threading.Thread(target=publish_server_advertisements,
-                         args=(server_on, channel, args.name))
-    t.setDaemon(True)
-    t.start()
-    LOG.debug('Started server advertising.')
+    # Worker processes are started once the server follows game adverts,
+    # so games they restore are listed
+    workers = start_workers(transport, args)
 
-    # Dict of games
-    game_list = GameList(channel, args, clients)
+    # Lease in the directory of servers
+    registration = Registration(channel, transport, args.name, args.node)
+    LOG.debug('Started server registration.')
 
     try:
         while True:
@@ -326,12 +1068,16 @@ if __name__ == '__main__':
         LOG.debug('Crtrl+C issued ...')
         LOG.info('Terminating server ...')
 
-    server_on[0] = False
-    stop_server(channel, args.name)
-    LOG.debug('Stopped advertising.')
+    # Other nodes of cluster keep the server listed until they stop too
+    registration.stop()
+    LOG.debug('Stopped registration.')
+    # Games are kept in the event log to be restored on next start
+    if game_list.log is not None:
+        game_list.log.stop()
 
-    # Send message to all games control queues to stop consuming.
-    for game in game_list.games.values():
-        channel.basic_publish(exchange='direct_logs',
-                              routing_key=game.control_queue,
-                              body='')
+    # Stop all games, workers stop their games on interrupt
+    if workers:
+        for worker in workers:
+            worker.join()
+    else:
+        stop_games(channel, game_list)
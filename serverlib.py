@@ -5,9 +5,12 @@ Created on Tue Dec 13 14:51:28 2016
 @author: pavla
 """
 # Imports ---------------------------------------------------------------------
+import collections
 import functools
 import logging
+import pika
 # Custom imports --------------------------------------------------------------
+import codec
 import common
 # Logging ---------------------------------------------------------------------
 LOG = logging.getLogger(__name__)
@@ -20,8 +23,11 @@ def do_str(func):
     return wrapped
 
 @do_str
-def make_rsp_connected(server_name, client_name):
-    return common.RSP_CONNECTED, server_name, client_name
+def make_rsp_connected(server_name, client_name, codec=None):
+    if codec is None:
+        return common.RSP_CONNECTED, server_name, client_name
+    else:
+        return common.RSP_CONNECTED, server_name, client_name, codec
 
 @do_str
 def make_rsp_disconnected():
@@ -32,12 +38,12 @@ def make_rsp_username_taken():
     return common.RSP_USERNAME_TAKEN,
 
 @do_str
-def make_rsp_list_opened(game_names):
-    return [common.RSP_LIST_OPENED] + game_names
+def make_rsp_list_opened(total, offset, game_names):
+    return [common.RSP_LIST_OPENED, str(total), str(offset)] + game_names
 
 @do_str
-def make_rsp_list_closed(game_names):
-    return [common.RSP_LIST_CLOSED] + game_names
+def make_rsp_list_closed(total, offset, game_names):
+    return [common.RSP_LIST_CLOSED, str(total), str(offset)] + game_names
 
 @do_str
 def make_rsp_game_entered(game_name, is_owner):
@@ -94,6 +100,19 @@ def make_rsp_all_fields(all_fields):
 def make_rsp_hits(hits):
     return [common.RSP_HITS] + hits
 
+@do_str
+def make_rsp_player_order(player_order):
+    return [common.RSP_PLAYER_ORDER] + player_order
+
+@do_str
+def make_rsp_game_state(version, responses):
+    return [common.RSP_GAME_STATE, str(version)] +\
+        common.pack_messages(responses)
+
+@do_str
+def make_rsp_changes(version, events):
+    return [common.RSP_CHANGES, str(version)] + common.pack_messages(events)
+
 @do_str
 def make_rsp_spectator(spectator):
     return common.RSP_SPECTATOR, str(spectator)
@@ -102,6 +121,10 @@ def make_rsp_spectator(spectator):
 def make_rsp_spectator_queue(spectator_queue):
     return common.RSP_SPECTATOR_QUEUE, spectator_queue
 
+@do_str
+def make_rsp_keyframe(version, events):
+    return [common.RSP_KEYFRAME, str(version)] + common.pack_messages(events)
+
 @do_str
 def make_rsp_ready():
     return common.RSP_READY,
@@ -130,6 +153,10 @@ def make_rsp_hit(client_name, opponent_name, row, column):
 def make_rsp_miss(client_name, opponent_name, row, column):
     return common.RSP_MISS, client_name, opponent_name, str(row), str(column)
 
+@do_str
+def make_rsp_batch(responses):
+    return [common.RSP_BATCH] + common.pack_messages(responses)
+
 @do_str
 def make_rsp_ok():
     return common.RSP_OK,
@@ -142,6 +169,109 @@ def make_rsp_permission_denied():
 def make_rsp_invalid_request():
     return common.RSP_INVALID_REQUEST,
 
+def send_response(channel, response, properties, codecs):
+    '''Send response to the queue expecting reply, encoded by the codec
+    negotiated for the queue.
+    @param channel: pika communication channel
+    @param response: String, text response
+    @param properties: pika.spec.BasicProperties of the request
+    @param codecs: dict of queues and their codecs
+    '''
+    body = response
+    if codecs.get(properties.reply_to) == codec.CODEC_BINARY:
+        body = codec.encode(response)
+    body, encoding = common.compress(body)
+    channel.basic_publish(
+        exchange='direct_logs', routing_key=properties.reply_to,
+        properties=pika.BasicProperties(
+            correlation_id=properties.correlation_id,
+            content_encoding=encoding),
+        body=body)
+    LOG.debug('Sent response to client: %s', response)
+
+class Forward(object):
+    '''Request is answered by another consumer, to which it is forwarded.
+    '''
+    def __init__(self, routing_key):
+        '''Set routing key of the consumer.
+        @param routing_key: routing key
+        '''
+        self.routing_key = routing_key
+
+def forward_request(channel, body, properties, routing_key, codec_name):
+    '''Forward request to another consumer, which replies to the client.
+    @param channel: pika communication channel
+    @param body: String, request
+    @param properties: pika.spec.BasicProperties of the request
+    @param routing_key: routing key of the consumer
+    @param codec_name: codec of the client
+    '''
+    body, encoding = common.compress(body)
+    channel.basic_publish(
+        exchange='direct_logs', routing_key=routing_key,
+        properties=pika.BasicProperties(
+            reply_to=properties.reply_to,
+            correlation_id=properties.correlation_id,
+            headers={'codec': codec_name},
+            content_encoding=encoding),
+        body=body)
+    LOG.debug('Forwarded request to "%s"', routing_key)
+
+def get_forwarded_codec(properties):
+    '''Get codec of client from forwarded request.
+    @param properties: pika.spec.BasicProperties
+    @return codec name, or None if request was not forwarded
+    '''
+    if not properties.headers:
+        return None
+    return properties.headers.get('codec')
+
+class ResponseCache(object):
+    '''Bounded cache of responses to requests by their correlation ids, the
+    oldest responses are dropped first.
+    '''
+    def __init__(self, length):
+        '''Set maximal number of responses and cached responses.
+        @param length: maximal number of responses
+        '''
+        self.length = length
+        self.responses = collections.OrderedDict()
+
+    def key(self, properties, index=None):
+        '''Get key of request.
+        @param properties: pika.spec.BasicProperties of the request
+        @param index: index of request in batch, None if not in batch
+        @return tuple (reply queue, correlation id, index), or None if request
+                has no correlation id
+        '''
+        if properties is None or properties.correlation_id is None:
+            return None
+        return properties.reply_to, properties.correlation_id, index
+
+    def get(self, properties, index=None):
+        '''Get response to request answered before.
+        @param properties: pika.spec.BasicProperties of the request
+        @param index: index of request in batch, None if not in batch
+        @return String, response, or None
+        '''
+        key = self.key(properties, index)
+        if key is None:
+            return None
+        return self.responses.get(key)
+
+    def put(self, properties, response, index=None):
+        '''Remember response to request.
+        @param properties: pika.spec.BasicProperties of the request
+        @param response: String, response
+        @param index: index of request in batch, None if not in batch
+        '''
+        key = self.key(properties, index)
+        if key is None:
+            return
+        self.responses[key] = response
+        if len(self.responses) > self.length:
+            self.responses.popitem(last=False)
+
 # Game event functions --------------------------------------------------------
 @do_str
 def make_e_new_player(player):
@@ -171,10 +301,18 @@ def make_e_on_turn(on_turn):
 def make_e_hit(client_name, opponent_name, row, column):
     return common.E_HIT, client_name, opponent_name, str(row), str(column)
 
+@do_str
+def make_e_miss(client_name, opponent_name, row, column):
+    return common.E_MISS, client_name, opponent_name, str(row), str(column)
+
 @do_str
 def make_e_sink(player, ship_parts):
     return [common.E_SINK, player] + ship_parts
 
+@do_str
+def make_e_keyframe(all_fields):
+    return [common.E_KEYFRAME] + all_fields
+
 @do_str
 def make_e_player_end(player):
     return common.E_PLAYER_END, player
@@ -194,3 +332,167 @@ def make_e_game_close(game_name):
 @do_str
 def make_e_game_end(game_name):
     return common.E_GAME_END, game_name
+
+# Directory message functions -------------------------------------------------
+@do_str
+def make_rsp_registered(lease):
+    return common.RSP_REGISTERED, '%.3f' % lease
+
+@do_str
+def make_rsp_list_servers(version, server_names):
+    return [common.RSP_LIST_SERVERS, str(version)] + server_names
+
+@do_str
+def make_e_server_join(server_name):
+    return common.E_SERVER_JOIN, server_name
+
+@do_str
+def make_e_server_leave(server_name):
+    return common.E_SERVER_LEAVE, server_name
+
+@do_str
+def make_e_server_expire(server_name):
+    return common.E_SERVER_EXPIRE, server_name
+
+# Cluster message functions ---------------------------------------------------
+@do_str
+def make_cluster_hello(node):
+    return common.CLUSTER_HELLO, node
+
+@do_str
+def make_cluster_clients(node, clients):
+    return [common.CLUSTER_CLIENTS, node] + clients
+
+@do_str
+def make_cluster_codecs(node, codecs):
+    return [common.CLUSTER_CODECS, node] + codecs
+
+@do_str
+def make_cluster_client_left(node, client_name, client_queue):
+    return common.CLUSTER_CLIENT_LEFT, node, client_name, client_queue
+
+@do_str
+def make_cluster_games(node, games):
+    return [common.CLUSTER_GAMES, node] + games
+
+# Request parsing -------------------------------------------------------------
+class Request(object):
+    '''Request decoded once from the message body, with typed fields.
+    '''
+    __slots__ = ('type', 'client_name', 'opponent_name', 'game_name', 'row',
+                 'column', 'width', 'height', 'version', 'items')
+
+    def __init__(self, request_type):
+        '''Initialize - type of request, all fields empty.
+        @param request_type: type of request
+        '''
+        self.type = request_type
+        self.client_name = None
+        self.opponent_name = None
+        self.game_name = None
+        self.row = None
+        self.column = None
+        self.width = None
+        self.height = None
+        self.version = None
+        self.items = None
+
+def name(value):
+    '''Convert name, empty names are invalid.
+    @param value: String
+    @return String, stripped name
+    '''
+    value = value.strip()
+    if value == '':
+        raise ValueError('Empty name')
+    return value
+
+def text(value):
+    '''Convert text, it is kept as it is.
+    @param value: String
+    @return String
+    '''
+    return value
+
+# Request type -> (fields with their conversions, whether list of items
+# follows the fields)
+REQUEST_FORMATS = {
+    common.REQ_CONNECT: ((('client_name', name),), True),
+    common.REQ_DISCONNECT: ((('client_name', text),), False),
+    common.REQ_LIST_OPENED: ((), True),
+    common.REQ_LIST_CLOSED: ((), True),
+    common.REQ_CREATE_GAME: ((('game_name', name), ('client_name', text),
+                              ('width', int), ('height', int)), False),
+    common.REQ_JOIN_GAME: ((('game_name', text), ('client_name', text)),
+                           False),
+    common.REQ_SPECTATE_GAME: ((('game_name', text), ('client_name', text)),
+                               False),
+    common.REQ_LEAVE_GAME: ((('client_name', text),), False),
+    common.REQ_GET_DIMENSIONS: ((), False),
+    common.REQ_GET_PLAYERS: ((), False),
+    common.REQ_GET_PLAYERS_READY: ((), False),
+    common.REQ_GET_OWNER: ((), False),
+    common.REQ_GET_TURN: ((), False),
+    common.REQ_GET_FIELD: ((('client_name', text),), False),
+    common.REQ_GET_ALL_FIELDS: ((('client_name', text),), False),
+    common.REQ_GET_SPECTATOR: ((('client_name', text),), False),
+    common.REQ_GET_SPECTATOR_QUEUE: ((('client_name', text),), False),
+    common.REQ_GET_KEYFRAME: ((('client_name', text),), False),
+    common.REQ_GET_HITS: ((('client_name', text),), False),
+    common.REQ_GET_GAME_STATE: ((('client_name', text),), False),
+    common.REQ_GET_CHANGES: ((('client_name', text), ('version', int)),
+                             False),
+    common.REQ_SET_READY: ((('client_name', text),), True),
+    common.REQ_KICK_OUT: ((('client_name', text), ('opponent_name', text)),
+                          False),
+    common.REQ_START_GAME: ((('client_name', text),), False),
+    common.REQ_SHOOT: ((('client_name', text), ('opponent_name', text),
+                        ('row', int), ('column', int)), False),
+    common.REQ_RESTART_SESSION: ((), False),
+    common.REQ_BATCH: ((), True),
+}
+
+def parse_request(msg_parts):
+    '''Decode request, check its arity and types of its fields.
+    @param msg_parts: message split by separator
+    @return Request, or None if request is unknown or invalid
+    '''
+    request_format = REQUEST_FORMATS.get(msg_parts[0])
+    if request_format is None:
+        return None
+    fields, has_items = request_format
+    if len(msg_parts) - 1 < len(fields) or\
+        (not has_items and len(msg_parts) - 1 != len(fields)):
+        return None
+
+    request = Request(msg_parts[0])
+    try:
+        for (field, conversion), value in zip(fields, msg_parts[1:]):
+            setattr(request, field, conversion(value))
+    except ValueError:
+        return None
+    if has_items:
+        request.items = msg_parts[len(fields) + 1:]
+    return request
+
+def decode_request(body):
+    '''Decode request body of either codec.
+    @param body: str, message
+    @return Request, or None if body is malformed or request is invalid
+    '''
+    try:
+        msg_parts = codec.decode(body)
+    except ValueError:
+        return None
+    return parse_request(msg_parts)
+
+def parse_batch(request):
+    '''Decode requests of batch request, batches may not be nested.
+    @param request: Request of batch
+    @return list of Request, None for invalid requests and nested batches
+    @raise ValueError: if items of batch are not packed messages
+    '''
+    requests = [parse_request(msg_parts)
+                for msg_parts in common.unpack_messages(request.items)]
+    return [None if item is not None and item.type == common.REQ_BATCH
+            else item for item in requests]
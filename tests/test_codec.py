@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of codec.
+"""
+# Imports ---------------------------------------------------------------------
+import unittest
+# Custom imports --------------------------------------------------------------
+import codec
+import common
+from common import SEP, FIELD_SEP
+# Constants -------------------------------------------------------------------
+MESSAGES = [
+    SEP.join([common.REQ_SHOOT, 'alice', 'bob', '2', '3']),
+    SEP.join([common.REQ_SET_READY, 'alice', '0' + FIELD_SEP + '1',
+              '9' + FIELD_SEP + '300']),
+    SEP.join([common.RSP_HITS,
+              FIELD_SEP.join(['bob', '1', '2', common.FIELD_SHIP]),
+              FIELD_SEP.join(['bob', '0', '0', common.FIELD_WATER])]),
+    SEP.join([common.RSP_ALL_FIELDS, 'alice',
+              FIELD_SEP.join(['1', '1', common.FIELD_HIT_SHIP]),
+              FIELD_SEP.join(['4', '1000', common.FIELD_SINK_SHIP]),
+              'bob']),
+    # Numbers with leading zeros, empty parts and unknown items stay text
+    SEP.join([common.RSP_DIMENSIONS, '007', '', '123456789']),
+    SEP.join([common.RSP_HITS, FIELD_SEP.join(['bob', '1', '2', 'boat'])]),
+    common.RSP_OK,
+]
+# Tests -----------------------------------------------------------------------
+class RoundTripTest(unittest.TestCase):
+    '''Messages decode to the same parts in both codecs.
+    '''
+    def test_text(self):
+        for message in MESSAGES:
+            self.assertFalse(codec.is_binary(message))
+            self.assertEqual(codec.decode(message), message.split(SEP))
+
+    def test_binary(self):
+        for message in MESSAGES:
+            body = codec.encode(message)
+            self.assertTrue(codec.is_binary(body))
+            self.assertEqual(codec.decode(body), message.split(SEP))
+
+    def test_unknown_keyword(self):
+        message = SEP.join(['no such keyword', '1'])
+        self.assertEqual(codec.encode(message), message)
+
+    def test_binary_is_shorter(self):
+        message = SEP.join([common.RSP_HITS] + [
+            FIELD_SEP.join(['bob', str(i), str(i), common.FIELD_SHIP])
+            for i in range(100)])
+        self.assertLess(len(codec.encode(message)), len(message))
+
+class MalformedTest(unittest.TestCase):
+    '''Malformed binary messages raise ValueError.
+    '''
+    def test_truncated(self):
+        # Prefix ending between runs is a valid shorter message
+        for message in MESSAGES:
+            body = codec.encode(message)
+            parts = message.split(SEP)
+            for end in range(1, len(body)):
+                try:
+                    decoded = codec.decode(body[:end])
+                except ValueError:
+                    continue
+                self.assertEqual(decoded, parts[:len(decoded)])
+                self.assertLess(len(decoded), len(parts))
+
+    def test_magic_only(self):
+        self.assertRaises(ValueError, codec.decode, codec.BINARY_MAGIC)
+
+    def test_truncated_text(self):
+        body = codec.encode(SEP.join([common.REQ_SHOOT, 'alice', 'bob',
+                                      '2', '3']))
+        # Keyword and tag, count and length of the first text are kept
+        self.assertRaises(ValueError, codec.decode, body[:6])
+
+    def test_truncated_varint(self):
+        body = codec.encode(SEP.join([common.RSP_DIMENSIONS, '300']))
+        self.assertRaises(ValueError, codec.decode, body[:-1])
+
+    def test_unknown_opcode(self):
+        body = codec.BINARY_MAGIC + chr(len(codec.KEYWORDS))
+        self.assertRaises(ValueError, codec.decode, body)
+
+    def test_unknown_tag(self):
+        body = codec.encode(common.RSP_OK) + '\x07\x01\x00'
+        self.assertRaises(ValueError, codec.decode, body)
+
+    def test_unknown_item(self):
+        body = codec.encode(SEP.join([
+            common.RSP_ALL_FIELDS, FIELD_SEP.join(['1', '1',
+                                                   common.FIELD_SHIP])]))
+        for code in (0, len(common.Field.ITEMS)):
+            self.assertRaises(ValueError, codec.decode,
+                              body[:-1] + chr(code))
+
+if __name__ == '__main__':
+    unittest.main()
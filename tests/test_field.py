@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of common.Field.
+"""
+# Imports ---------------------------------------------------------------------
+import base64
+import random
+import unittest
+import zlib
+# Custom imports --------------------------------------------------------------
+import common
+from common import Field
+# Tests -----------------------------------------------------------------------
+class FieldStorageTest(unittest.TestCase):
+    '''Items stored as codes of bytearray with running counts.
+    '''
+    def setUp(self):
+        self.field = Field(4, 3)
+
+    def test_empty(self):
+        self.assertEqual(len(self.field.grid), 12)
+        self.assertEqual(self.field.counts[0], 12)
+        self.assertEqual(self.field.get_item(0, 0), None)
+        self.assertEqual(self.field.count_items(common.FIELD_SHIP), 0)
+        self.assertEqual(list(self.field.items()), [])
+
+    def test_add_and_count(self):
+        self.assertTrue(self.field.add_item(0, 1, common.FIELD_SHIP))
+        self.assertTrue(self.field.add_item(2, 3, common.FIELD_SHIP))
+        self.assertTrue(self.field.add_item(1, 0, common.FIELD_WATER))
+        self.assertEqual(self.field.get_item(2, 3), common.FIELD_SHIP)
+        self.assertEqual(self.field.count_items(common.FIELD_SHIP), 2)
+        self.assertEqual(self.field.count_items(common.FIELD_WATER), 1)
+        self.assertEqual(self.field.counts[0], 9)
+
+    def test_replace_keeps_counts(self):
+        self.field.add_item(1, 1, common.FIELD_SHIP)
+        self.field.add_item(1, 1, common.FIELD_WATER)
+        self.assertEqual(self.field.count_items(common.FIELD_SHIP), 0)
+        self.assertEqual(self.field.count_items(common.FIELD_WATER), 1)
+        self.assertEqual(sum(self.field.counts), 12)
+
+    def test_out_of_field(self):
+        for row, column in ((-1, 0), (0, -1), (3, 0), (0, 4)):
+            self.assertFalse(self.field.add_item(row, column,
+                                                 common.FIELD_SHIP))
+            self.assertEqual(self.field.get_item(row, column), None)
+        self.assertFalse(self.field.remove_item(3, 0))
+        self.assertEqual(self.field.counts[0], 12)
+
+    def test_unknown_item(self):
+        self.assertFalse(self.field.add_item(0, 0, 'boat'))
+        self.assertEqual(self.field.count_items('boat'), 0)
+        self.assertEqual(self.field.get_item(0, 0), None)
+
+    def test_remove(self):
+        self.assertFalse(self.field.remove_item(0, 0))
+        self.field.add_item(0, 0, common.FIELD_SHIP)
+        self.assertTrue(self.field.remove_item(0, 0))
+        self.assertEqual(self.field.get_item(0, 0), None)
+        self.assertEqual(self.field.count_items(common.FIELD_SHIP), 0)
+        self.assertEqual(self.field.counts[0], 12)
+
+    def test_change(self):
+        self.field.add_item(2, 2, common.FIELD_SHIP)
+        self.assertFalse(self.field.change_item(
+            2, 2, common.FIELD_WATER, common.FIELD_HIT_SHIP))
+        self.assertFalse(self.field.change_item(
+            0, 0, common.FIELD_SHIP, common.FIELD_HIT_SHIP))
+        self.assertTrue(self.field.change_item(
+            2, 2, common.FIELD_SHIP, common.FIELD_HIT_SHIP))
+        self.assertEqual(self.field.get_item(2, 2), common.FIELD_HIT_SHIP)
+        self.assertEqual(self.field.count_items(common.FIELD_SHIP), 0)
+        self.assertEqual(self.field.count_items(common.FIELD_HIT_SHIP), 1)
+
+    def test_items_in_row_major_order(self):
+        self.field.add_item(2, 0, common.FIELD_SHIP)
+        self.field.add_item(0, 3, common.FIELD_SHIP)
+        self.field.add_item(1, 2, common.FIELD_WATER)
+        self.assertEqual(list(self.field.items(common.FIELD_SHIP)),
+                         [((0, 3), common.FIELD_SHIP),
+                          ((2, 0), common.FIELD_SHIP)])
+        self.assertEqual(len(list(self.field.items())), 3)
+        self.assertEqual(self.field.get_all_items(common.FIELD_WATER),
+                         [common.FIELD_SEP.join(['1', '2',
+                                                 common.FIELD_WATER])])
+
+    def test_dirty_positions(self):
+        self.field.add_item(0, 0, common.FIELD_SHIP)
+        self.assertEqual(self.field.pop_dirty(), [])
+        self.field.track()
+        self.field.add_item(1, 1, common.FIELD_SHIP)
+        self.field.add_item(0, 0, common.FIELD_SHIP)
+        self.field.remove_item(0, 0)
+        self.assertEqual(self.field.pop_dirty(),
+                         [((0, 0), None), ((1, 1), common.FIELD_SHIP)])
+        self.assertEqual(self.field.pop_dirty(), [])
+
+class FieldDumpTest(unittest.TestCase):
+    '''Dumps of fields load back, invalid dumps are rejected.
+    '''
+    def random_field(self, width, height, items, number):
+        field = Field(width, height)
+        rng = random.Random(number)
+        for index in rng.sample(xrange(width * height), number):
+            field.add_item(index // width, index % width, rng.choice(items))
+        return field
+
+    def assertLoads(self, field, dump):
+        loaded = Field.load(field.width, field.height, dump)
+        self.assertEqual(loaded.grid, field.grid)
+        self.assertEqual(loaded.counts, field.counts)
+
+    def test_map(self):
+        field = self.random_field(30, 20, [common.FIELD_SHIP,
+                                           common.FIELD_WATER,
+                                           common.FIELD_HIT_SHIP], 300)
+        dump = field.dump()
+        self.assertTrue(dump.startswith('map:'))
+        self.assertLoads(field, dump)
+
+    def test_bit(self):
+        field = self.random_field(100, 100, [common.FIELD_SHIP], 3000)
+        dump = field.dump()
+        self.assertTrue(dump.startswith('bit:'))
+        self.assertLoads(field, dump)
+        # Bitmap is padded to whole bytes
+        field = self.random_field(3, 3, [common.FIELD_WATER], 5)
+        self.assertLoads(field, field.dump_bits(
+            Field.CODES[common.FIELD_WATER]))
+
+    def test_rle(self):
+        field = Field(100, 100)
+        field.add_item(5, 5, common.FIELD_SHIP)
+        field.add_item(50, 7, common.FIELD_WATER)
+        dump = field.dump()
+        self.assertTrue(dump.startswith('rle:'))
+        self.assertLoads(field, dump)
+
+    def test_empty(self):
+        field = Field(10, 10)
+        self.assertLoads(field, field.dump())
+
+    def test_export(self):
+        for number in (10, 500):
+            field = self.random_field(40, 40, [common.FIELD_SHIP,
+                                               common.FIELD_WATER], number)
+            parts = field.export()
+            self.assertEqual(len(parts) == 1, number > common.MAX_ITEM_PARTS)
+            other = Field(40, 40)
+            other.add_parts(parts)
+            self.assertEqual(other.grid, field.grid)
+
+    def assertRejects(self, dump, width=4, height=3):
+        self.assertRaises(ValueError, Field.load, width, height, dump)
+
+    def test_wrong_size(self):
+        self.assertRejects('map:' + base64.b64encode(zlib.compress('\0' * 11)))
+        self.assertRejects('map:' + base64.b64encode(zlib.compress('\0' * 13)))
+        self.assertRejects('rle:11*0')
+        self.assertRejects('rle:12*0,1')
+        self.assertRejects('bit:2:' + base64.b64encode(zlib.compress('\0')))
+        self.assertRejects('bit:2:' + base64.b64encode(
+            zlib.compress('\0' * 3)))
+
+    def test_bounds_before_allocation(self):
+        # Sizes are checked before the grid is made
+        self.assertRejects('rle:100000000000*2', 1000, 1000)
+        self.assertRejects('rle:-5*0,17*0')
+        self.assertRejects('map:' + base64.b64encode(
+            zlib.compress('\0' * 10 ** 7)), 1000, 1000)
+        self.assertRejects('bit:2:' + base64.b64encode(
+            zlib.compress('\0' * 10 ** 6)), 1000, 1000)
+
+    def test_unknown_items(self):
+        self.assertRejects('map:' + base64.b64encode(zlib.compress(
+            '\0' * 11 + chr(len(Field.ITEMS)))))
+        self.assertRejects('rle:11*0,%d' % len(Field.ITEMS))
+        self.assertRejects('bit:%d:' % len(Field.ITEMS) + base64.b64encode(
+            zlib.compress('\xff\xff')))
+
+    def test_malformed(self):
+        self.assertRejects('')
+        self.assertRejects('dots:....')
+        self.assertRejects('map:!')
+        self.assertRejects('map:' + base64.b64encode('not zlib'))
+        self.assertRejects('rle:x*1')
+        self.assertRejects('rle:12*')
+        self.assertRejects('bit:x:' + base64.b64encode(zlib.compress('\0')))
+        self.assertRejects('bit:2')
+
+if __name__ == '__main__':
+    unittest.main()
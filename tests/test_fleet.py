@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of game.Fleet.
+"""
+# Imports ---------------------------------------------------------------------
+import unittest
+# Custom imports --------------------------------------------------------------
+from game import Fleet
+# Tests -----------------------------------------------------------------------
+class FleetTest(unittest.TestCase):
+    '''Ships labeled by flood fill, sinking found from the labels.
+    '''
+    def test_connected_ships(self):
+        # Two ships, horizontal and L-shaped, and one single part
+        fleet = Fleet(5, 4, [(0, 0), (0, 1), (0, 2),
+                             (2, 1), (3, 1), (3, 2),
+                             (1, 4)])
+        self.assertEqual(fleet.afloat, 3)
+        self.assertEqual(sorted(fleet.remaining), [1, 3, 3])
+
+    def test_rows_do_not_wrap(self):
+        # Last column of one row and first column of the next one are not
+        # neighbours
+        fleet = Fleet(3, 3, [(0, 2), (1, 0)])
+        self.assertEqual(fleet.afloat, 2)
+        self.assertEqual(fleet.hit(0, 2), [(0, 2)])
+        self.assertEqual(fleet.afloat, 1)
+
+    def test_sink_returns_all_parts(self):
+        fleet = Fleet(4, 4, [(1, 1), (2, 1), (2, 2), (3, 3)])
+        self.assertEqual(fleet.hit(2, 2), None)
+        self.assertEqual(fleet.hit(1, 1), None)
+        self.assertEqual(fleet.afloat, 2)
+        self.assertEqual(sorted(fleet.hit(2, 1)), [(1, 1), (2, 1), (2, 2)])
+        self.assertEqual(fleet.afloat, 1)
+        self.assertEqual(fleet.hit(3, 3), [(3, 3)])
+        self.assertEqual(fleet.afloat, 0)
+
+    def test_sunk_ship_keeps_labels(self):
+        # Parts are relabeled back after the sink, so the ship is not found
+        # twice and other ships are not affected
+        fleet = Fleet(3, 1, [(0, 0), (0, 2)])
+        self.assertEqual(fleet.hit(0, 0), [(0, 0)])
+        self.assertEqual(len(set(fleet.ship_ids) - set([-1])), 2)
+        self.assertEqual(fleet.hit(0, 2), [(0, 2)])
+        self.assertEqual(fleet.afloat, 0)
+
+    def test_miss(self):
+        fleet = Fleet(2, 2, [(0, 0)])
+        self.assertEqual(fleet.hit(1, 1), None)
+        self.assertEqual(fleet.afloat, 1)
+
+    def test_large_field(self):
+        # Long ship is labeled without recursion
+        width = 1000
+        positions = [(row, 500) for row in range(1000)]
+        fleet = Fleet(width, 1000, positions)
+        self.assertEqual(fleet.afloat, 1)
+        for row in range(999):
+            self.assertEqual(fleet.hit(row, 500), None)
+        self.assertEqual(len(fleet.hit(999, 500)), 1000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+Transports providing communication channels.
+
+PikaTransport connects to RabbitMQ. LocalTransport is an in-memory broker with
+direct exchanges for running the server and clients in one process. Channels
+of both transports offer the same subset of pika.BlockingChannel interface:
+exchange_declare, queue_declare, queue_bind, queue_unbind, queue_delete,
+basic_consume, basic_cancel, basic_publish, start_consuming, stop_consuming
+and close. ChannelControl lets other threads bind queues of a channel
+consumed by one thread.
+"""
+# Imports ---------------------------------------------------------------------
+import collections
+import itertools
+import threading
+import Queue
+import logging
+import pika
+# Logging ---------------------------------------------------------------------
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+# Constants -------------------------------------------------------------------
+# Seconds to wait for channel method called by the consuming thread
+CONTROL_TIMEOUT = 5.0
+# Classes ---------------------------------------------------------------------
+class PikaTransport(object):
+    '''Transport over RabbitMQ server.
+    '''
+    def __init__(self, host, port):
+        '''Set address of RabbitMQ server.
+        @param host: address of RabbitMQ server
+        @param port: port of RabbitMQ server
+        '''
+        self.host = host
+        self.port = port
+
+    def channel(self):
+        '''Open new connection and channel with the exchange declared.
+        @return pika.BlockingChannel
+        '''
+        connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=self.host, port=int(self.port))
+        )
+        channel = connection.channel()
+        channel.exchange_declare(exchange='direct_logs', type='direct')
+        return channel
+
+    def claim_queue(self, queue):
+        '''Open new channel owning exclusive queue of given name.
+        @param queue: name of queue
+        @return pika.BlockingChannel, or None if the queue is owned by another
+                connection
+        '''
+        channel = self.channel()
+        try:
+            channel.queue_declare(queue=queue, exclusive=True)
+        except pika.exceptions.ChannelClosed:
+            channel.connection.close()
+            return None
+        return channel
+
+class Method(object):
+    '''Method frame of local transport, attributes are set from keywords.
+    '''
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class Frame(object):
+    '''Frame of local transport carrying a method.
+    '''
+    def __init__(self, method):
+        self.method = method
+
+class LocalQueue(object):
+    '''Queue of local transport. Messages are delivered to consumers in
+    round-robin order, or kept until some consumer comes.
+    '''
+    def __init__(self, name, owner=None):
+        '''Set name, owner, messages and consumers.
+        @param name: name of queue
+        @param owner: LocalChannel owning exclusive queue, else None
+        '''
+        self.name = name
+        self.owner = owner
+        self.messages = collections.deque()
+        self.consumers = []
+        self.next_consumer = 0
+
+    def consumer(self):
+        '''Choose next consumer.
+        @return tuple (LocalChannel, callback, consumer tag), or None
+        '''
+        if not self.consumers:
+            return None
+        self.next_consumer = (self.next_consumer + 1) % len(self.consumers)
+        return self.consumers[self.next_consumer]
+
+class LocalTransport(object):
+    '''In-memory broker with direct exchanges.
+    '''
+    def __init__(self):
+        '''Set queues and bindings.
+        '''
+        self.lock = threading.RLock()
+        self.queues = {}
+        # (exchange, routing key) -> set of queue names
+        self.bindings = collections.defaultdict(set)
+        self.counter = itertools.count()
+
+    def channel(self):
+        '''Open new channel.
+        @return LocalChannel
+        '''
+        return LocalChannel(self)
+
+    def claim_queue(self, queue):
+        '''Open new channel owning exclusive queue of given name.
+        @param queue: name of queue
+        @return LocalChannel, or None if the queue is owned by another channel
+        '''
+        channel = self.channel()
+        try:
+            channel.queue_declare(queue=queue, exclusive=True)
+        except RuntimeError:
+            return None
+        return channel
+
+    def deliver(self, queue, message):
+        '''Deliver message to consumer of queue, or keep it in the queue.
+        @param queue: LocalQueue
+        @param message: tuple (routing key, exchange, properties, body)
+        '''
+        consumer = queue.consumer()
+        if consumer is None:
+            queue.messages.append(message)
+            return
+        channel, callback, consumer_tag = consumer
+        channel.inbox.put((queue.name, consumer_tag, callback, message))
+
+    def publish(self, exchange, routing_key, properties, body):
+        '''Route message to all queues bound by the routing key.
+        @param exchange: name of exchange
+        @param routing_key: routing key
+        @param properties: pika.spec.BasicProperties
+        @param body: str
+        '''
+        with self.lock:
+            for name in self.bindings.get((exchange, routing_key), ()):
+                self.deliver(self.queues[name],
+                             (routing_key, exchange, properties, body))
+
+class LocalChannel(object):
+    '''Channel of local transport, mimics pika.BlockingChannel.
+    '''
+    def __init__(self, transport):
+        '''Set transport, consumers and inbox of delivered messages.
+        @param transport: LocalTransport
+        '''
+        self.transport = transport
+        # Consumer tag -> queue name
+        self.consumers = {}
+        self.inbox = Queue.Queue()
+        self.delivery_tags = itertools.count(1)
+        # Consuming loops are numbered, stop request is for one loop only
+        self.loop = 0
+
+    def exchange_declare(self, exchange=None, type=None, **kwargs):
+        '''Exchanges are created on first use.
+        '''
+        return Frame(Method(exchange=exchange))
+
+    def queue_declare(self, queue='', exclusive=False, **kwargs):
+        '''Declare queue, name is generated if not given.
+        @param queue: name of queue
+        @param exclusive: whether only this channel may use the queue
+        @return Frame, name of the queue in method.queue
+        '''
+        with self.transport.lock:
+            if not queue:
+                queue = 'local.gen-%d' % next(self.transport.counter)
+            if queue not in self.transport.queues:
+                self.transport.queues[queue] = LocalQueue(
+                    queue, self if exclusive else None)
+            elif exclusive and\
+                self.transport.queues[queue].owner is not self:
+                raise RuntimeError('Queue %s is locked' % queue)
+        return Frame(Method(queue=queue))
+
+    def queue_bind(self, queue, exchange, routing_key=None, **kwargs):
+        '''Bind queue to exchange by routing key.
+        '''
+        if routing_key is None:
+            routing_key = queue
+        with self.transport.lock:
+            self.transport.bindings[(exchange, routing_key)].add(queue)
+        return Frame(Method(queue=queue))
+
+    def queue_unbind(self, queue, exchange=None, routing_key=None, **kwargs):
+        '''Unbind queue from exchange.
+        '''
+        if routing_key is None:
+            routing_key = queue
+        with self.transport.lock:
+            self.transport.bindings[(exchange, routing_key)].discard(queue)
+        return Frame(Method(queue=queue))
+
+    def queue_delete(self, queue='', **kwargs):
+        '''Delete queue and its bindings.
+        @param queue: name of queue
+        '''
+        with self.transport.lock:
+            local_queue = self.transport.queues.pop(queue, None)
+            if local_queue is None:
+                return Frame(Method(message_count=0))
+            for bound in self.transport.bindings.values():
+                bound.discard(queue)
+            for channel, callback, consumer_tag in local_queue.consumers:
+                channel.consumers.pop(consumer_tag, None)
+        return Frame(Method(message_count=len(local_queue.messages)))
+
+    def basic_consume(self, consumer_callback, queue, no_ack=False,
+                      consumer_tag=None, **kwargs):
+        '''Start consuming queue, messages waiting in it are delivered.
+        @param consumer_callback: function(channel, method, properties, body)
+        @param queue: name of queue
+        @return consumer tag
+        '''
+        with self.transport.lock:
+            if consumer_tag is None:
+                consumer_tag = 'local.ctag-%d' % next(self.transport.counter)
+            local_queue = self.transport.queues[queue]
+            local_queue.consumers.append((self, consumer_callback,
+                                          consumer_tag))
+            self.consumers[consumer_tag] = queue
+            while local_queue.messages:
+                self.transport.deliver(local_queue,
+                                       local_queue.messages.popleft())
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag=None, **kwargs):
+        '''Cancel consumer. Messages delivered to it and not processed yet are
+        returned to the queue.
+        @param consumer_tag: consumer tag
+        '''
+        with self.transport.lock:
+            queue = self.consumers.pop(consumer_tag, None)
+            if queue is None:
+                return
+            local_queue = self.transport.queues[queue]
+            local_queue.consumers = [consumer for consumer
+                                     in local_queue.consumers
+                                     if consumer[2] != consumer_tag]
+            # Return undelivered messages
+            pending = []
+            while True:
+                try:
+                    item = self.inbox.get_nowait()
+                except Queue.Empty:
+                    break
+                if item[0] is not None and item[1] == consumer_tag:
+                    local_queue.messages.append(item[3])
+                else:
+                    pending.append(item)
+            for item in pending:
+                self.inbox.put(item)
+            while local_queue.consumers and local_queue.messages:
+                self.transport.deliver(local_queue,
+                                       local_queue.messages.popleft())
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      **kwargs):
+        '''Publish message.
+        @param exchange: name of exchange
+        @param routing_key: routing key
+        @param body: str
+        @param properties: pika.spec.BasicProperties
+        '''
+        if properties is None:
+            properties = pika.BasicProperties()
+        self.transport.publish(exchange, routing_key, properties, body)
+
+    def start_consuming(self):
+        '''Process delivered messages until consuming is stopped. Exceptions
+        of callbacks stop consuming and are raised, as by pika.
+        '''
+        self.loop += 1
+        loop = self.loop
+        while self.consumers:
+            item = self.inbox.get()
+            queue, consumer_tag, callback, message = item
+            # Stop request
+            if queue is None:
+                if message == loop:
+                    break
+                continue
+            if consumer_tag not in self.consumers:
+                continue
+            routing_key, exchange, properties, body = message
+            method = Method(consumer_tag=consumer_tag,
+                            delivery_tag=next(self.delivery_tags),
+                            exchange=exchange, routing_key=routing_key)
+            callback(self, method, properties, body)
+
+    def stop_consuming(self, consumer_tag=None):
+        '''Cancel all consumers and stop consuming loop.
+        '''
+        for tag in list(self.consumers):
+            self.basic_cancel(tag)
+        self.inbox.put((None, None, None, self.loop))
+
+    def close(self):
+        '''Stop consuming and delete exclusive queues of the channel.
+        '''
+        self.stop_consuming()
+        with self.transport.lock:
+            for name, queue in self.transport.queues.items():
+                if queue.owner is self:
+                    del self.transport.queues[name]
+                    for bound in self.transport.bindings.values():
+                        bound.discard(name)
+
+class ChannelControl(object):
+    '''Calls methods of consumed channel by its consuming thread. Channels
+    are not thread-safe, so other threads publish on their own channel,
+    guarded by the lock, and request binding by control messages.
+    '''
+    def __init__(self, channel, publisher):
+        '''Set channels, and declare and consume control queue.
+        @param channel: channel consumed by one thread
+        @param publisher: channel of the other threads
+        '''
+        self.channel = channel
+        self.publisher = publisher
+        self.lock = threading.Lock()
+        self.thread = None
+        # Tuples (channel method name, keyword arguments, threading.Event)
+        self.operations = Queue.Queue()
+        self.control_queue =\
+            channel.queue_declare(exclusive=True).method.queue
+        channel.queue_bind(exchange='direct_logs', queue=self.control_queue,
+                           routing_key=self.control_queue)
+        channel.basic_consume(self.on_control, queue=self.control_queue,
+                              no_ack=True)
+
+    def start(self, thread):
+        '''Use channel only by its consuming thread from now on.
+        @param thread: threading.Thread consuming the channel
+        '''
+        self.thread = thread
+
+    def bind(self, queue, routing_key):
+        '''Bind consumed queue to the exchange by routing key.
+        @param queue: name of queue
+        @param routing_key: routing key
+        '''
+        self.call('queue_bind', exchange='direct_logs', queue=queue,
+                  routing_key=routing_key)
+
+    def unbind(self, queue, routing_key):
+        '''Unbind consumed queue from the exchange.
+        @param queue: name of queue
+        @param routing_key: routing key
+        '''
+        self.call('queue_unbind', exchange='direct_logs', queue=queue,
+                  routing_key=routing_key)
+
+    def call(self, name, **kwargs):
+        '''Call method of the consumed channel, by the consuming thread if it
+        runs, and wait until it is done.
+        @param name: name of channel method
+        @param kwargs: keyword arguments of the method
+        '''
+        if self.thread is None or\
+            self.thread is threading.current_thread():
+            getattr(self.channel, name)(**kwargs)
+            return
+        done = threading.Event()
+        self.operations.put((name, kwargs, done))
+        with self.lock:
+            self.publisher.basic_publish(exchange='direct_logs',
+                                         routing_key=self.control_queue,
+                                         body='')
+        if not done.wait(CONTROL_TIMEOUT):
+            LOG.warn('Consuming thread did not call %s in time.', name)
+
+    def on_control(self, ch, method, properties, body):
+        '''Call channel methods requested by other threads.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
+        while True:
+            try:
+                name, kwargs, done = self.operations.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                getattr(self.channel, name)(**kwargs)
+            except Exception:
+                LOG.exception('Calling %s failed.', name)
+            done.set()
@@ -1,10 +1,22 @@
 # Imports ---------------------------------------------------------------------
+import bisect
 import threading
+import Queue
 from time import sleep
+import Tkinter
+# Custom imports --------------------------------------------------------------
+import common
 # Logging ---------------------------------------------------------------------
 import logging
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
+# Constants -------------------------------------------------------------------
+# Milliseconds between batched updates of listboxes
+FLUSH_DELAY = 50
+# Milliseconds between frames handling messages received by listening thread
+FRAME_DELAY = 20
+# Seconds the Tk thread waits for binding done by the listening thread
+BIND_TIMEOUT = 5.0
 
 counter = 0
 
@@ -44,3 +56,288 @@ def thread_printing():
     t_debug.setDaemon(True)
     t_debug.start()
 
+
+# Classes ---------------------------------------------------------------------
+class Dispatcher(object):
+    '''Hands messages consumed by one long-lived listening thread over to
+    the Tk main loop, where they are routed to handlers of the shown window.
+    Messages received within one frame are handled together, followed by one
+    update of the window.
+
+    Pika channels are not thread-safe, so the consumed channel is used only
+    by the listening thread once it runs. Windows publish on their own
+    channel, and queues are bound by the listening thread on request.
+    '''
+    def __init__(self, channel, publisher):
+        '''Set channels, empty routes, and control queue of binding requests.
+        @param channel: pika connection channel consumed by listening thread,
+                        owning the consumed queues
+        @param publisher: pika connection channel of the Tk thread
+        '''
+        self.channel = channel
+        self.publisher = publisher
+        self.widget = None
+        # Tuples (queue, arguments of callback), filled by listening thread
+        self.messages = Queue.Queue()
+        # Queue name -> handler, and update of the shown window
+        self.handlers = {}
+        self.update = None
+        self.handling = False
+        self.listening_thread = None
+
+        # Tuples (channel method name, keyword arguments, threading.Event)
+        # done by the listening thread when woken by control message
+        self.operations = Queue.Queue()
+        self.control_queue =\
+            channel.queue_declare(exclusive=True).method.queue
+        channel.queue_bind(exchange='direct_logs', queue=self.control_queue,
+                           routing_key=self.control_queue)
+        channel.basic_consume(self.on_control, queue=self.control_queue,
+                              no_ack=True)
+
+    def consume(self, queue):
+        '''Consume queue for the whole run of the client.
+        @param queue: name of queue
+        '''
+        def callback(ch, method, properties, body):
+            self.messages.put((queue, (ch, method, properties, body)))
+        self.channel.basic_consume(common.decompressing(callback),
+                                   queue=queue, no_ack=True)
+
+    def start(self, widget):
+        '''Start listening thread and handling frames.
+        @param widget: Tkinter widget running the frames
+        '''
+        self.widget = widget
+        self.listening_thread = listen(self.channel, 'client')
+        self.widget.after(FRAME_DELAY, self.handle_frame)
+
+    def bind(self, queue, routing_key):
+        '''Bind consumed queue to the exchange by routing key.
+        @param queue: name of queue
+        @param routing_key: routing key
+        '''
+        self.call('queue_bind', exchange='direct_logs', queue=queue,
+                  routing_key=routing_key)
+
+    def unbind(self, queue, routing_key):
+        '''Unbind consumed queue from the exchange.
+        @param queue: name of queue
+        @param routing_key: routing key
+        '''
+        self.call('queue_unbind', exchange='direct_logs', queue=queue,
+                  routing_key=routing_key)
+
+    def call(self, name, **kwargs):
+        '''Call method of the consumed channel, by the listening thread if it
+        runs, and wait until it is done.
+        @param name: name of channel method
+        @param kwargs: keyword arguments of the method
+        '''
+        if self.listening_thread is None:
+            getattr(self.channel, name)(**kwargs)
+            return
+        done = threading.Event()
+        self.operations.put((name, kwargs, done))
+        self.publisher.basic_publish(exchange='direct_logs',
+                                     routing_key=self.control_queue, body='')
+        if not done.wait(BIND_TIMEOUT):
+            LOG.warn('Listening thread did not call %s in time.', name)
+
+    def on_control(self, ch, method, properties, body):
+        '''Call channel methods requested by the Tk thread.
+        @param ch: pika.BlockingChannel
+        @param method: pika.spec.Basic.Deliver
+        @param properties: pika.spec.BasicProperties
+        @param body: str or unicode
+        '''
+        while True:
+            try:
+                name, kwargs, done = self.operations.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                getattr(self.channel, name)(**kwargs)
+            except Exception:
+                LOG.exception('Calling %s failed.', name)
+            done.set()
+
+    def route(self, handlers=None, update=None):
+        '''Route messages to handlers of window, messages of queues without
+        handler are dropped.
+        @param handlers: dict queue name -> function(ch, method, properties,
+                         body), or None to drop all messages
+        @param update: function updating the window after handled messages
+        '''
+        self.handlers = handlers or {}
+        self.update = update
+
+    def handle_frame(self):
+        '''Handle messages received since the last frame, then update window
+        once.
+        '''
+        # Dialogs shown by handlers run frames of their own
+        if self.handling:
+            self.widget.after(FRAME_DELAY, self.handle_frame)
+            return
+        self.handling = True
+        try:
+            handled = 0
+            while True:
+                try:
+                    queue, args = self.messages.get_nowait()
+                except Queue.Empty:
+                    break
+                handler = self.handlers.get(queue)
+                if handler is None:
+                    continue
+                try:
+                    handler(*args)
+                except Exception:
+                    LOG.exception('Handling message failed.')
+                handled += 1
+            if handled and self.update is not None:
+                self.update()
+        finally:
+            self.handling = False
+            self.widget.after(FRAME_DELAY, self.handle_frame)
+
+class IndexedListbox(object):
+    '''Listbox of unique names with index of their rows. Changes are
+    collected and applied to the widget in one batch per UI tick.
+    '''
+    def __init__(self, listbox, keep_sorted=False):
+        '''Set listbox and empty index.
+        @param listbox: Tkinter.Listbox
+        @param keep_sorted: whether names are kept sorted, otherwise new names
+                            are appended
+        '''
+        self.listbox = listbox
+        self.keep_sorted = keep_sorted
+        # Names in order of rows, name -> row
+        self.names = []
+        self.rows = {}
+        # Name -> whether it should be shown, guarded by lock
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.scheduled = False
+
+    def __contains__(self, name):
+        '''Check whether name is shown or waits to be shown.
+        @param name: name
+        @return bool
+        '''
+        with self.lock:
+            if name in self.pending:
+                return self.pending[name]
+        return name in self.rows
+
+    def __len__(self):
+        '''Get number of shown names.
+        @return int
+        '''
+        return len(self.names)
+
+    def add(self, name):
+        '''Show name with the next batch.
+        @param name: name
+        '''
+        self.change(name, True)
+
+    def remove(self, name):
+        '''Remove name with the next batch.
+        @param name: name
+        '''
+        self.change(name, False)
+
+    def change(self, name, shown):
+        '''Record change of name and schedule batch, the last change of name
+        wins.
+        @param name: name
+        @param shown: whether name should be shown
+        '''
+        with self.lock:
+            self.pending[name] = shown
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.listbox.after(FLUSH_DELAY, self.flush)
+
+    def set(self, names):
+        '''Replace all names at once.
+        @param names: names
+        '''
+        with self.lock:
+            self.pending = {}
+        if self.keep_sorted:
+            names = sorted(set(names))
+        else:
+            unique, seen = [], set()
+            for name in names:
+                if name not in seen:
+                    seen.add(name)
+                    unique.append(name)
+            names = unique
+        self.listbox.delete(0, Tkinter.END)
+        if names:
+            self.listbox.insert(Tkinter.END, *names)
+        self.names = names
+        self.rows = dict((name, row) for row, name in enumerate(names))
+
+    def clear(self):
+        '''Remove all names at once.
+        '''
+        self.set([])
+
+    def selected(self):
+        '''Get selected name.
+        @return String, or None if nothing is selected
+        '''
+        selection = self.listbox.curselection()
+        if selection == ():
+            return None
+        return self.names[int(selection[0])]
+
+    def flush(self):
+        '''Apply recorded changes to the listbox.
+        '''
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.scheduled = False
+        removed_names = [name for name, shown in pending.items()
+                         if not shown and name in self.rows]
+        removed = sorted((self.rows[name] for name in removed_names),
+                         reverse=True)
+        added = sorted(name for name, shown in pending.items()
+                       if shown and name not in self.rows)
+        if not removed and not added:
+            return
+
+        # Rows are deleted from the last one, so other rows stay in place
+        for row in removed:
+            self.listbox.delete(row)
+            del self.names[row]
+        first = removed[-1] if removed else len(self.names)
+        if self.keep_sorted and added:
+            # Rows from the first new name are rewritten at once, keeping
+            # selection
+            row = bisect.bisect_left(self.names, added[0])
+            selected = self.selected()
+            tail = sorted(self.names[row:] + added)
+            self.listbox.delete(row, Tkinter.END)
+            self.listbox.insert(Tkinter.END, *tail)
+            self.names[row:] = tail
+            first = min(first, row)
+            if selected is not None and selected in tail:
+                self.listbox.selection_set(row + tail.index(selected))
+        elif added:
+            self.names.extend(added)
+            self.listbox.insert(Tkinter.END, *added)
+
+        # Rows after the first change moved
+        for name in removed_names:
+            del self.rows[name]
+        for row in range(first, len(self.names)):
+            self.rows[self.names[row]] = row
+
@@ -5,137 +5,200 @@ Created on Fri Dec  9 20:55:58 2016
 @author: pavla
 """
 # Imports----------------------------------------------------------------------
-import threading
 import Tkinter
 import tkMessageBox
+import random
 import logging
 # Custom imports --------------------------------------------------------------
 import clientlib
+import codec
 import common
 from common import send_message
-from . import listen
 # Logging ---------------------------------------------------------------------
 LOG = logging.getLogger(__name__)
+# Constants -------------------------------------------------------------------
+# Colors of field items
+COLORS = {
+    common.FIELD_WATER: '#675BEB',
+    common.FIELD_SHIP: '#A56721',
+    common.FIELD_HIT_SHIP: '#C00000',
+    common.FIELD_SINK_SHIP: '#000000',
+    common.FIELD_UNKNOWN: '#E4E4E4',
+    'shot': '#A1A1A1'}
+OUTLINE = '#FFFFFF'
+# Size of cell in pixels, smaller for fields over BOARD_SIZE pixels, larger
+# fields are scrolled
+CELL_SIZE = 24
+MIN_CELL_SIZE = 1
+BOARD_SIZE = 480
+# Fields with more cells are drawn as image instead of rectangle per cell
+MAX_CELL_ITEMS = 10000
+# Boards with more changed cells are repainted whole
+MAX_DIRTY_CELLS = 1000
 # Classes ---------------------------------------------------------------------
-class GameButton(Tkinter.Button):
-    '''Button in the game field.
+class Board(object):
+    '''Game field drawn on one canvas, as rectangles, or as image with pixel
+    per cell on large fields.
     '''
-    def __init__(self, master, row, column, parent, game_window):
-        '''Init GameButton.
+    def __init__(self, master, width, height, parent, game_window):
+        '''Init Board, all cells have the default color of its type.
         @param master: master Tkinter widget
-        @param row: row in the field
-        @param column: column in the field
+        @param width: width of the field
+        @param height: height of the field
         @param parent: String, player or opponent - type of game field
         @param game_window: GameWindow
         '''
-        Tkinter.Button.__init__(self, master, command=self.button_pressed)
+        self.width = width
+        self.height = height
         self.parent = parent
         self.game_window = game_window
+        self.cell_size = max(MIN_CELL_SIZE,
+                             min(CELL_SIZE, BOARD_SIZE // max(width, height)))
+
+        self.frame = Tkinter.Frame(master)
+        size = self.cell_size
+        self.canvas = Tkinter.Canvas(self.frame,
+                                     width=min(width * size, BOARD_SIZE),
+                                     height=min(height * size, BOARD_SIZE),
+                                     scrollregion=(0, 0, width * size,
+                                                   height * size),
+                                     highlightthickness=0)
+        self.canvas.grid(row=0, column=0)
+        self.canvas.bind('<Button-1>', self.clicked)
+        if width * size > BOARD_SIZE:
+            scrollbar = Tkinter.Scrollbar(self.frame,
+                                          orient=Tkinter.HORIZONTAL,
+                                          command=self.canvas.xview)
+            scrollbar.grid(row=1, column=0, sticky='we')
+            self.canvas.config(xscrollcommand=scrollbar.set)
+        if height * size > BOARD_SIZE:
+            scrollbar = Tkinter.Scrollbar(self.frame,
+                                          orient=Tkinter.VERTICAL,
+                                          command=self.canvas.yview)
+            scrollbar.grid(row=0, column=1, sticky='ns')
+            self.canvas.config(yscrollcommand=scrollbar.set)
 
-        self.row = row
-        self.column = column
-
-        self.color = None
+        if self.parent == 'player':
+            color = common.FIELD_WATER
+        else:
+            color = common.FIELD_UNKNOWN
+        # Colors and canvas items of cells, in row-major order
+        self.colors = [color] * (width * height)
+        self.cells = []
+        # Image with pixel per cell and its zoomed copy shown on the canvas
+        self.image = None
+        self.display = None
+        if width * height > MAX_CELL_ITEMS:
+            self.image = Tkinter.PhotoImage(width=width, height=height)
+            self.display = Tkinter.PhotoImage(width=width * size,
+                                              height=height * size)
+            self.canvas.create_image(0, 0, image=self.display,
+                                     anchor=Tkinter.NW)
+            self.image.put(COLORS[color], to=(0, 0, width, height))
+            self.zoom()
+            return
+        for row in range(height):
+            for column in range(width):
+                self.cells.append(self.canvas.create_rectangle(
+                    column * size, row * size,
+                    (column + 1) * size, (row + 1) * size,
+                    fill=COLORS[color], outline=OUTLINE))
+
+    def grid(self, **options):
+        '''Place the board by grid geometry manager.
+        @param options: grid options
+        '''
+        self.frame.grid(**options)
 
-        # Colors
-        self.colors = {
-            common.FIELD_WATER: '#675BEB',
-            common.FIELD_SHIP: '#A56721',
-            common.FIELD_HIT_SHIP: '#C00000',
-            common.FIELD_SINK_SHIP: '#000000',
-            common.FIELD_UNKNOWN: '#E4E4E4',
-            'shot': '#A1A1A1'}
+    def zoom(self):
+        '''Copy whole image to the shown image, zoomed to cell size.
+        '''
+        self.display.tk.call(self.display, 'copy', self.image,
+                             '-zoom', self.cell_size, self.cell_size)
 
-        if self.parent == 'player':
-            self.change_color(common.FIELD_WATER)
-        if self.parent == 'opponent':
-            self.change_color(common.FIELD_UNKNOWN)
+    def get_color(self, row, column):
+        '''Get color of cell.
+        @param row: row in the field
+        @param column: column in the field
+        @return color
+        '''
+        return self.colors[row * self.width + column]
 
-    def change_color(self, color):
-        '''Change color of button and its backgrounds.
+    def change_color(self, row, column, color):
+        '''Change color of cell.
+        @param row: row in the field
+        @param column: column in the field
         @param color: color
         '''
-        self.color = color
-        self.config(bg=self.colors[color],
-                    activebackground=self.colors[color])
-
-    def button_pressed(self):
-        '''Reaction on pressing the button.
+        index = row * self.width + column
+        if self.colors[index] == color:
+            return
+        self.colors[index] = color
+        if self.image is None:
+            self.canvas.itemconfig(self.cells[index], fill=COLORS[color])
+            return
+        size = self.cell_size
+        self.image.put(COLORS[color], to=(column, row))
+        self.display.put(COLORS[color], to=(column * size, row * size,
+                                            (column + 1) * size,
+                                            (row + 1) * size))
+
+    def fill(self, color):
+        '''Change color of all cells.
+        @param color: color
         '''
-        if self.game_window.spectator:
+        if self.image is None:
+            for row in range(self.height):
+                for column in range(self.width):
+                    self.change_color(row, column, color)
             return
-
-        LOG.debug('Pressed button on position: %s, %s', self.row, self.column)
-
-        # If in positioning ships phase
-        if self.game_window.client_name not in self.game_window.players_ready:
-            if self.parent == 'opponent':
-                return
-
-            # Add ship
-            if self.color == common.FIELD_WATER and\
-                self.game_window.ships_remaining != 0:
-                self.change_color(common.FIELD_SHIP)
-                self.game_window.ships_remaining -= 1
-                # Update ready_label
-                self.game_window.ready_label.destroy()
-                self.game_window.ready_label = Tkinter.Label(
-                    self.game_window.frame_player,
-                    text='Ships remaining: %s' %\
-                        self.game_window.ships_remaining)
-                self.game_window.ready_label.grid(
-                    row=self.game_window.height+2,
-                    columnspan=self.game_window.width)
-                # Update field
-                self.game_window.fields[self.game_window.client_name].add_item(
-                    self.row, self.column, common.FIELD_SHIP)
-
-            # Remove ship
-            elif self.color == common.FIELD_SHIP:
-                self.change_color(common.FIELD_WATER)
-                self.game_window.ships_remaining += 1
-                # Update ready_label
-                self.game_window.ready_label.destroy()
-                self.game_window.ready_label = Tkinter.Label(
-                    self.game_window.frame_player,
-                    text='Ships remaining: %s' %\
-                        self.game_window.ships_remaining)
-                self.game_window.ready_label.grid(
-                    row=self.game_window.height+2,
-                    columnspan=self.game_window.width)
-                # Update field
-                self.game_window.fields[
-                    self.game_window.client_name].remove_item(self.row,
-                                                              self.column)
-
-        # If game started and on turn
-        if self.game_window.on_turn == self.game_window.client_name:
-            if self.parent == 'player' or self.game_window.opponent is None:
-                return
-
-            # Dont allow shooting at known positions
-            if self.color != 'unknown':
-                return
-
-            # Mark as shot and send request to server
-            self.change_color('shot')
-            msg = clientlib.make_req_shoot(self.game_window.client_name,
-                                           self.game_window.opponent,
-                                           self.row, self.column)
-            send_message(self.game_window.channel, msg,
-                         self.game_window.key_game,
-                         self.game_window.client_queue)
+        self.colors = [color] * (self.width * self.height)
+        self.image.put(COLORS[color], to=(0, 0, self.width, self.height))
+        self.zoom()
+
+    def paint(self, field, default):
+        '''Change color of all cells to items of field.
+        @param field: common.Field
+        @param default: color of positions without item
+        '''
+        colors = [item or default for item in field.ITEMS]
+        if self.image is None:
+            for index, code in enumerate(field.grid):
+                self.change_color(index // self.width, index % self.width,
+                                  colors[code])
+            return
+        self.colors = [colors[code] for code in field.grid]
+        # Image data are rows of colors in braces
+        pixels = [COLORS[color] for color in colors]
+        width = self.width
+        self.image.put(' '.join(
+            '{%s}' % ' '.join(pixels[code]
+                              for code in field.grid[row * width:
+                                                     (row + 1) * width])
+            for row in range(self.height)))
+        self.zoom()
+
+    def clicked(self, event):
+        '''Reaction on click into the canvas.
+        @param event: Tkinter event with coordinates of click
+        '''
+        row = int(self.canvas.canvasy(event.y)) // self.cell_size
+        column = int(self.canvas.canvasx(event.x)) // self.cell_size
+        if 0 <= row < self.height and 0 <= column < self.width:
+            self.game_window.cell_pressed(self.parent, row, column)
 
 class GameWindow(object):
     '''Window for displaying game.
     '''
-    def __init__(self, channel, client_queue, events_queue, events, parent):
+    def __init__(self, channel, client_queue, events_queue, dispatcher,
+                 control, parent):
         '''Set next window, gui elements, communication channel, and queues.
         Hides the game window.
         @param channel: pika connection channel
         @param client_queue: queue for messages to client
         @param events_queue: queue for game events
-        @param events: Queue of events for window control
+        @param dispatcher: Dispatcher of consumed messages
+        @param control: window control switching windows
         @param parent: parent for Tkinter
         '''
         # Next window
@@ -149,6 +212,7 @@ class GameWindow(object):
         self.is_owner = False
         self.spectator = False
         self.spectator_queue = None
+        self.key_spectate = None
 
         # Attributes of the game
         self.width = None
@@ -157,21 +221,23 @@ class GameWindow(object):
         self.ships_remaining = None
         self.players = set()
         self.players_ready = set()
+        self.player_order = []
         self.on_turn = None
+        self.version = 0
 
         # Fields
-        self.player_buttons = {}
-        self.opponent_buttons = {}
+        self.player_board = None
+        self.opponent_board = None
         self.opponent = None
+        self.turn_label = None
+        self.full_update = False
         self.fields = {}
 
         # Spectator option
         self.spectator = False
 
-        self.ready_event = threading.Event()
-
-        # Queue of events for window control
-        self.events = events
+        # Window control
+        self.control = control
 
         # GUI
         self.root = Tkinter.Toplevel(master=parent.root)
@@ -195,6 +261,7 @@ class GameWindow(object):
         self.channel = channel
         self.client_queue = client_queue
         self.events_queue = events_queue
+        self.dispatcher = dispatcher
 
         self.root.withdraw()
 
@@ -215,7 +282,7 @@ class GameWindow(object):
         self.root.deiconify()
 
     def on_show(self):
-        '''Bind queues, set consuming and listen.
+        '''Bind queues, route messages to the window and ask for game state.
         '''
         # Routing keys
         self.key_client = self.client_queue
@@ -223,58 +290,22 @@ class GameWindow(object):
         self.key_game = common.make_key_game(self.server_name, self.game_name)
         self.key_events = common.make_key_game_events(self.server_name,
                                                       self.game_name)
-        if self.spectator:
-            self.key_spectate = self.spectator_queue
+        self.key_spectate = None
 
         # Binding queues
-        self.channel.queue_bind(exchange='direct_logs',
-                                queue=self.client_queue,
-                                routing_key=self.client_queue)
-        self.channel.queue_bind(exchange='direct_logs',
-                                queue=self.events_queue,
-                                routing_key=self.key_events)
-        if self.spectator:
-            self.channel.queue_bind(exchange='direct_logs',
-                                    queue=self.events_queue,
-                                    routing_key=self.key_spectate)
-        # Set consuming
-        self.channel.basic_consume(self.on_response,
-                                   queue=self.client_queue,
-                                   no_ack=True)
-        self.channel.basic_consume(self.on_event,
-                                   queue=self.events_queue,
-                                   no_ack=True)
-        # Listening
-        self.listening_thread = listen(self.channel, 'game')
+        self.dispatcher.bind(self.events_queue, self.key_events)
+        if self.spectator and self.spectator_queue is not None:
+            self.follow_spectators(self.spectator_queue)
+        # Route messages
+        self.dispatcher.route({self.client_queue: self.on_response,
+                               self.events_queue: self.on_event},
+                              self.update_window)
 
         # Remove old settings and get all information from server
         self.reset_setting()
 
-        msg = clientlib.make_req_get_dimensions()
-        send_message(self.channel, msg, self.key_game, self.client_queue)
-        msg = clientlib.make_req_get_players()
-        send_message(self.channel, msg, self.key_game, self.client_queue)
-        msg = clientlib.make_req_get_players_ready()
-        send_message(self.channel, msg, self.key_game, self.client_queue)
-        msg = clientlib.make_req_get_owner()
-        send_message(self.channel, msg, self.key_game, self.client_queue)
-        msg = clientlib.make_req_get_turn()
+        msg = clientlib.make_req_get_game_state(self.client_name)
         send_message(self.channel, msg, self.key_game, self.client_queue)
-        msg = clientlib.make_req_get_field(self.client_name)
-        send_message(self.channel, msg, self.key_game, self.client_queue)
-        msg = clientlib.make_req_get_spectator(self.client_name)
-        send_message(self.channel, msg, self.key_game, self.client_queue)
-
-        self.wait_for_ready()
-        # If game already started
-        if self.on_turn is not None:
-            self.at_game_start(self.on_turn)
-            msg = clientlib.make_req_get_hits(self.client_name)
-            send_message(self.channel, msg, self.key_game, self.client_queue)
-
-        if self.spectator:
-            msg = clientlib.make_req_get_all_fields(self.client_name)
-            send_message(self.channel, msg, self.key_game, self.client_queue)
 
     def hide(self):
         '''Hide the game window.
@@ -284,25 +315,61 @@ class GameWindow(object):
         self.on_hide()
 
     def on_hide(self):
-        '''Unbind queues, stop consuming.
+        '''Unbind queues, stop routing messages to the window.
         '''
         # Unbinding queues
-        self.channel.queue_unbind(exchange='direct_logs',
-                                  queue=self.client_queue,
-                                  routing_key=self.client_queue)
-        self.channel.queue_unbind(exchange='direct_logs',
-                                  queue=self.events_queue,
-                                  routing_key=self.key_events)
-        # Stop consuming
-        if threading.current_thread() == self.listening_thread:
-            self.channel.stop_consuming()
-        else:
-            LOG.error('LobbyWindow.on_hide called from non-listening thread.')
+        self.dispatcher.unbind(self.events_queue, self.key_events)
+        self.unfollow_spectators()
+        # Stop routing messages
+        self.dispatcher.route()
+
+    def follow_spectators(self, key_spectate):
+        '''Receive stream of spectators, the events queue gets its own copy
+        of every delta and keyframe.
+        @param key_spectate: routing key of spectator stream
+        '''
+        if self.key_spectate is not None:
+            return
+        self.key_spectate = key_spectate
+        self.dispatcher.bind(self.events_queue, self.key_spectate)
 
-    def wait_for_ready(self):
-        '''To synchronize game communication.
+    def unfollow_spectators(self):
+        '''Stop receiving stream of spectators.
         '''
-        self.ready_event.wait()
+        if self.key_spectate is not None:
+            self.dispatcher.unbind(self.events_queue, self.key_spectate)
+            self.key_spectate = None
+
+    def spectate(self):
+        '''Ask for spectator stream if not received, and for its latest
+        keyframe with the following deltas.
+        '''
+        if self.key_spectate is None:
+            msg = clientlib.make_req_get_spectator_queue(self.client_name)
+            send_message(self.channel, msg, self.key_game, self.client_queue)
+        msg = clientlib.make_req_get_keyframe(self.client_name)
+        send_message(self.channel, msg, self.key_game, self.client_queue)
+
+    def load_fields(self, all_fields, replace=False):
+        '''Add items of fields of all players.
+        @param all_fields: name of every player followed by items or dump of
+                           the player's field
+        @param replace: whether the items replace known fields of the players
+        '''
+        for item in all_fields:
+            if common.FIELD_SEP not in item:
+                if replace or item not in self.fields:
+                    self.fields[item] = self.new_field()
+                field = self.fields[item]
+            else:
+                field.add_parts([item])
+        self.full_update = True
+
+    def resync(self):
+        '''Ask server for changes since the known version of game state.
+        '''
+        msg = clientlib.make_req_get_changes(self.client_name, self.version)
+        send_message(self.channel, msg, self.key_game, self.client_queue)
 
     def reset_setting(self):
         '''Resets frames, dimensions, list of players
@@ -327,12 +394,15 @@ class GameWindow(object):
         self.height = None
         self.ship_number = None
         self.players = set()
+        self.player_order = []
         self.on_turn = None
-        self.player_buttons = {}
-        self.opponent_buttons = {}
+        self.version = 0
+        self.player_board = None
+        self.opponent_board = None
         self.opponent = None
+        self.turn_label = None
+        self.full_update = False
         self.fields = {}
-        self.ready_event.clear()
 
     def set_setting(self, width, height, ships):
         '''Sets all widgets.
@@ -343,18 +413,16 @@ class GameWindow(object):
         self.ships_remaining = int(ships)
 
         # Set client field
-        self.fields[self.client_name] = common.Field(self.width, self.height)
+        self.fields[self.client_name] = self.new_field()
 
         # Player frame
         self.game_label = Tkinter.Label(self.frame_player,
                                         text=self.client_name)
         self.game_label.grid(columnspan=self.width)
 
-        for i in range(self.height):
-            for j in range(self.width):
-                button = GameButton(self.frame_player, i, j, 'player', self)
-                button.grid(row=i+1, column=j)
-                self.player_buttons[(i, j)] = button
+        self.player_board = Board(self.frame_player, self.width, self.height,
+                                  'player', self)
+        self.player_board.grid(row=1, columnspan=self.width)
 
         if not self.spectator:
             self.ready_label = Tkinter.Label(self.frame_player,
@@ -366,6 +434,11 @@ class GameWindow(object):
                                                command=self.get_ready)
             self.button_ready.grid(row=self.height+3, columnspan=self.width)
 
+            self.button_random = Tkinter.Button(self.frame_player,
+                                                text="Random",
+                                                command=self.place_randomly)
+            self.button_random.grid(row=self.height+5, columnspan=self.width)
+
         # Start button in case of owner
         if self.is_owner:
             self.button_start = Tkinter.Button(self.frame_player,
@@ -380,13 +453,9 @@ class GameWindow(object):
                                             text='None selected')
         self.opponent_label.grid(row=1, columnspan=self.width)
 
-        for i in range(self.height):
-            for j in range(self.width):
-                button = GameButton(
-                    self.frame_opponent, i, j, 'opponent', self
-                )
-                button.grid(row=i+2, column=j)
-                self.opponent_buttons[(i, j)] = button
+        self.opponent_board = Board(self.frame_opponent, self.width,
+                                    self.height, 'opponent', self)
+        self.opponent_board.grid(row=2, columnspan=self.width)
 
         # Kick button in case of owner
         if self.is_owner:
@@ -476,7 +545,7 @@ class GameWindow(object):
                                                 text=label)
             self.ready_label_op.grid(row=self.height+3, columnspan=self.width)
         else:
-            self.update_buttons()
+            self.update_buttons(full=True)
 
     def kick_out(self):
         '''Kick out player
@@ -498,6 +567,59 @@ class GameWindow(object):
                                           command=self.kick_out)
         self.button_kick.grid(row=self.height + 4, columnspan=self.width)
 
+    def cell_pressed(self, parent, row, column):
+        '''Reaction on pressing cell of board, placing ships or shooting.
+        @param parent: String, player or opponent - type of game field
+        @param row: row in the field
+        @param column: column in the field
+        '''
+        if self.spectator:
+            return
+
+        LOG.debug('Pressed cell on position: %s, %s', row, column)
+
+        # If in positioning ships phase
+        if self.client_name not in self.players_ready:
+            if parent == 'opponent':
+                return
+            color = self.player_board.get_color(row, column)
+
+            # Add ship
+            if color == common.FIELD_WATER and self.ships_remaining != 0:
+                self.player_board.change_color(row, column, common.FIELD_SHIP)
+                self.ships_remaining -= 1
+                self.ready_label.config(
+                    text='Ships remaining: %s' % self.ships_remaining)
+                # Update field
+                self.fields[self.client_name].add_item(row, column,
+                                                       common.FIELD_SHIP)
+
+            # Remove ship
+            elif color == common.FIELD_SHIP:
+                self.player_board.change_color(row, column,
+                                               common.FIELD_WATER)
+                self.ships_remaining += 1
+                self.ready_label.config(
+                    text='Ships remaining: %s' % self.ships_remaining)
+                # Update field
+                self.fields[self.client_name].remove_item(row, column)
+
+        # If game started and on turn
+        if self.on_turn == self.client_name:
+            if parent == 'player' or self.opponent is None:
+                return
+
+            # Dont allow shooting at known positions
+            if self.opponent_board.get_color(row, column) !=\
+                common.FIELD_UNKNOWN:
+                return
+
+            # Mark as shot and send request to server
+            self.opponent_board.change_color(row, column, 'shot')
+            msg = clientlib.make_req_shoot(self.client_name, self.opponent,
+                                           row, column)
+            send_message(self.channel, msg, self.key_game, self.client_queue)
+
     def get_ready(self):
         '''Confirm the ship positioning to the server.
         '''
@@ -508,13 +630,28 @@ class GameWindow(object):
                 'Game', 'Ships remaining: %s' % self.ships_remaining
             )
         else:
-            # Send request to server
-            ships = self.fields[self.client_name].get_all_items('ship')
+            # Send request to server, many ships are sent as field dump
+            ships = self.fields[self.client_name].export()
             msg = clientlib.make_req_set_ready(self.client_name, ships)
             send_message(self.channel, msg, self.key_game, self.client_queue)
             # Color the button
             self.button_ready.config(bg='#68c45c', activebackground='#68c45c')
 
+    def place_randomly(self):
+        '''Place remaining ships on random positions of water.
+        '''
+        if self.client_name in self.players_ready or\
+            self.ships_remaining == 0:
+            return
+        field = self.fields[self.client_name]
+        water = [index for index, code in enumerate(field.grid) if code == 0]
+        for index in random.sample(water, self.ships_remaining):
+            field.add_item(index // self.width, index % self.width,
+                           common.FIELD_SHIP)
+        self.ships_remaining = 0
+        self.ready_label.config(text='Ships remaining: 0')
+        self.update_buttons()
+
     def start_game(self):
         '''Check if all players are ready and start the game.
         '''
@@ -534,6 +671,7 @@ class GameWindow(object):
         if not self.spectator:
             self.ready_label.destroy()
             self.button_ready.destroy()
+            self.button_random.destroy()
         try:
             self.ready_label_op.destroy()
         except AttributeError:
@@ -545,23 +683,60 @@ class GameWindow(object):
         self.turn_label = Tkinter.Label(self.frame_player,
                                         text='Turn: %s' % self.on_turn)
         self.turn_label.grid(row=self.height + 2, columnspan=self.width)
-        # Initialize fields for other players
+        # Initialize fields for other players, unless known from hits
         for player in self.players:
-            self.fields[player] = common.Field(self.width, self.height)
+            if player not in self.fields:
+                self.fields[player] = self.new_field()
 
-    def update_buttons(self):
-        '''Update buttons according to field of player and selected opponent
+    def new_field(self):
+        '''Create field recording its changes for redraw.
+        @return common.Field
         '''
-        for key, value in self.fields[self.client_name].field_dict.items():
-            self.player_buttons[key].change_color(value)
-        if self.on_turn is not None and self.opponent is not None:
-            for button in self.opponent_buttons.values():
-                if self.spectator:
-                    button.change_color(common.FIELD_WATER)
-                else:
-                    button.change_color(common.FIELD_UNKNOWN)
-            for key, value in self.fields[self.opponent].field_dict.items():
-                self.opponent_buttons[key].change_color(value)
+        field = common.Field(self.width, self.height)
+        field.track()
+        return field
+
+    def update_buttons(self, full=False):
+        '''Redraw cells changed since the last update in fields of player and
+        selected opponent.
+        @param full: whether to redraw whole board of opponent, e.g. when
+                     another opponent was selected
+        '''
+        self.redraw(self.player_board, self.fields[self.client_name],
+                    common.FIELD_WATER)
+        if self.on_turn is None or self.opponent is None:
+            return
+        if self.spectator:
+            default = common.FIELD_WATER
+        else:
+            default = common.FIELD_UNKNOWN
+        self.redraw(self.opponent_board, self.fields[self.opponent], default,
+                    full)
+
+    def redraw(self, board, field, default, full=False):
+        '''Redraw changed cells of board, or whole board if many changed.
+        @param board: Board
+        @param field: common.Field shown on the board
+        @param default: color of positions without item
+        @param full: whether to redraw whole board
+        '''
+        if full or len(field.dirty) > MAX_DIRTY_CELLS:
+            # Changes are forgotten, the whole field is painted
+            field.track()
+            board.paint(field, default)
+            return
+        for key, value in field.pop_dirty():
+            board.change_color(key[0], key[1], value or default)
+
+    def update_window(self):
+        '''Update widgets once after messages handled within one frame.
+        '''
+        if self.player_board is None:
+            return
+        if self.turn_label is not None:
+            self.turn_label.config(text='Turn: %s' % self.on_turn)
+        self.update_buttons(full=self.full_update)
+        self.full_update = False
 
     def on_response(self, ch, method, properties, body):
         '''React on server response.
@@ -571,18 +746,51 @@ class GameWindow(object):
         @param body: str or unicode
         '''
         LOG.debug('Received message: %s', body)
-        msg_parts = body.split(common.SEP)
+        self.process_response(codec.decode(body))
+
+    def process_response(self, msg_parts):
+        '''React on parsed server response.
+        @param msg_parts: parsed message
+        '''
+        # Batch of responses
+        if msg_parts[0] == common.RSP_BATCH:
+            for response in common.unpack_messages(msg_parts[1:]):
+                self.process_response(response)
+
+        # Game state made of responses
+        if msg_parts[0] == common.RSP_GAME_STATE:
+            self.version = int(msg_parts[1])
+            for response in common.unpack_messages(msg_parts[2:]):
+                self.process_response(response)
+            # The state is complete, the game may be running already
+            if self.on_turn is not None and self.turn_label is None:
+                self.at_game_start(self.on_turn)
+            if self.spectator:
+                self.spectate()
+
+        # Latest keyframe of spectators and deltas after it
+        if msg_parts[0] == common.RSP_KEYFRAME:
+            for event in common.unpack_messages(msg_parts[2:]):
+                self.process_event(event)
+            self.version = max(self.version, int(msg_parts[1]))
+
+        # Changes since the known version
+        if msg_parts[0] == common.RSP_CHANGES:
+            for event in common.unpack_messages(msg_parts[2:]):
+                self.process_event(event)
+            self.version = max(self.version, int(msg_parts[1]))
+
+        # Not on turn, some event was probably missed
+        if msg_parts[0] == common.RSP_NOT_ON_TURN:
+            self.resync()
 
         # Disconnected
         if msg_parts[0] == common.RSP_DISCONNECTED:
-            self.hide()
-            self.events.put(('server', None, None))
+            self.control.switch('server')
 
         # Game left
         if msg_parts[0] == common.RSP_GAME_LEFT:
-            self.hide()
-            self.events.put(('lobby', None,
-                             [self.server_name, self.client_name]))
+            self.control.switch('lobby', [self.server_name, self.client_name])
 
         # Dimensions
         if msg_parts[0] == common.RSP_DIMENSIONS:
@@ -611,41 +819,39 @@ class GameWindow(object):
                 self.on_turn = None
             else:
                 self.on_turn = msg_parts[1]
-            self.ready_event.set()
 
         # Field
         if msg_parts[0] == common.RSP_FIELD:
-            field = self.fields[self.client_name]
-            for item in msg_parts[1:]:
-                item_parts = item.split(common.FIELD_SEP)
-                for item in item_parts:
-                    field.add_item(int(item_parts[0]), int(item_parts[1]),
-                                   item_parts[2])
-            self.update_buttons()
-
-        # Hits
+            self.fields[self.client_name].add_parts(msg_parts[1:])
+
+        # Hits, shot items are recorded as they were before the shot
         if msg_parts[0] == common.RSP_HITS:
             for hit in msg_parts[1:]:
-                self.fields[hit[0]].add_item(*hit[1:])
-            self.update_buttons()
+                hit_parts = hit.split(common.FIELD_SEP)
+                if hit_parts[0] not in self.fields:
+                    self.fields[hit_parts[0]] = self.new_field()
+                item = hit_parts[3]
+                if item == common.FIELD_SHIP:
+                    item = common.FIELD_HIT_SHIP
+                self.fields[hit_parts[0]].add_item(int(hit_parts[1]),
+                                                   int(hit_parts[2]), item)
+
+        # Player order
+        if msg_parts[0] == common.RSP_PLAYER_ORDER:
+            self.player_order = msg_parts[1:]
 
         # All fields
         if msg_parts[0] == common.RSP_ALL_FIELDS:
-            for item in msg_parts[1:]:
-                item_parts = item.split(common.FIELD_SEP)
-                if len(item_parts) == 1:
-                    current_player = item_parts[0]
-                    field = self.fields[current_player]
-                else:
-                    for item in item_parts:
-                        field.add_item(int(item_parts[0]), int(item_parts[1]),
-                                       item_parts[2])
-            self.update_buttons()
+            self.load_fields(msg_parts[1:])
 
         # Spectator
         if msg_parts[0] == common.RSP_SPECTATOR:
             self.spectator = msg_parts[1] == '1'
 
+        # Spectator stream
+        if msg_parts[0] == common.RSP_SPECTATOR_QUEUE:
+            self.follow_spectators(msg_parts[1])
+
         # Ready
         if msg_parts[0] == common.RSP_READY:
             self.players_ready.add(self.client_name)
@@ -661,7 +867,6 @@ class GameWindow(object):
                 common.FIELD_SINK_SHIP:
                 field.add_item(int(msg_parts[3]), int(msg_parts[4]),
                                common.FIELD_HIT_SHIP)
-                self.update_buttons()
             if msg_parts[1] != self.client_name:
                 tkMessageBox.showinfo('Game',
                                       'Your ship was hit by %s' % msg_parts[1])
@@ -671,7 +876,6 @@ class GameWindow(object):
             field = self.fields[msg_parts[2]]
             field.add_item(int(msg_parts[3]), int(msg_parts[4]),
                            common.FIELD_WATER)
-            self.update_buttons()
 
     def on_event(self, ch, method, properties, body):
         '''React on game event.
@@ -681,8 +885,21 @@ class GameWindow(object):
         @param body: str or unicode
         '''
         LOG.debug('Received event: %s', body)
-        msg_parts = body.split(common.SEP)
+        # Skip events already known from game state or changes. Keyframe has
+        # the version of the last delta before it and replaces the fields.
+        version = common.get_version(properties)
+        msg_parts = codec.decode(body)
+        if version is not None:
+            if version < self.version or (version == self.version and
+                                          msg_parts[0] != common.E_KEYFRAME):
+                return
+            self.version = version
+        self.process_event(msg_parts)
 
+    def process_event(self, msg_parts):
+        '''React on parsed game event.
+        @param msg_parts: parsed message
+        '''
         # New player
         if msg_parts[0] == common.E_NEW_PLAYER:
             self.add_players(msg_parts[1:])
@@ -704,14 +921,14 @@ class GameWindow(object):
         # Game starts
         if msg_parts[0] == common.E_GAME_STARTS:
             self.at_game_start(msg_parts[1])
+            # Spectator stream gets new key at game start
+            if self.spectator:
+                self.unfollow_spectators()
+                self.spectate()
 
         # On turn
         if msg_parts[0] == common.E_ON_TURN:
             self.on_turn = msg_parts[1]
-            self.turn_label.destroy()
-            self.turn_label = Tkinter.Label(self.frame_player,
-                                            text='Turn: %s' % self.on_turn)
-            self.turn_label.grid(row=self.height+2, columnspan=self.width)
 
         # Hit
         if msg_parts[0] == common.E_HIT:
@@ -719,6 +936,12 @@ class GameWindow(object):
                                                int(msg_parts[4]),
                                                common.FIELD_HIT_SHIP)
 
+        # Miss, known only from changes
+        if msg_parts[0] == common.E_MISS:
+            self.fields[msg_parts[2]].add_item(int(msg_parts[3]),
+                                               int(msg_parts[4]),
+                                               common.FIELD_WATER)
+
         # Sink
         if msg_parts[0] == common.E_SINK:
             field = self.fields[msg_parts[1]]
@@ -726,7 +949,10 @@ class GameWindow(object):
                 sink_ship_pos = sink_ship.split(common.FIELD_SEP)
                 field.add_item(int(sink_ship_pos[0]), int(sink_ship_pos[1]),
                                common.FIELD_SINK_SHIP)
-            self.update_buttons()
+
+        # Keyframe of spectators
+        if msg_parts[0] == common.E_KEYFRAME:
+            self.load_fields(msg_parts[1:], replace=True)
 
         # Player end
         if msg_parts[0] == common.E_PLAYER_END:
@@ -735,22 +961,16 @@ class GameWindow(object):
                     self.leave()
                 else:
                     self.spectator = True
-                    msg = clientlib.make_req_get_spectator_queue(
-                        self.client_name)
-                    send_message(self.channel, msg, self.key_game,
-                                 self.client_queue)
-                    msg = clientlib.make_req_get_all_fields(self.client_name)
-                    send_message(self.channel, msg, self.key_game,
-                                 self.client_queue)
+                    self.spectate()
             else:
                 self.remove_player(msg_parts[1])
 
         # Game end
         if msg_parts[0] == common.E_GAME_END:
-            ships = self.fields[self.client_name].get_all_items(
+            ships = self.fields[self.client_name].count_items(
                 common.FIELD_SHIP
             )
-            if ships != []:
+            if ships != 0:
                 tkMessageBox.showinfo('Game', 'Congratulations, you won!')
             else:
                 tkMessageBox.showinfo('Game', 'Game ended!')
@@ -762,6 +982,6 @@ class GameWindow(object):
 
         # Game restart
         if msg_parts[0] == common.E_GAME_RESTART:
-            self.hide()
-            self.show([self.server_name, self.client_name, self.game_name,
-                       self.is_owner, self.spectator, self.spectator_queue])
+            self.control.switch('game', [self.server_name, self.client_name,
+                                         self.game_name, self.is_owner,
+                                         self.spectator, self.key_spectate])
@@ -5,29 +5,33 @@ Created on Tue Dec  7 16:27:21 2016
 @author: pavla
 """
 # Imports----------------------------------------------------------------------
-import threading
 import Tkinter
 import tkMessageBox
 import logging
 # Custom imports --------------------------------------------------------------
 import clientlib
+import codec
 import common
 from common import send_message
-from . import listen
+from . import IndexedListbox
 # Logging ---------------------------------------------------------------------
 LOG = logging.getLogger(__name__)
+# Constants -------------------------------------------------------------------
+# Number of games asked for at once
+PAGE_SIZE = 100
 # Classes ---------------------------------------------------------------------
 class LobbyWindow(object):
     '''Window for displaying game sessions, and creating new sessions.
     '''
     def __init__(self, channel, game_advertisements, client_queue,
-                 events, parent):
+                 dispatcher, control, parent):
         '''Set next window, gui elements, communication channel, and queues.
         Hide the lobby window.
         @param channel: pika connection channel
         @param server_advertisements: queue for server advertisements
         @param client_queue: queue for messages to client
-        @param events: Queue of events for window control
+        @param dispatcher: Dispatcher of consumed messages
+        @param control: window control switching windows
         @param parent: parent for Tkinter
         '''
         # Next window
@@ -38,8 +42,8 @@ class LobbyWindow(object):
         self.server_name = None
         self.client_name = None
 
-        # Queue of events for window control
-        self.events = events
+        # Window control
+        self.control = control
 
         # GUI
         self.root = Tkinter.Toplevel(master=parent.root)
@@ -57,11 +61,11 @@ class LobbyWindow(object):
         self.create_label.pack()
         self.gamename_entry = Tkinter.Entry(frame)
         self.gamename_entry.pack()
-        self.width_entry = Tkinter.Scale(frame, from_=1, to=20,
-                                         orient=Tkinter.HORIZONTAL)
+        self.width_entry = Tkinter.Spinbox(frame, from_=1,
+                                           to=common.MAX_FIELD_SIZE, width=6)
         self.width_entry.pack()
-        self.height_entry = Tkinter.Scale(frame, from_=1, to=20,
-                                          orient=Tkinter.HORIZONTAL)
+        self.height_entry = Tkinter.Spinbox(frame, from_=1,
+                                            to=common.MAX_FIELD_SIZE, width=6)
         self.height_entry.pack()
 
         self.button_create = Tkinter.Button(
@@ -72,6 +76,11 @@ class LobbyWindow(object):
         self.listbox_label.pack()
         self.listbox_opened = Tkinter.Listbox(frame, width=40, height=10)
         self.listbox_opened.pack()
+        self.games_opened = IndexedListbox(self.listbox_opened)
+
+        self.button_more_opened = Tkinter.Button(
+            frame, text="More", command=lambda: self.get_games_page('open'))
+        self.button_more_opened.pack()
 
         self.button_join = Tkinter.Button(
             frame, text="Join", command=self.join_game)
@@ -82,6 +91,11 @@ class LobbyWindow(object):
         self.listbox_label.pack()
         self.listbox_closed = Tkinter.Listbox(frame, width=40, height=10)
         self.listbox_closed.pack()
+        self.games_closed = IndexedListbox(self.listbox_closed)
+
+        self.button_more_closed = Tkinter.Button(
+            frame, text="More", command=lambda: self.get_games_page('close'))
+        self.button_more_closed.pack()
 
         self.button_join_closed = Tkinter.Button(
             frame, text="Join", command=self.join_game_closed)
@@ -95,6 +109,11 @@ class LobbyWindow(object):
         self.channel = channel
         self.game_advertisements = game_advertisements
         self.client_queue = client_queue
+        self.dispatcher = dispatcher
+
+        # State -> number of games got by pages, and number of all games
+        self.loaded = {'open': 0, 'close': 0}
+        self.totals = {'open': 0, 'close': 0}
 
         self.root.withdraw()
 
@@ -110,35 +129,20 @@ class LobbyWindow(object):
         self.root.deiconify()
 
     def on_show(self):
-        '''Bind queues, set consuming and listen.
+        '''Bind queues, route messages to the window and ask for games.
         '''
         # Clear listboxes
-        self.listbox_opened.delete(0, Tkinter.END)
-        self.listbox_closed.delete(0, Tkinter.END)
+        self.games_opened.clear()
+        self.games_closed.clear()
 
         # Binding queues
-        self.channel.queue_bind(
-            exchange='direct_logs',
-            queue=self.game_advertisements,
-            routing_key=common.make_key_games(self.server_name)
-        )
-        self.channel.queue_bind(
-            exchange='direct_logs',
-            queue=self.game_advertisements,
-            routing_key=common.make_key_game_advert(self.server_name)
-        )
-        self.channel.queue_bind(exchange='direct_logs',
-                                queue=self.client_queue,
-                                routing_key=self.client_queue)
-        # Set consuming
-        self.channel.basic_consume(self.update,
-                                   queue=self.game_advertisements,
-                                   no_ack=True)
-        self.channel.basic_consume(self.on_response,
-                                   queue=self.client_queue,
-                                   no_ack=True)
-        # Listening
-        self.listening_thread = listen(self.channel, 'lobby')
+        self.dispatcher.bind(self.game_advertisements,
+                             common.make_key_games(self.server_name))
+        self.dispatcher.bind(self.game_advertisements,
+                             common.make_key_game_advert(self.server_name))
+        # Route messages
+        self.dispatcher.route({self.game_advertisements: self.update,
+                               self.client_queue: self.on_response})
 
         # Get list of games
         self.get_games_list()
@@ -151,25 +155,15 @@ class LobbyWindow(object):
         self.on_hide()
 
     def on_hide(self):
-        '''Unbind queues, stop consuming.
+        '''Unbind queues, stop routing messages to the window.
         '''
         # Unbinding queues
-        self.channel.queue_unbind(exchange='direct_logs',
-                                  queue=self.game_advertisements,
-                                  routing_key=common.make_key_games(
-                                      self.server_name))
-        self.channel.queue_unbind(exchange='direct_logs',
-                                  queue=self.game_advertisements,
-                                  routing_key=common.make_key_game_advert(
-                                      self.server_name))
-        self.channel.queue_unbind(exchange='direct_logs',
-                                  queue=self.client_queue,
-                                  routing_key=self.client_queue)
-        # Stop consuming
-        if threading.current_thread() == self.listening_thread:
-            self.channel.stop_consuming()
-        else:
-            LOG.error('LobbyWindow.on_hide called from non-listening thread.')
+        self.dispatcher.unbind(self.game_advertisements,
+                               common.make_key_games(self.server_name))
+        self.dispatcher.unbind(self.game_advertisements,
+                               common.make_key_game_advert(self.server_name))
+        # Stop routing messages
+        self.dispatcher.route()
 
     def disconnect(self):
         '''Disconnect from server.
@@ -179,38 +173,24 @@ class LobbyWindow(object):
         send_message(self.channel, msg, routing_key, self.client_queue)
 
     def add_game(self, name, state):
-        '''Add game session name into listbox.
+        '''Add game session name into listbox, shown with the next batch.
         @param name: game session name
+        @param state: 'open' or 'close'
         '''
         if state == 'open':
-            if name in self.listbox_opened.get(0, Tkinter.END):
-                return
-            else:
-                self.listbox_opened.insert(Tkinter.END, name)
+            self.games_opened.add(name)
         if state == 'close':
-            if name in self.listbox_closed.get(0, Tkinter.END):
-                return
-            else:
-                self.listbox_closed.insert(Tkinter.END, name)
+            self.games_closed.add(name)
 
     def remove_game(self, name, state):
-        '''Remove game session name from listbox.
+        '''Remove game session name from listbox with the next batch.
         @param name: game session name
+        @param state: 'open' or 'close'
         '''
         if state == 'open':
-            if name not in self.listbox_opened.get(0, Tkinter.END):
-                LOG.debug('Ignoring game session %s removal.', name)
-                return
-            else:
-                index = self.listbox_opened.get(0, Tkinter.END).index(name)
-                self.listbox_opened.delete(index)
+            self.games_opened.remove(name)
         if state == 'close':
-            if name not in self.listbox_closed.get(0, Tkinter.END):
-                LOG.debug('Ignoring game session %s removal.', name)
-                return
-            else:
-                index = self.listbox_closed.get(0, Tkinter.END).index(name)
-                self.listbox_closed.delete(index)
+            self.games_closed.remove(name)
 
     def update(self, ch, method, properties, body):
         '''Update listbox of game session names.
@@ -219,7 +199,7 @@ class LobbyWindow(object):
         @param properties: pika.spec.BasicProperties
         @param body: str or unicode
         '''
-        msg_parts = body.split(common.SEP)
+        msg_parts = codec.decode(body)
         if msg_parts[0] == common.E_GAME_OPEN:
             self.add_game(msg_parts[1], 'open')
         if msg_parts[0] == common.E_GAME_CLOSE:
@@ -230,16 +210,55 @@ class LobbyWindow(object):
             self.remove_game(msg_parts[1], 'close')
 
     def get_games_list(self):
-        '''Send requests to server to get list of all game sessions.
+        '''Send requests to server to get the first pages of game sessions.
         '''
+        self.loaded = {'open': 0, 'close': 0}
+        self.totals = {'open': 0, 'close': 0}
         routing_key = common.make_key_games(self.server_name)
-        # Sending request to get list of opened games
-        msg = clientlib.make_req_list_opened()
+        # Sending request to get lists of opened and closed games
+        msg = clientlib.make_req_batch([
+            clientlib.make_req_list_opened(0, PAGE_SIZE),
+            clientlib.make_req_list_closed(0, PAGE_SIZE)])
         send_message(self.channel, msg, routing_key, self.client_queue)
-        # Sending request to get list of closed games
-        msg = clientlib.make_req_list_closed()
+
+    def get_games_page(self, state):
+        '''Send request to server to get next page of game sessions.
+        @param state: 'open' or 'close'
+        '''
+        if self.loaded[state] >= self.totals[state]:
+            return
+        if state == 'open':
+            msg = clientlib.make_req_list_opened(self.loaded[state],
+                                                 PAGE_SIZE)
+        else:
+            msg = clientlib.make_req_list_closed(self.loaded[state],
+                                                 PAGE_SIZE)
+        routing_key = common.make_key_games(self.server_name)
         send_message(self.channel, msg, routing_key, self.client_queue)
 
+    def add_page(self, msg_parts, state):
+        '''Add page of game sessions into listbox.
+        @param msg_parts: list response: total, offset, names
+        @param state: 'open' or 'close'
+        '''
+        try:
+            total = int(msg_parts[1])
+            offset = int(msg_parts[2])
+        except (IndexError, ValueError):
+            return
+        for game_name in msg_parts[3:]:
+            if game_name.strip() != '':
+                self.add_game(game_name, state)
+        self.totals[state] = total
+        self.loaded[state] = max(self.loaded[state],
+                                 offset + len(msg_parts[3:]))
+        button = self.button_more_opened if state == 'open' else\
+            self.button_more_closed
+        if self.loaded[state] < total:
+            button.config(state=Tkinter.NORMAL)
+        else:
+            button.config(state=Tkinter.DISABLED)
+
     def create_game(self):
         '''Send game creation request to server.
         '''
@@ -247,8 +266,16 @@ class LobbyWindow(object):
         if game_name.strip() == '':
             tkMessageBox.showinfo('Name', 'Please enter name of the game')
             return
-        width = self.width_entry.get()
-        height = self.height_entry.get()
+        try:
+            width = int(self.width_entry.get())
+            height = int(self.height_entry.get())
+        except ValueError:
+            width = height = 0
+        if not (1 <= width <= common.MAX_FIELD_SIZE and
+                1 <= height <= common.MAX_FIELD_SIZE):
+            tkMessageBox.showinfo('Size', 'Width and height must be from 1 '
+                                  'to %d' % common.MAX_FIELD_SIZE)
+            return
 
         # Sending request to create game
         msg = clientlib.make_req_create_game(game_name, self.client_name,
@@ -259,9 +286,9 @@ class LobbyWindow(object):
     def join_game(self):
         '''Send join game request to server.
         '''
-        if self.listbox_opened.curselection() == ():
+        game_name = self.games_opened.selected()
+        if game_name is None:
             return
-        game_name = self.listbox_opened.get(self.listbox_opened.curselection())
 
         # Sending request to join game
         msg = clientlib.make_req_join_game(game_name, self.client_name)
@@ -271,9 +298,9 @@ class LobbyWindow(object):
     def join_game_closed(self):
         '''Send join game request to server.
         '''
-        if self.listbox_closed.curselection() == ():
+        game_name = self.games_closed.selected()
+        if game_name is None:
             return
-        game_name = self.listbox_closed.get(self.listbox_closed.curselection())
 
         # Sending request to join game
         msg = clientlib.make_req_join_game(game_name, self.client_name)
@@ -283,9 +310,9 @@ class LobbyWindow(object):
     def spectate_game(self):
         '''Send spectate game request to server.
         '''
-        if self.listbox_closed.curselection() == ():
+        game_name = self.games_closed.selected()
+        if game_name is None:
             return
-        game_name = self.listbox_closed.get(self.listbox_closed.curselection())
 
         # Sending request to spectate game
         msg = clientlib.make_req_spectate_game(game_name, self.client_name)
@@ -300,40 +327,42 @@ class LobbyWindow(object):
         @param body: str or unicode
         '''
         LOG.debug('Received message: %s', body)
-        msg_parts = body.split(common.SEP)
+        self.process_response(codec.decode(body))
+
+    def process_response(self, msg_parts):
+        '''React on parsed server response.
+        @param msg_parts: parsed message
+        '''
+        # Batch of responses
+        if msg_parts[0] == common.RSP_BATCH:
+            for response in common.unpack_messages(msg_parts[1:]):
+                self.process_response(response)
 
         if msg_parts[0] == common.RSP_DISCONNECTED or\
             msg_parts[0] == common.RSP_NAME_DOESNT_EXIST:
-            self.hide()
-            self.events.put(('server', None, None))
+            self.control.switch('server')
 
         if msg_parts[0] == common.RSP_LIST_OPENED:
-            for game_name in msg_parts[1:]:
-                if game_name.strip() != '':
-                    self.add_game(game_name, 'open')
+            self.add_page(msg_parts, 'open')
 
         if msg_parts[0] == common.RSP_LIST_CLOSED:
-            for game_name in msg_parts[1:]:
-                if game_name.strip() != '':
-                    self.add_game(game_name, 'close')
+            self.add_page(msg_parts, 'close')
         if msg_parts[0] == common.RSP_USERNAME_TAKEN:
             tkMessageBox.showinfo('Username', 'The username is already '+\
                                   'taken on this server')
 
         if msg_parts[0] == common.RSP_GAME_ENTERED:
-            # If game entered, hide lobby window and put event for the game
-            # window with necessary arguments (server name, client name, game
-            # name, is_owner, spectator, spectator_queue)
-            self.hide()
-            self.events.put(('game', threading.current_thread(),
-                             [self.server_name, self.client_name, msg_parts[1],
-                              int(msg_parts[2]), False, '']))
+            # If game entered, switch to the game window with necessary
+            # arguments (server name, client name, game name, is_owner,
+            # spectator, spectator_queue)
+            self.control.switch('game', [self.server_name, self.client_name,
+                                         msg_parts[1], int(msg_parts[2]),
+                                         False, ''])
 
         if msg_parts[0] == common.RSP_GAME_SPECTATE:
-            # If game entered, hide lobby window and put event for the game
-            # window with necessary arguments (server name, client name, game
-            # name, is_owner, spectator, spectator_queue)
-            self.hide()
-            self.events.put(('game', threading.current_thread(),
-                             [self.server_name, self.client_name, msg_parts[1],
-                              int(msg_parts[2]), True, msg_parts[3]]))
+            # If game entered, switch to the game window with necessary
+            # arguments (server name, client name, game name, is_owner,
+            # spectator, spectator_queue)
+            self.control.switch('game', [self.server_name, self.client_name,
+                                         msg_parts[1], int(msg_parts[2]),
+                                         True, msg_parts[3]])
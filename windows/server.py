@@ -5,16 +5,16 @@ Created on Tue Dec  6 21:29:21 2016
 @author: pavla
 """
 # Imports----------------------------------------------------------------------
-import threading
 import Tkinter
 import tkMessageBox
 import sys
 import logging
 # Custom imports --------------------------------------------------------------
 import clientlib
+import codec
 import common
 from common import send_message
-from . import listen
+from . import IndexedListbox
 # Logging ---------------------------------------------------------------------
 LOG = logging.getLogger(__name__)
 # Classes ---------------------------------------------------------------------
@@ -22,20 +22,23 @@ class ServerWindow(object):
     '''Window for displaying active servers, entering username, and connecting
     to servers.
     '''
-    def __init__(self, channel, server_advertisements, client_queue, events):
+    def __init__(self, channel, server_advertisements, client_queue,
+                 dispatcher, control, codec_name=codec.CODEC_TEXT):
         '''Set next window, gui elements, communication channel, and queues.
-        Show the server window.
         @param channel: pika connection channel
-        @param server_advertisements: queue for server advertisements
+        @param server_advertisements: queue for list of servers and events of
+                                      the directory
         @param client_queue: queue for messages to client
-        @param events: Queue of events for window control
+        @param dispatcher: Dispatcher of consumed messages
+        @param control: window control switching windows
+        @param codec_name: codec of responses asked for when connecting
         '''
         # Next window
         self.lobby_window = None
         self.game_window = None
 
-        # Queue of events for window control
-        self.events = events
+        # Window control
+        self.control = control
 
         # GUI
         self.root = Tkinter.Tk()
@@ -54,6 +57,7 @@ class ServerWindow(object):
         self.listbox_label.pack()
         self.listbox = Tkinter.Listbox(frame, width=40, height=20)
         self.listbox.pack()
+        self.servers = IndexedListbox(self.listbox, keep_sorted=True)
 
         self.button_connect = Tkinter.Button(
             frame, text="Connect", command=self.connect_server)
@@ -63,8 +67,13 @@ class ServerWindow(object):
         self.channel = channel
         self.server_advertisements = server_advertisements
         self.client_queue = client_queue
+        self.codec_name = codec_name
+        self.dispatcher = dispatcher
 
-        self.on_show()
+        # Version of the list of servers, and directory events that came
+        # before the list
+        self.version = None
+        self.pending_events = []
 
     def show(self, arguments=None):
         '''Show the server window.
@@ -75,29 +84,22 @@ class ServerWindow(object):
         self.on_show()
 
     def on_show(self):
-        '''Bind queues, set consuming and listen.
+        '''Bind queues and route messages to the window.
         '''
         # Clear listbox
-        self.listbox.delete(0, Tkinter.END)
+        self.servers.clear()
+        self.version = None
+        self.pending_events = []
         # Binding queues
-        self.channel.queue_bind(exchange='direct_logs',
-                                queue=self.server_advertisements,
-                                routing_key=common.make_key_server_advert())
-        self.channel.queue_bind(exchange='direct_logs',
-                                queue=self.server_advertisements,
-                                routing_key=common.make_key_server_stop())
-        self.channel.queue_bind(exchange='direct_logs',
-                                queue=self.client_queue,
-                                routing_key=self.client_queue)
-        # Set consuming
-        self.channel.basic_consume(self.update,
-                                   queue=self.server_advertisements,
-                                   no_ack=True)
-        self.channel.basic_consume(self.on_response,
-                                   queue=self.client_queue,
-                                   no_ack=True)
-        # Listening
-        self.listening_thread = listen(self.channel, 'server')
+        self.dispatcher.bind(self.server_advertisements,
+                             common.make_key_directory_events())
+        self.dispatcher.bind(self.server_advertisements,
+                             self.server_advertisements)
+        # Route messages
+        self.dispatcher.route({self.server_advertisements: self.update,
+                               self.client_queue: self.on_response})
+        # Events are followed before asking for the list of servers
+        self.request_servers()
 
     def hide(self):
         '''Hide the server window.
@@ -107,67 +109,106 @@ class ServerWindow(object):
         self.on_hide()
 
     def on_hide(self):
-        '''Unbind queues, stop consuming.
+        '''Unbind queues, stop routing messages to the window.
         '''
         # Unbinding queues
-        self.channel.queue_unbind(exchange='direct_logs',
-                                  queue=self.server_advertisements,
-                                  routing_key=common.make_key_server_advert())
-        self.channel.queue_unbind(exchange='direct_logs',
-                                  queue=self.server_advertisements,
-                                  routing_key=common.make_key_server_stop())
-        self.channel.queue_unbind(exchange='direct_logs',
-                                  queue=self.client_queue,
-                                  routing_key=self.client_queue)
-        # Stop consuming
-        if threading.current_thread() == self.listening_thread:
-            self.channel.stop_consuming()
-        else:
-            LOG.error('ServerWindow.on_hide called from non-listening thread.')
+        self.dispatcher.unbind(self.server_advertisements,
+                               common.make_key_directory_events())
+        self.dispatcher.unbind(self.server_advertisements,
+                               self.server_advertisements)
+        # Stop routing messages
+        self.dispatcher.route()
+
+    def request_servers(self):
+        '''Ask the directory for list of servers.
+        '''
+        self.version = None
+        msg = clientlib.make_req_list_servers()
+        send_message(self.channel, msg, common.make_key_directory(),
+                     self.server_advertisements)
 
     def add_server(self, name):
-        '''Add server name into the listbox.
+        '''Add server name into the sorted listbox with the next batch.
         @param name: server name
         '''
-        if name in self.listbox.get(0, Tkinter.END):
-            return
-        self.listbox.insert(Tkinter.END, name)
+        self.servers.add(name)
 
     def remove_server(self, name):
-        '''Remove server name from the listbox.
+        '''Remove server name from the listbox with the next batch.
         @param name: server name
         '''
-        if name not in self.listbox.get(0, Tkinter.END):
-            LOG.debug('Ignoring server %s removal, not in set.', name)
+        self.servers.remove(name)
+
+    def set_servers(self, version, names):
+        '''Replace listbox by list of servers, and apply events that came
+        before it.
+        @param version: version of the list
+        @param names: server names
+        '''
+        self.servers.set(names)
+        self.version = version
+
+        pending_events = self.pending_events
+        self.pending_events = []
+        for event_version, msg_parts in pending_events:
+            if event_version > self.version:
+                self.apply_event(event_version, msg_parts)
+
+    def apply_event(self, version, msg_parts):
+        '''Apply directory event following the known version of the list.
+        Missed event, e.g. after restart of the directory, leads to asking
+        for the whole list again.
+        @param version: version of the list after the event
+        @param msg_parts: event parts
+        '''
+        if version != self.version + 1:
+            LOG.debug('Directory events missed, asking for list again.')
+            self.request_servers()
             return
-        listbox_index = self.listbox.get(0, Tkinter.END).index(name)
-        self.listbox.delete(listbox_index)
+        self.version = version
+        if msg_parts[0] == common.E_SERVER_JOIN:
+            self.add_server(msg_parts[1])
+        elif msg_parts[0] in (common.E_SERVER_LEAVE, common.E_SERVER_EXPIRE):
+            self.remove_server(msg_parts[1])
 
     def update(self, ch, method, properties, body):
-        '''Update listbox of server names.
+        '''Update listbox of server names from list of servers or directory
+        event.
         @param ch: pika.BlockingChannel
         @param method: pika.spec.Basic.Deliver
         @param properties: pika.spec.BasicProperties
         @param body: str or unicode
         '''
-        if method.routing_key == common.make_key_server_advert():
-            self.add_server(body)
-        if method.routing_key == common.make_key_server_stop():
-            self.remove_server(body)
+        msg_parts = body.split(common.SEP)
+        if msg_parts[0] == common.RSP_LIST_SERVERS:
+            try:
+                self.set_servers(int(msg_parts[1]), msg_parts[2:])
+            except (IndexError, ValueError):
+                LOG.debug('Invalid list of servers: %s', body)
+            return
+
+        version = common.get_version(properties)
+        if version is None or len(msg_parts) != 2:
+            return
+        if self.version is None:
+            # List of servers did not come yet
+            self.pending_events.append((version, msg_parts))
+        elif version > self.version:
+            self.apply_event(version, msg_parts)
 
     def connect_server(self):
         '''Send connection request to server selected in the listbox.
         '''
-        if self.listbox.curselection() == ():
+        server_name = self.servers.selected()
+        if server_name is None:
             return
-        server_name = self.listbox.get(self.listbox.curselection())
         client_name = self.username_entry.get()
         if client_name.strip() == '':
             tkMessageBox.showinfo('Username', 'Please enter username')
             return
 
         # Sending connect request
-        msg = clientlib.make_req_connect(client_name)
+        msg = clientlib.make_req_connect(client_name, self.codec_name)
         routing_key = common.make_key_server(server_name)
         send_message(self.channel, msg, routing_key, self.client_queue)
 
@@ -179,13 +220,11 @@ class ServerWindow(object):
         @param body: str or unicode
         '''
         LOG.debug('Received message: %s', body)
-        msg_parts = body.split(common.SEP)
+        msg_parts = codec.decode(body)
         if msg_parts[0] == common.RSP_CONNECTED:
-            # If response ok, hide server window and put event for the lobby
-            # window with necessary arguments (server name, client name)
-            self.hide()
-            self.events.put(('lobby', threading.current_thread(),
-                             [msg_parts[1], msg_parts[2]]))
+            # If response ok, switch to the lobby window with necessary
+            # arguments (server name, client name)
+            self.control.switch('lobby', [msg_parts[1], msg_parts[2]])
         if msg_parts[0] == common.RSP_USERNAME_TAKEN:
             tkMessageBox.showinfo('Username', 'The username is already '+\
                                   'taken on this server')